@@ -15,6 +15,11 @@ import array
 import getopt
 import platform
 import errno
+
+import numpy
+
+import bayerframe
+import dngreader
 import math
 
 
@@ -22,70 +27,24 @@ inputFilename = "S:\\KronTech\\Raw\\testScene_000002.dng"
 outputBase = "S:\\KronTech\\Raw\\test\\"
 
 # set up the image binary data
-rawFile = open(inputFilename, "rb")
-rawDNG = rawFile.read()
-
-# this will itterate through DNGs to find the raw image data
-def parseIFD(rawFile, ifdOffset):
-    foundIFDList = []
-    stripOffset = None
-    validImageFound = False
-    width = 0
-    height = 0
-    ifdLength = struct.unpack_from("<H", rawFile, ifdOffset)[0]
-    for i in range(ifdLength):
-        tagID, tagDataType, tagDataCount, tagValue = struct.unpack_from("<HHII", rawFile, ifdOffset+2+(i*12))
-        if tagID == 254 and tagValue == 0:
-            validImageFound = True
-            
-        if tagID == 273:
-            stripOffset = tagValue
-
-        if tagID == 330:
-            foundIFDList.append(tagValue)
-
-        if tagID == 256:
-            width = tagValue
-
-        if tagID == 257:
-            height = tagValue
-
-    nextIFD = struct.unpack_from("<I", rawFile, ifdOffset+2 + ifdLength*12)[0]
-
-    if nextIFD > 0:
-        foundIFDList.append(nextIFD)
-
-    if not validImageFound:
-        for ifd in foundIFDList:
-            stripOffset, width, height = parseIFD(rawFile, ifd)
-
-    return stripOffset, width, height
-        
-ifdOffset = struct.unpack_from("<I", rawDNG, 4)[0]
-stripOffset, hres, vres = parseIFD(rawDNG, ifdOffset)
-
-if not stripOffset:
-    print("Image data not found")
+try:
+    dng = dngreader.dngReader(inputFilename)
+    cfa = dng.cfa(leftJustify=True)
+except ValueError as e:
+    print("Image data not found: %s" % e)
     sys.exit(0)
+hres, vres = dng.width, dng.length
 
-print("Image data found at offset: 0x%08X %dx%d" % (stripOffset, hres, vres))
+print("Image data found: %dx%d, %d bits per sample" % (hres, vres, dng.bitsPerSample))
 
-rawImage = [hres, vres, array.array('H', rawDNG[stripOffset:(stripOffset + 2*hres*vres)])]
+# the green interpolation is computed two pixels past the edges, and reads
+# two pixels further, so the image gets a halo of four pixels, folded to
+# keep the bayer format
+rawImage = bayerframe.fromCFA(cfa, halo=4)
 
             
 def getPixel(rawImage, x, y):
-    # make sure the selected pixel is within the image while keeping it in bayer format
-    while x < 0:
-        x += 2
-    while x >= rawImage[0]:
-        x -= 2
-    while y < 0:
-        y += 2
-    while y >= rawImage[1]:
-        y -= 2
-
-    value = rawImage[2][x+(y*rawImage[0])]
-    return value >> 4
+    return rawImage.pixel(x, y) >> 4
 
 #===============================================================================================================
 # From here down is the test
@@ -95,55 +54,51 @@ def getPixel(rawImage, x, y):
 # G Interpolation
 print('-------------------------------------------------')
 print("calculating green interpolation")
-gInterpolation_H = {}
-gInterpolation_V = {}
-for y in range(-2,vres+2):
-    gInterpolation_H[y] = {}
-    gInterpolation_V[y] = {}
+gInterpolation_H = rawImage.plane(numpy.uint16, halo=2)
+gInterpolation_V = rawImage.plane(numpy.uint16, halo=2)
 
 print(" - horizontal mapping")
 for y in range(-2,vres+2):
     for x in range(-2,hres+2):
-        gInterpolation_H[y][x] = (-1 * getPixel(rawImage, x-2,   y) +
-                                  2  * getPixel(rawImage, x-1,   y) +
-                                  2  * getPixel(rawImage,   x,   y) +
-                                  2  * getPixel(rawImage, x+1,   y) +
-                                  -1 * getPixel(rawImage, x+2,   y)) // 4
+        g = (-1 * getPixel(rawImage, x-2,   y) +
+             2  * getPixel(rawImage, x-1,   y) +
+             2  * getPixel(rawImage,   x,   y) +
+             2  * getPixel(rawImage, x+1,   y) +
+             -1 * getPixel(rawImage, x+2,   y)) // 4
 
-        if gInterpolation_H[y][x] > 4095: gInterpolation_H[y][x] = 4095
-        if gInterpolation_H[y][x] <    0: gInterpolation_H[y][x] = 0
+        if g > 4095: g = 4095
+        if g <    0: g = 0
+        gInterpolation_H.setPixel(x, y, g)
 
 print(" - vertical mapping")
 for y in range(-2,vres+2):
     for x in range(-2,hres+2):
-        gInterpolation_V[y][x] = (-1 * getPixel(rawImage,   x, y-2) +
-                                  2  * getPixel(rawImage,   x, y-1) +
-                                  2  * getPixel(rawImage,   x,   y) +
-                                  2  * getPixel(rawImage,   x, y+1) +
-                                  -1 * getPixel(rawImage,   x, y+2)) // 4
+        g = (-1 * getPixel(rawImage,   x, y-2) +
+             2  * getPixel(rawImage,   x, y-1) +
+             2  * getPixel(rawImage,   x,   y) +
+             2  * getPixel(rawImage,   x, y+1) +
+             -1 * getPixel(rawImage,   x, y+2)) // 4
 
-        if gInterpolation_V[y][x] > 4095: gInterpolation_V[y][x] = 4095
-        if gInterpolation_V[y][x] <    0: gInterpolation_V[y][x] = 0
+        if g > 4095: g = 4095
+        if g <    0: g = 0
+        gInterpolation_V.setPixel(x, y, g)
 
 print(" Writing to disk")
 # write interpolation 
 gInterpolation_H_out = open(outputBase+'001a_gInterpolation_H_out.data', 'wb')
 gInterpolation_V_out = open(outputBase+'001b_gInterpolation_V_out.data', 'wb')
-for y in range(vres):
-    for x in range(hres):
-        gInterpolation_H_out.write(struct.pack("<H", gInterpolation_H[y][x] << 4))
-        gInterpolation_V_out.write(struct.pack("<H", gInterpolation_V[y][x] << 4))
+gInterpolation_H_out.write((gInterpolation_H.image << 4).astype('<u2').tobytes())
+gInterpolation_V_out.write((gInterpolation_V.image << 4).astype('<u2').tobytes())
     
         
 # R/B Interpolation
 print('-------------------------------------------------')
 print('calculating R/B interpolation')
 
-rgbInterpolation_H = {}
-rgbInterpolation_V = {}
-for y in range(vres):
-    rgbInterpolation_H[y] = {}
-    rgbInterpolation_V[y] = {}
+# the homogeneity maps read the neighbours of border pixels, so these get a
+# halo of one pixel once they are complete
+rgbInterpolation_H = rawImage.plane(numpy.uint16, channels=3, halo=1)
+rgbInterpolation_V = rawImage.plane(numpy.uint16, channels=3, halo=1)
 
 rgbInterpolation_H_out = open(outputBase+'002a_rgbInterpolation_H_out.data', 'wb')
 print(' - Horizontal')
@@ -151,15 +106,15 @@ for y in range(vres):
     for x in range(hres):
         hBlend = (getPixel(rawImage, x, y) +
                   (getPixel(rawImage, x-1, y) + getPixel(rawImage, x+1, y) -
-                   gInterpolation_H[y][x-1] - gInterpolation_H[y][x+1])//2)
+                   gInterpolation_H.pixel(x-1, y) - gInterpolation_H.pixel(x+1, y))//2)
         vBlend = (getPixel(rawImage, x, y) +
                   (getPixel(rawImage, x, y-1) + getPixel(rawImage, x, y+1) -
-                   gInterpolation_H[y-1][x] - gInterpolation_H[y+1][x])//2)
-        xBlend = (gInterpolation_H[y][x] +
+                   gInterpolation_H.pixel(x, y-1) - gInterpolation_H.pixel(x, y+1))//2)
+        xBlend = (gInterpolation_H.pixel(x, y) +
                   (getPixel(rawImage, x-1,y-1) + getPixel(rawImage, x+1,y-1) +
                    getPixel(rawImage, x-1,y+1) + getPixel(rawImage, x+1,y+1) -
-                   gInterpolation_H[y-1][x-1] - gInterpolation_H[y-1][x+1] -
-                   gInterpolation_H[y+1][x-1] - gInterpolation_H[y+1][x+1])//4)
+                   gInterpolation_H.pixel(x-1, y-1) - gInterpolation_H.pixel(x+1, y-1) -
+                   gInterpolation_H.pixel(x-1, y+1) - gInterpolation_H.pixel(x+1, y+1))//4)
         if hBlend < 0: hBlend = 0
         if hBlend > 4095: hBlend = 4095
         if vBlend < 0: vBlend = 0
@@ -173,19 +128,20 @@ for y in range(vres):
             blue = vBlend
         elif pos == 1:
             red = getPixel(rawImage,x,y)
-            green = gInterpolation_H[y][x]
+            green = gInterpolation_H.pixel(x, y)
             blue = xBlend
         elif pos == 2:
             red = xBlend
-            green = gInterpolation_H[y][x]
+            green = gInterpolation_H.pixel(x, y)
             blue = getPixel(rawImage,x,y)
         else:
             red = vBlend
             green = getPixel(rawImage,x,y)
             blue = hBlend
-        rgbInterpolation_H[y][x] = [red, green, blue]
-        rgbInterpolation_H_out.write(struct.pack("<BBB", red>>4, green>>4, blue>>4))
+        rgbInterpolation_H.image[y, x] = (red, green, blue)
+rgbInterpolation_H_out.write((rgbInterpolation_H.image >> 4).astype(numpy.uint8).tobytes())
 rgbInterpolation_H_out.close()
+rgbInterpolation_H.fillHalo()
 
 rgbInterpolation_V_out = open(outputBase+'002b_rgbInterpolation_V_out.data', 'wb')
 print(' - Vertical')
@@ -193,15 +149,15 @@ for y in range(vres):
     for x in range(hres):
         hBlend = (getPixel(rawImage, x, y) +
                   (getPixel(rawImage, x-1, y) + getPixel(rawImage, x+1, y) -
-                   gInterpolation_V[y][x-1] - gInterpolation_V[y][x+1])//2)
+                   gInterpolation_V.pixel(x-1, y) - gInterpolation_V.pixel(x+1, y))//2)
         vBlend = (getPixel(rawImage, x, y) +
                   (getPixel(rawImage, x, y-1) + getPixel(rawImage, x, y+1) -
-                   gInterpolation_V[y-1][x] - gInterpolation_V[y+1][x])//2)
-        xBlend = (gInterpolation_V[y][x] +
+                   gInterpolation_V.pixel(x, y-1) - gInterpolation_V.pixel(x, y+1))//2)
+        xBlend = (gInterpolation_V.pixel(x, y) +
                   (getPixel(rawImage, x-1,y-1) + getPixel(rawImage, x+1,y-1) +
                    getPixel(rawImage, x-1,y+1) + getPixel(rawImage, x+1,y+1) -
-                   gInterpolation_V[y-1][x-1] - gInterpolation_V[y-1][x+1] -
-                   gInterpolation_V[y+1][x-1] - gInterpolation_V[y+1][x+1])//4)
+                   gInterpolation_V.pixel(x-1, y-1) - gInterpolation_V.pixel(x+1, y-1) -
+                   gInterpolation_V.pixel(x-1, y+1) - gInterpolation_V.pixel(x+1, y+1))//4)
         if hBlend < 0: hBlend = 0
         if hBlend > 4095: hBlend = 4095
         if vBlend < 0: vBlend = 0
@@ -215,27 +171,24 @@ for y in range(vres):
             blue = vBlend
         elif pos == 1:
             red = getPixel(rawImage,x,y)
-            green = gInterpolation_V[y][x]
+            green = gInterpolation_V.pixel(x, y)
             blue = xBlend
         elif pos == 2:
             red = xBlend
-            green = gInterpolation_V[y][x]
+            green = gInterpolation_V.pixel(x, y)
             blue = getPixel(rawImage,x,y)
         else:
             red = vBlend
             green = getPixel(rawImage,x,y)
             blue = hBlend
-        rgbInterpolation_V[y][x] = [red, green, blue]
-        rgbInterpolation_V_out.write(struct.pack("<BBB", red>>4, green>>4, blue>>4))
+        rgbInterpolation_V.image[y, x] = (red, green, blue)
+rgbInterpolation_V_out.write((rgbInterpolation_V.image >> 4).astype(numpy.uint8).tobytes())
 rgbInterpolation_V_out.close()
+rgbInterpolation_V.fillHalo()
 
 
 def getValue(data, x, y):
-    while x < 0: x+= 2
-    while x >= len(data[0]): x -= 2
-    while y < 0: y+= 2
-    while y >= len(data): y -= 2
-    return data[y][x]
+    return data.pixels(x, y)
 
 
 rgb_to_lab = [[ 0.412453, 0.357580, 0.180423 ],
@@ -267,13 +220,9 @@ def getLab(data, x, y):
 
 
 
-rgbOut = {}
-for y in range(vres):
-    rgbOut[y] = {}
+rgbOut = rawImage.plane(numpy.uint16, channels=3, halo=0)
 
-homogMap = {}
-for y in range(vres):
-    homogMap[y] = {}
+homogMap = rawImage.plane(numpy.int16, halo=0)
     
 # Homogeneity Map
 
@@ -359,21 +308,25 @@ for y in range(vres):
         homogMap_H_out.write(struct.pack("<H", max(min(h_homog, 65535), 0)))
 
         
+        rgb_H = getValue(rgbInterpolation_H, x, y)
+        rgb_V = getValue(rgbInterpolation_V, x, y)
         val = v_homog - h_homog
-        homogMap[y][x] = val
-        if homogMap[y][x] > 32767: homogMap[y][x] = 32767
-        if homogMap[y][x] < -32767: homogMap[y][x] = -32767
+        homog = val
+        if homog > 32767: homog = 32767
+        if homog < -32767: homog = -32767
         if (val > gutter):
-            rgbOut[y][x] = rgbInterpolation_V[y][x]
+            out = rgb_V
         elif (val < -gutter):
-            rgbOut[y][x] = rgbInterpolation_H[y][x]
+            out = rgb_H
         else:
-            rgbOut[y][x] = [(rgbInterpolation_V[y][x][0] + rgbInterpolation_H[y][x][0])>>1,
-                            (rgbInterpolation_V[y][x][1] + rgbInterpolation_H[y][x][1])>>1,
-                            (rgbInterpolation_V[y][x][2] + rgbInterpolation_H[y][x][2])>>1]
+            out = [(rgb_V[0] + rgb_H[0])>>1,
+                   (rgb_V[1] + rgb_H[1])>>1,
+                   (rgb_V[2] + rgb_H[2])>>1]
+        homogMap.setPixel(x, y, homog)
+        rgbOut.image[y, x] = out
 
-        homogMap_out.write(struct.pack("<H", homogMap[y][x] + 32768))
-        rgbOut_out.write(struct.pack("<BBB", rgbOut[y][x][0]>>4, rgbOut[y][x][1]>>4, rgbOut[y][x][2]>>4))
+        homogMap_out.write(struct.pack("<H", homog + 32768))
+        rgbOut_out.write(struct.pack("<BBB", out[0]>>4, out[1]>>4, out[2]>>4))
 
         # AHD original method
         
@@ -416,16 +369,16 @@ for y in range(vres):
         
         if v_homog > h_homog:
             ahdMap_out.write(struct.pack("<H", 50000))
-            ahdOut_out.write(struct.pack("<BBB", rgbInterpolation_V[y][x][0]>>4, rgbInterpolation_V[y][x][1]>>4, rgbInterpolation_V[y][x][2]>>4))
+            ahdOut_out.write(struct.pack("<BBB", rgb_V[0]>>4, rgb_V[1]>>4, rgb_V[2]>>4))
         elif v_homog < h_homog:
             ahdMap_out.write(struct.pack("<H", 10000))
-            ahdOut_out.write(struct.pack("<BBB", rgbInterpolation_H[y][x][0]>>4, rgbInterpolation_H[y][x][1]>>4, rgbInterpolation_H[y][x][2]>>4))
+            ahdOut_out.write(struct.pack("<BBB", rgb_H[0]>>4, rgb_H[1]>>4, rgb_H[2]>>4))
         else:
             ahdMap_out.write(struct.pack("<H", 30000))
             ahdOut_out.write(struct.pack("<BBB",
-                                         (rgbInterpolation_H[y][x][0]+rgbInterpolation_V[y][x][0])>>5,
-                                         (rgbInterpolation_H[y][x][1]+rgbInterpolation_V[y][x][1])>>5,
-                                         (rgbInterpolation_H[y][x][2]+rgbInterpolation_V[y][x][2])>>5))
+                                         (rgb_H[0]+rgb_V[0])>>5,
+                                         (rgb_H[1]+rgb_V[1])>>5,
+                                         (rgb_H[2]+rgb_V[2])>>5))
 
 homogMap_out.close()
 homogMap_H_out.close()
@@ -17,93 +17,43 @@ import getopt
 import platform
 import errno
 
+import numpy
+
+import bayerframe
+import dngreader
+
 def constrain(val, min_val, max_val):
     return min(max_val, max(min_val, val))
-def demConstrain(val, min_val, max_val):
-    while val < min_val:
-        val += 2
-    while val >= max_val:
-        val -= 2
-    return val
 
 inputFilename = "S:\\KronTech\\Raw\\testScene_000002.dng"
 outputBase = "S:\\KronTech\\Raw\\test_igd\\"
 
 # set up the image binary data
-rawFile = open(inputFilename, "rb")
-rawDNG = rawFile.read()
-
-# this will itterate through DNGs to find the raw image data
-def parseIFD(rawFile, ifdOffset):
-    foundIFDList = []
-    stripOffset = None
-    validImageFound = False
-    width = 0
-    height = 0
-    ifdLength = struct.unpack_from("<H", rawFile, ifdOffset)[0]
-    for i in range(ifdLength):
-        tagID, tagDataType, tagDataCount, tagValue = struct.unpack_from("<HHII", rawFile, ifdOffset+2+(i*12))
-        if tagID == 254 and tagValue == 0:
-            validImageFound = True
-            
-        if tagID == 273:
-            stripOffset = tagValue
-
-        if tagID == 330:
-            foundIFDList.append(tagValue)
-
-        if tagID == 256:
-            width = tagValue
-
-        if tagID == 257:
-            height = tagValue
-
-    nextIFD = struct.unpack_from("<I", rawFile, ifdOffset+2 + ifdLength*12)[0]
-
-    if nextIFD > 0:
-        foundIFDList.append(nextIFD)
-
-    if not validImageFound:
-        for ifd in foundIFDList:
-            stripOffset, width, height = parseIFD(rawFile, ifd)
-
-    return stripOffset, width, height
-        
-ifdOffset = struct.unpack_from("<I", rawDNG, 4)[0]
-stripOffset, hres, vres = parseIFD(rawDNG, ifdOffset)
-
-if not stripOffset:
-    print("Image data not found")
+try:
+    dng = dngreader.dngReader(inputFilename)
+    cfa = dng.cfa(leftJustify=True)
+except ValueError as e:
+    print("Image data not found: %s" % e)
     sys.exit(0)
+hres, vres = dng.width, dng.length
 
-print("Image data found at offset: 0x%08X %dx%d" % (stripOffset, hres, vres))
+print("Image data found: %dx%d, %d bits per sample" % (hres, vres, dng.bitsPerSample))
 
-rawImage = [hres, vres, array.array('H', rawDNG[stripOffset:(stripOffset + 2*hres*vres)])]
+# the image and the green estimate have a halo of two pixels, folded to keep
+# the bayer format, so their neighbours are read without bounds checks
+rawImage = bayerframe.fromCFA(cfa, halo=2)
 
 
             
 def getPixel(rawImage, x, y):
-    # make sure the selected pixel is within the image while keeping it in bayer format
-    while x < 0:
-        x += 2
-    while x >= rawImage[0]:
-        x -= 2
-    while y < 0:
-        y += 2
-    while y >= rawImage[1]:
-        y -= 2
-
-    value = rawImage[2][x+(y*rawImage[0])]
-    return value
+    return rawImage.pixel(x, y)
 
 #===============================================================================================================
 # From here down is the test
 
 print('001 - Original image')
 image_out = open(outputBase+'001_image.data', 'wb')
-for y in range(vres):
-    for x in range(hres):
-        image_out.write(struct.pack("<H", getPixel(rawImage, x, y)))
+image_out.write(rawImage.image.astype('<u2').tobytes())
 
 image_out.close()
 
@@ -111,25 +61,18 @@ image_out.close()
 
 print('002 - Calculating Integrated Gradients')
 
-integrationGradientEWGB = {}
-integrationGradientEWGR = {}
-integrationGradientNSGB = {}
-integrationGradientNSGR = {}
-for y in range(vres//2):
-    integrationGradientEWGB[y] = {}
-    integrationGradientEWGR[y] = {}
-    
-for y in range(vres):
-    integrationGradientNSGB[y] = {}
-    integrationGradientNSGR[y] = {}
+# the east-west gradients of the blue and red rows, and the north-south
+# gradients of the columns, each at half the resolution of the image. Only
+# the rows of the first, and the columns of the second, are folded
+integrationGradientEWGB = bayerframe.bayerFrame(hres, vres//2)
+integrationGradientEWGR = bayerframe.bayerFrame(hres, vres//2)
+integrationGradientNSGB = bayerframe.bayerFrame(hres//2, vres)
+integrationGradientNSGR = bayerframe.bayerFrame(hres//2, vres)
 
 
     
-ig_ew = {}
-ig_ns = {}
-for y in range(vres):
-    ig_ew[y] = {}
-    ig_ns[y] = {}
+ig_ew = rawImage.plane(numpy.int32)
+ig_ns = rawImage.plane(numpy.int32)
 
 for y in range(vres):
     for x in range(hres):
@@ -144,17 +87,20 @@ for y in range(vres):
         IG = abs(IG)
         IG = constrain(IG, 0, 65535)
         if (y & 1):
-            integrationGradientEWGB[y//2][x] = IG
+            integrationGradientEWGB.setPixel(x, y//2, IG)
         else:
-            integrationGradientEWGR[y//2][x] = IG
+            integrationGradientEWGR.setPixel(x, y//2, IG)
 
+integrationGradientEWGB.fillHalo()
+integrationGradientEWGR.fillHalo()
 for y in range(0,vres,2):
     for x in range(hres):
-        ig_ew[y][x] = 0
+        ig = 0
         for t in range(-1,2):
-            ig_ew[y][x] += abs(integrationGradientEWGB[y//2][demConstrain(x+t,0,hres)] - integrationGradientEWGB[y//2][demConstrain(x+t-1,0,hres)])
-            ig_ew[y][x] += abs(integrationGradientEWGR[y//2][demConstrain(x+t,0,hres)] - integrationGradientEWGR[y//2][demConstrain(x+t-1,0,hres)])
-        ig_ew[y+1][x] = ig_ew[y][x]
+            ig += abs(integrationGradientEWGB.pixel(x+t, y//2) - integrationGradientEWGB.pixel(x+t-1, y//2))
+            ig += abs(integrationGradientEWGR.pixel(x+t, y//2) - integrationGradientEWGR.pixel(x+t-1, y//2))
+        ig_ew.setPixel(x, y, ig)
+        ig_ew.setPixel(x, y+1, ig)
             
 for y in range(vres):
     for x in range(hres):
@@ -168,17 +114,20 @@ for y in range(vres):
         IG = abs(IG)
         IG = constrain(IG, 0, 65535)
         if (x & 1):
-            integrationGradientNSGB[y][x//2] = IG
+            integrationGradientNSGB.setPixel(x//2, y, IG)
         else:
-            integrationGradientNSGR[y][x//2] = IG
+            integrationGradientNSGR.setPixel(x//2, y, IG)
 
+integrationGradientNSGB.fillHalo()
+integrationGradientNSGR.fillHalo()
 for y in range(vres):
     for x in range(0,hres,2):
-        ig_ns[y][x] = 0
+        ig = 0
         for t in range(-1,2):
-            ig_ns[y][x] += abs(integrationGradientNSGB[demConstrain(y+t,0,vres)][x//2] - integrationGradientNSGB[demConstrain(y+t-1,0,vres)][x//2])
-            ig_ns[y][x] += abs(integrationGradientNSGR[demConstrain(y+t,0,vres)][x//2] - integrationGradientNSGR[demConstrain(y+t-1,0,vres)][x//2])
-        ig_ns[y][x+1] = ig_ns[y][x]
+            ig += abs(integrationGradientNSGB.pixel(x//2, y+t) - integrationGradientNSGB.pixel(x//2, y+t-1))
+            ig += abs(integrationGradientNSGR.pixel(x//2, y+t) - integrationGradientNSGR.pixel(x//2, y+t-1))
+        ig_ns.setPixel(x, y, ig)
+        ig_ns.setPixel(x+1, y, ig)
 
 print(' - writing')
 IG_EWGB_out = open(outputBase+'002a_IG_EWGB.data', 'wb')
@@ -194,20 +143,20 @@ IG_DNS_out = open(outputBase+'002cd_IG_delta_NS.data', 'wb')
 for y in range(vres):
     for x in range(hres):
         if (y & 1):
-            IG_EWGB_out.write(struct.pack("<H", integrationGradientEWGB[y//2][x]))
-            IG_EW_out.write(struct.pack("<H", integrationGradientEWGB[y//2][x]))
+            IG_EWGB_out.write(struct.pack("<H", integrationGradientEWGB.pixel(x, y//2)))
+            IG_EW_out.write(struct.pack("<H", integrationGradientEWGB.pixel(x, y//2)))
         else:
-            IG_EWGR_out.write(struct.pack("<H", integrationGradientEWGR[y//2][x]))
-            IG_EW_out.write(struct.pack("<H", integrationGradientEWGR[y//2][x]))
+            IG_EWGR_out.write(struct.pack("<H", integrationGradientEWGR.pixel(x, y//2)))
+            IG_EW_out.write(struct.pack("<H", integrationGradientEWGR.pixel(x, y//2)))
         if (x & 1):
-            IG_NSGB_out.write(struct.pack("<H", integrationGradientNSGB[y][x//2]))
-            IG_NS_out.write(struct.pack("<H", integrationGradientNSGB[y][x//2]))
+            IG_NSGB_out.write(struct.pack("<H", integrationGradientNSGB.pixel(x//2, y)))
+            IG_NS_out.write(struct.pack("<H", integrationGradientNSGB.pixel(x//2, y)))
         else:
-            IG_NSGR_out.write(struct.pack("<H", integrationGradientNSGR[y][x//2]))
-            IG_NS_out.write(struct.pack("<H", integrationGradientNSGR[y][x//2]))
+            IG_NSGR_out.write(struct.pack("<H", integrationGradientNSGR.pixel(x//2, y)))
+            IG_NS_out.write(struct.pack("<H", integrationGradientNSGR.pixel(x//2, y)))
 
-        IG_DEW_out.write(struct.pack("<H", ig_ew[y][x]))
-        IG_DNS_out.write(struct.pack("<H", ig_ns[y][x]))
+        IG_DEW_out.write(struct.pack("<H", ig_ew.pixel(x, y)))
+        IG_DNS_out.write(struct.pack("<H", ig_ns.pixel(x, y)))
 
 IG_EWGB_out.close()
 IG_EWGR_out.close()
@@ -221,55 +170,48 @@ IG_DNS_out.close()
 #------------------------------------------------------------------------------------------
 print('003 - Green estimation')
 
-h_greenInterp = {}
-v_greenInterp = {}
-d_greenInterp = {}
-greenInterp = {}
-interpDirection = {}
-ig_delta_h = {}
-ig_delta_v = {}
-for y in range(vres):
-    h_greenInterp[y] = {}
-    v_greenInterp[y] = {}
-    d_greenInterp[y] = {}
-    greenInterp[y] = {}
-    interpDirection[y] = {}
-    ig_delta_h[y] = {}
-    ig_delta_v[y] = {}
+h_greenInterp = rawImage.plane(numpy.uint16)
+v_greenInterp = rawImage.plane(numpy.uint16)
+d_greenInterp = rawImage.plane(numpy.uint16)
+greenInterp = rawImage.plane(numpy.uint16)
+interpDirection = rawImage.plane(numpy.uint16)
 
     
 for y in range(vres):
     for x in range(hres):
-        delta = ig_ew[y][x] - ig_ns[y][x]
+        delta = ig_ew.pixel(x, y) - ig_ns.pixel(x, y)
         if abs(delta) < 200:
-            interpDirection[y][x] = 20000
+            interpDirection.setPixel(x, y, 20000)
         elif delta > 0:
-            interpDirection[y][x] = 30000
+            interpDirection.setPixel(x, y, 30000)
         else:
-            interpDirection[y][x] = 10000
+            interpDirection.setPixel(x, y, 10000)
 
         if not ((x & 1) ^ (y & 1)):
-            greenInterp[y][x] = getPixel(rawImage, x, y)
-            h_greenInterp[y][x] = getPixel(rawImage, x, y)
-            v_greenInterp[y][x] = getPixel(rawImage, x, y)
-            d_greenInterp[y][x] = getPixel(rawImage, x, y)
+            h_green = v_green = d_green = green = getPixel(rawImage, x, y)
         else:
-            h_greenInterp[y][x] = ((getPixel(rawImage, x-1, y) + getPixel(rawImage, x+1, y))//2  +   (2*getPixel(rawImage, x, y) - getPixel(rawImage, x-2, y) - getPixel(rawImage, x+2, y))//6)
-            v_greenInterp[y][x] = ((getPixel(rawImage, x, y-1) + getPixel(rawImage, x, y+1))//2  +   (2*getPixel(rawImage, x, y) - getPixel(rawImage, x, y-2) - getPixel(rawImage, x, y+2))//6)
-            d_greenInterp[y][x] = (h_greenInterp[y][x] + v_greenInterp[y][x]) // 2
+            h_green = ((getPixel(rawImage, x-1, y) + getPixel(rawImage, x+1, y))//2  +   (2*getPixel(rawImage, x, y) - getPixel(rawImage, x-2, y) - getPixel(rawImage, x+2, y))//6)
+            v_green = ((getPixel(rawImage, x, y-1) + getPixel(rawImage, x, y+1))//2  +   (2*getPixel(rawImage, x, y) - getPixel(rawImage, x, y-2) - getPixel(rawImage, x, y+2))//6)
+            d_green = (h_green + v_green) // 2
 
-            h_greenInterp[y][x] = constrain(h_greenInterp[y][x], 0, 65535)
-            v_greenInterp[y][x] = constrain(v_greenInterp[y][x], 0, 65535)
-            d_greenInterp[y][x] = constrain(d_greenInterp[y][x], 0, 65535)
+            h_green = constrain(h_green, 0, 65535)
+            v_green = constrain(v_green, 0, 65535)
+            d_green = constrain(d_green, 0, 65535)
 
             if abs(delta) < 200:
-                greenInterp[y][x] = d_greenInterp[y][x]
+                green = d_green
             elif delta > 0:
-                greenInterp[y][x] = v_greenInterp[y][x]
+                green = v_green
             else:
-                greenInterp[y][x] = h_greenInterp[y][x]
-                
+                green = h_green
+
+        h_greenInterp.setPixel(x, y, h_green)
+        v_greenInterp.setPixel(x, y, v_green)
+        d_greenInterp.setPixel(x, y, d_green)
+        greenInterp.setPixel(x, y, green)
                 
+# the next stages read the green of the neighbours of border pixels
+greenInterp.fillHalo()
 
 print(' - writing')
 h_greenInterp_out   = open(outputBase+'003a_h_green.data', 'wb')
@@ -278,13 +220,11 @@ d_greenInterp_out   = open(outputBase+'003c_d_green.data', 'wb')
 interpDirection_out = open(outputBase+'003d_interp.data', 'wb')
 greenInterp_out     = open(outputBase+'003e_output.data', 'wb')
 
-for y in range(vres):
-    for x in range(hres):
-        h_greenInterp_out.write(struct.pack("<H", h_greenInterp[y][x]))
-        v_greenInterp_out.write(struct.pack("<H", v_greenInterp[y][x]))
-        d_greenInterp_out.write(struct.pack("<H", d_greenInterp[y][x]))
-        interpDirection_out.write(struct.pack("<H", interpDirection[y][x]))
-        greenInterp_out.write(struct.pack("<H", greenInterp[y][x]))
+h_greenInterp_out.write(h_greenInterp.image.astype('<u2').tobytes())
+v_greenInterp_out.write(v_greenInterp.image.astype('<u2').tobytes())
+d_greenInterp_out.write(d_greenInterp.image.astype('<u2').tobytes())
+interpDirection_out.write(interpDirection.image.astype('<u2').tobytes())
+greenInterp_out.write(greenInterp.image.astype('<u2').tobytes())
 
 h_greenInterp_out.close()
 v_greenInterp_out.close()
@@ -295,18 +235,16 @@ greenInterp_out.close()
 #------------------------------------------------------------------------------------------
 print('004 - Enhance Green')
 
-enhancedGreen = {}
-for y in range(vres):
-    enhancedGreen[y] = {}
+enhancedGreen = rawImage.plane(numpy.uint16)
 
 for y in range(vres):
     for x in range(hres):
         if ((x & 1) ^ (y & 1)): # not a green sample
-            d_east  = greenInterp[y][demConstrain(x+2,0,hres)] - getPixel(rawImage, x+2, y)
-            d_west  = greenInterp[y][demConstrain(x-2,0,hres)] - getPixel(rawImage, x-2, y)
-            d_north = greenInterp[demConstrain(y-2,0,vres)][x] - getPixel(rawImage, x, y-2)
-            d_south = greenInterp[demConstrain(y+2,0,vres)][x] - getPixel(rawImage, x, y+2)
-            d_center = greenInterp[y][x]                       - getPixel(rawImage, x, y)
+            d_east  = greenInterp.pixel(x+2, y) - getPixel(rawImage, x+2, y)
+            d_west  = greenInterp.pixel(x-2, y) - getPixel(rawImage, x-2, y)
+            d_north = greenInterp.pixel(x, y-2) - getPixel(rawImage, x, y-2)
+            d_south = greenInterp.pixel(x, y+2) - getPixel(rawImage, x, y+2)
+            d_center = greenInterp.pixel(x, y)  - getPixel(rawImage, x, y)
             
             w_east  = 65536 // (abs(d_center - d_east) or 1)
             w_west  = 65536 // (abs(d_center - d_west) or 1)
@@ -319,18 +257,16 @@ for y in range(vres):
             new_estimate = getPixel(rawImage, x, y) + int(estimated_delta)
 
             #if new_estimate > 65535 or new_estimate < 0:
-            #    print("<%4d,%4d> [%d/%f,%d/%f,%d/%f,%d/%f]: %f, %f, %d, %d, %d" % (x, y, d_west, w_ew, d_north, w_ns, d_east, w_ew, d_south, w_ns, delta_g_colour, estimated_delta, getPixel(rawImage, x, y), greenInterp[y][x], new_estimate))
+            #    print("<%4d,%4d> [%d/%f,%d/%f,%d/%f,%d/%f]: %f, %f, %d, %d, %d" % (x, y, d_west, w_ew, d_north, w_ns, d_east, w_ew, d_south, w_ns, delta_g_colour, estimated_delta, getPixel(rawImage, x, y), greenInterp.pixel(x, y), new_estimate))
             new_estimate = constrain(new_estimate, 0, 65535)
 
-            enhancedGreen[y][x] = int(new_estimate)
+            enhancedGreen.setPixel(x, y, int(new_estimate))
         else:
-            enhancedGreen[y][x] = greenInterp[y][x]
+            enhancedGreen.setPixel(x, y, greenInterp.pixel(x, y))
 
 print(' - writing')
 enhancedGreen_out   = open(outputBase+'004_enhanced_green.data', 'wb')
-for y in range(vres):
-    for x in range(hres):
-        enhancedGreen_out.write(struct.pack("<H", enhancedGreen[y][x]))
+enhancedGreen_out.write(enhancedGreen.image.astype('<u2').tobytes())
 enhancedGreen_out.close()
 
 
@@ -338,25 +274,23 @@ enhancedGreen_out.close()
 print('005 - RGB interpolation stage 1')
 
 
-rgbInterp_partial = {}
-for y in range(vres):
-    rgbInterp_partial[y] = {}
+rgbInterp_partial = rawImage.plane(numpy.uint16)
 
 for y in range(vres):
     for x in range(hres):
         if ((x & 1) ^ (y & 1)): # not a green sample
-            d_northeast = greenInterp[demConstrain(y-1,0,vres)][demConstrain(x+1,0,hres)] - getPixel(rawImage, x+1, y-1)
-            d_northwest = greenInterp[demConstrain(y-1,0,vres)][demConstrain(x-1,0,hres)] - getPixel(rawImage, x-1, y-1)
-            d_southeast = greenInterp[demConstrain(y+1,0,vres)][demConstrain(x+1,0,hres)] - getPixel(rawImage, x+1, y+1)
-            d_southwest = greenInterp[demConstrain(y+1,0,vres)][demConstrain(x-1,0,hres)] - getPixel(rawImage, x-1, y+1)
-
-            delta_nw_se = 65536 / ((abs(greenInterp[demConstrain(y-2,0,vres)][demConstrain(x-2,0,hres)] - greenInterp[demConstrain(y-0,0,vres)][demConstrain(x-0,0,hres)]) +
-                                    abs(greenInterp[demConstrain(y-1,0,vres)][demConstrain(x-1,0,hres)] - greenInterp[demConstrain(y+1,0,vres)][demConstrain(x+1,0,hres)]) + 
-                                    abs(greenInterp[demConstrain(y+0,0,vres)][demConstrain(x+0,0,hres)] - greenInterp[demConstrain(y+2,0,vres)][demConstrain(x+2,0,hres)])) or 65535)
+            d_northeast = greenInterp.pixel(x+1, y-1) - getPixel(rawImage, x+1, y-1)
+            d_northwest = greenInterp.pixel(x-1, y-1) - getPixel(rawImage, x-1, y-1)
+            d_southeast = greenInterp.pixel(x+1, y+1) - getPixel(rawImage, x+1, y+1)
+            d_southwest = greenInterp.pixel(x-1, y+1) - getPixel(rawImage, x-1, y+1)
+
+            delta_nw_se = 65536 / ((abs(greenInterp.pixel(x-2, y-2) - greenInterp.pixel(x, y)) +
+                                    abs(greenInterp.pixel(x-1, y-1) - greenInterp.pixel(x+1, y+1)) + 
+                                    abs(greenInterp.pixel(x, y) - greenInterp.pixel(x+2, y+2))) or 65535)
             
-            delta_ne_sw = 65536 / ((abs(greenInterp[demConstrain(y-2,0,vres)][demConstrain(x+2,0,hres)] - greenInterp[demConstrain(y-0,0,vres)][demConstrain(x+0,0,hres)]) +
-                                    abs(greenInterp[demConstrain(y-1,0,vres)][demConstrain(x+1,0,hres)] - greenInterp[demConstrain(y+1,0,vres)][demConstrain(x-1,0,hres)]) + 
-                                    abs(greenInterp[demConstrain(y+0,0,vres)][demConstrain(x-0,0,hres)] - greenInterp[demConstrain(y+2,0,vres)][demConstrain(x-2,0,hres)])) or 65535)
+            delta_ne_sw = 65536 / ((abs(greenInterp.pixel(x+2, y-2) - greenInterp.pixel(x, y)) +
+                                    abs(greenInterp.pixel(x+1, y-1) - greenInterp.pixel(x-1, y+1)) + 
+                                    abs(greenInterp.pixel(x, y) - greenInterp.pixel(x-2, y+2))) or 65535)
 
             delta_total = delta_nw_se + delta_ne_sw
             try:
@@ -364,29 +298,26 @@ for y in range(vres):
             except ZeroDivisionError:
                 print("Zero div: %d+%d = %d. |%d-%d|+|%d-%d|+|%d-%d|, |%d-%d|+|%d-%d|+|%d-%d|" %
                       (delta_nw_se,delta_ne_sw,delta_total,
-                       greenInterp[demConstrain(y-2,0,vres)][demConstrain(x-2,0,hres)], greenInterp[demConstrain(y-0,0,vres)][demConstrain(x-0,0,hres)],
-                       greenInterp[demConstrain(y-1,0,vres)][demConstrain(x-1,0,hres)], greenInterp[demConstrain(y+1,0,vres)][demConstrain(x+1,0,hres)],
-                       greenInterp[demConstrain(y+0,0,vres)][demConstrain(x+0,0,hres)], greenInterp[demConstrain(y+2,0,vres)][demConstrain(x+2,0,hres)],
+                       greenInterp.pixel(x-2, y-2), greenInterp.pixel(x, y),
+                       greenInterp.pixel(x-1, y-1), greenInterp.pixel(x+1, y+1),
+                       greenInterp.pixel(x, y), greenInterp.pixel(x+2, y+2),
             
-                       greenInterp[demConstrain(y-2,0,vres)][demConstrain(x+2,0,hres)], greenInterp[demConstrain(y-0,0,vres)][demConstrain(x+0,0,hres)],
-                       greenInterp[demConstrain(y-1,0,vres)][demConstrain(x+1,0,hres)], greenInterp[demConstrain(y+1,0,vres)][demConstrain(x-1,0,hres)],
-                       greenInterp[demConstrain(y+0,0,vres)][demConstrain(x-0,0,hres)], greenInterp[demConstrain(y+2,0,vres)][demConstrain(x-2,0,hres)]
+                       greenInterp.pixel(x+2, y-2), greenInterp.pixel(x, y),
+                       greenInterp.pixel(x+1, y-1), greenInterp.pixel(x-1, y+1),
+                       greenInterp.pixel(x, y), greenInterp.pixel(x-2, y+2)
                       ))
                 delta_g_colour = 0
-            rgbInterp_partial[y][x] = constrain(int(greenInterp[y][x] - delta_g_colour), 0, 65535)
+            rgbInterp_partial.setPixel(x, y, constrain(int(greenInterp.pixel(x, y) - delta_g_colour), 0, 65535))
 
             if (x > 500 and x < 510 and y > 200 and y < 210):
-                print("<%d,%d> %f(%d,%d), %f(%d,%d) / %f  = %d-%f  = %d" % (x,y, delta_nw_se,d_northwest,d_southeast, delta_ne_sw,d_northeast,d_southwest, delta_total, greenInterp[y][x],delta_g_colour, rgbInterp_partial[y][x]))
+                print("<%d,%d> %f(%d,%d), %f(%d,%d) / %f  = %d-%f  = %d" % (x,y, delta_nw_se,d_northwest,d_southeast, delta_ne_sw,d_northeast,d_southwest, delta_total, greenInterp.pixel(x, y),delta_g_colour, rgbInterp_partial.pixel(x, y)))
 
-        else:
-            rgbInterp_partial[y][x] = 0
+        # green samples are left at 0
 
 rgbInterp_out = open(outputBase+'005_rgb_partial_out.data', 'wb')
 
 print(' - writing')
-for y in range(vres):
-    for x in range(hres):
-        rgbInterp_out.write(struct.pack("<H", rgbInterp_partial[y][x]))
+rgbInterp_out.write(rgbInterp_partial.image.astype('<u2').tobytes())
 
 rgbInterp_out.close()
 
@@ -394,43 +325,38 @@ rgbInterp_out.close()
 #------------------------------------------------------------------------------------------
 print('006 - RGB interpolation stage 2 - complete')
 
-rgbInterp = {}
-for y in range(vres):
-    rgbInterp[y] = {}
+rgbInterp = rawImage.plane(numpy.uint16, channels=3, halo=0)
 
 for y in range(vres):
     for x in range(hres):
-        d_east   = greenInterp[demConstrain(y  ,0,vres)][demConstrain(x+1,0,hres)] - getPixel(rawImage,x+1,y  )
-        d_west   = greenInterp[demConstrain(y  ,0,vres)][demConstrain(x-1,0,hres)] - getPixel(rawImage,x-1,y  )
-        d_north  = greenInterp[demConstrain(y-1,0,vres)][demConstrain(x  ,0,hres)] - getPixel(rawImage,x  ,y-1)
-        d_south  = greenInterp[demConstrain(y+1,0,vres)][demConstrain(x  ,0,hres)] - getPixel(rawImage,x  ,y+1)
+        d_east   = greenInterp.pixel(x+1, y) - getPixel(rawImage,x+1,y  )
+        d_west   = greenInterp.pixel(x-1, y) - getPixel(rawImage,x-1,y  )
+        d_north  = greenInterp.pixel(x, y-1) - getPixel(rawImage,x  ,y-1)
+        d_south  = greenInterp.pixel(x, y+1) - getPixel(rawImage,x  ,y+1)
         
-        green = greenInterp[y][x]
+        green = greenInterp.pixel(x, y)
         pos = (x & 1) | ((y & 1)<<1)
         if pos == 0:
             red   = constrain(green - (d_east  + d_west)  // 2, 0, 65535)
             blue  = constrain(green - (d_north + d_south) // 2, 0, 65535)
         elif pos == 1:
             red   = getPixel(rawImage,x,y)
-            blue  = rgbInterp_partial[y][x]
+            blue  = rgbInterp_partial.pixel(x, y)
         elif pos == 2:
-            red   = rgbInterp_partial[y][x]
+            red   = rgbInterp_partial.pixel(x, y)
             blue  = getPixel(rawImage,x,y)
         else:
             red   = constrain(green - (d_north + d_south) // 2, 0, 65535)
             blue  = constrain(green - (d_east  + d_west)  // 2, 0, 65535)
         
-        rgbInterp[y][x] = [red, green, blue]
+        rgbInterp.image[y, x] = (red, green, blue)
 
 
         
 rgbInterp_out = open(outputBase+'006_rgb_out.data', 'wb')
 
 print(' - writing')
-for y in range(vres):
-    for x in range(hres):
-        pix = rgbInterp[y][x]
-        rgbInterp_out.write(struct.pack("<BBB", pix[0]>>8 & 0xFF, pix[1]>>8 & 0xFF, pix[2]>>8 & 0xFF))
+rgbInterp_out.write((rgbInterp.image >> 8).astype(numpy.uint8).tobytes())
 
 rgbInterp_out.close()
 
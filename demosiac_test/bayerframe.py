@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# coding=UTF-8
+
+# A Bayer (G R / B G) frame for the demosaic tests, held in one contiguous
+# numpy array with a halo of padding around the image.
+#
+# The halo is filled the same way as demConstrain() in the test scripts:
+# a coordinate outside the image is folded back inside by steps of two, so
+# it lands on a pixel of the same CFA colour. With the halo in place, a
+# neighbour up to halo pixels away is read straight from the array, without
+# any bounds checks, and every stage of a demosaic can be computed on the
+# whole frame at once from shifted views of it.
+#
+#   frame = bayerframe.fromCFA(dng.cfa(leftJustify=True))
+#   frame.pixel(-1, 0)              # the same as getPixel(rawImage, -1, 0)
+#   green = frame.plane(numpy.int32)
+#   green.image[...] = (frame(-1, 0) + frame(1, 0)) >> 1
+#   green.fillHalo()
+
+import numpy
+
+## The offsets (x, y) of each CFA colour within its 2x2 cell (G R / B G).
+## Gr is the green pixel on the rows of red pixels, Gb the one on the rows
+## of blue pixels.
+PHASES = {'Gr': (0, 0), 'R': (1, 0), 'B': (0, 1), 'Gb': (1, 1)}
+
+## Fold a coordinate outside 0..size-1 back inside by steps of two, so it
+## lands on the same CFA colour (as demConstrain in loials_demosiac.py)
+def demConstrain(val, size):
+    while val < 0:
+        val += 2
+    while val >= size:
+        val -= 2
+    return val
+
+class bayerFrame(object):
+    """
+    A width x length image padded by halo pixels on every side. padded is
+    the whole (contiguous) array and image the view of the image within it.
+    Companion planes of the same geometry, for the intermediate results of
+    a demosaic, are made with plane(). Planes of several channels (an RGB
+    image, for example) have the channels as their last axis.
+    """
+    def __init__(self, width, length, halo=2, dtype=numpy.uint16, channels=None):
+        if halo and (width < 2 or length < 2):
+            raise ValueError("a %dx%d image is too small to pad" % (width, length))
+        self.width = width
+        self.length = length
+        self.halo = halo
+        self.channels = channels
+        shape = (length + 2 * halo, width + 2 * halo) + ((channels,) if channels else ())
+        self.padded = numpy.zeros(shape, dtype=dtype)
+        self.image = self.padded[halo:halo + length, halo:halo + width]
+
+        # the rows and columns of the halo, and those of the image that each
+        # one repeats
+        self.haloRows = [y for y in range(halo)] + [halo + length + y for y in range(halo)]
+        self.sourceRows = [halo + demConstrain(y - halo, length) for y in self.haloRows]
+        self.haloCols = [x for x in range(halo)] + [halo + width + x for x in range(halo)]
+        self.sourceCols = [halo + demConstrain(x - halo, width) for x in self.haloCols]
+
+    def __repr__(self):
+        return "<bayerFrame %dx%d%s, halo %d, %s>" % (self.width, self.length,
+            "x%d" % self.channels if self.channels else "", self.halo, self.padded.dtype)
+
+    @property
+    def dtype(self):
+        return self.padded.dtype
+
+    @property
+    def nbytes(self):
+        return self.padded.nbytes
+
+    def fillHalo(self):
+        """
+        Fill the halo from the image, after the image has been written.
+        """
+        if not self.halo:
+            return
+        # rows first, then the columns of every row, so the corners of the
+        # halo are folded in both directions
+        self.padded[self.haloRows] = self.padded[self.sourceRows]
+        self.padded[:, self.haloCols] = self.padded[:, self.sourceCols]
+
+    def plane(self, dtype=numpy.uint16, channels=None, halo=None):
+        """
+        A new, zeroed plane with the same size as this frame, for the
+        results of a stage of a demosaic. It has the same halo unless
+        another is given.
+        """
+        return bayerFrame(self.width, self.length, self.halo if halo is None else halo, dtype, channels)
+
+    def astype(self, dtype):
+        """
+        A copy of this frame, halo included, with samples of another type.
+        """
+        frame = self.plane(dtype, self.channels)
+        frame.padded[...] = self.padded
+        return frame
+
+    def __call__(self, dx, dy):
+        """
+        A view of the frame shifted by (dx, dy), the size of the image, so
+        that frame(dx, dy)[y, x] is the pixel at (x + dx, y + dy). dx and dy
+        must be within the halo.
+        """
+        top = self.halo + dy
+        left = self.halo + dx
+        return self.padded[top:top + self.length, left:left + self.width]
+
+    def pixel(self, x, y):
+        """
+        The pixel at (x, y) as a Python number, for code that works a pixel
+        at a time. x and y may be up to halo pixels outside the image.
+        """
+        return self.padded.item(y + self.halo, x + self.halo)
+
+    def setPixel(self, x, y, value):
+        self.padded[y + self.halo, x + self.halo] = value
+
+    def pixels(self, x, y):
+        """
+        All channels of the pixel at (x, y) as a list of Python numbers.
+        """
+        return self.padded[y + self.halo, x + self.halo].tolist()
+
+    def phase(self, name):
+        """
+        A (writable) view of the pixels of one CFA colour (R, Gr, Gb or B)
+        of the image, every other pixel of every other row.
+        """
+        x, y = PHASES[name]
+        return self.image[y::2, x::2]
+
+    def mask(self, *names):
+        """
+        A boolean mask of the pixels of the image with one or more of the
+        CFA colours, as in mask('Gr', 'Gb') for all the green ones.
+        """
+        return phaseMask(self.width, self.length, *names)
+
+## A boolean (length, width) mask of the pixels with the given CFA colours
+def phaseMask(width, length, *names):
+    mask = numpy.zeros((length, width), dtype=bool)
+    for name in names:
+        x, y = PHASES[name]
+        mask[y::2, x::2] = True
+    return mask
+
+## A frame holding a copy of a (length, width) CFA image, with the halo filled
+def fromCFA(cfa, halo=2, dtype=numpy.uint16):
+    cfa = numpy.asarray(cfa)
+    length, width = cfa.shape
+    frame = bayerFrame(width, length, halo, dtype)
+    frame.image[...] = cfa
+    frame.fillHalo()
+    return frame
+
+## A frame holding a copy of the width x length window of a CFA image with
+## its top left corner at (left, top). Any part of the window outside the
+## image is folded back inside like demConstrain, and the halo is folded
+## within the window.
+def fromWindow(cfa, left, top, width, length, halo=2, dtype=numpy.uint16):
+    cfa = numpy.asarray(cfa)
+    rows = [demConstrain(y, cfa.shape[0]) for y in range(top, top + length)]
+    cols = [demConstrain(x, cfa.shape[1]) for x in range(left, left + width)]
+    return fromCFA(cfa[numpy.ix_(rows, cols)], halo, dtype)
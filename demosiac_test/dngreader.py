@@ -0,0 +1,272 @@
+#!/usr/bin/python
+# coding=UTF-8
+
+# Shared reader for the DNG files the demosaic tests load. The file is
+# memory mapped and its IFD tree parsed once, and the raw CFA image is
+# returned as a numpy array that, for uncompressed 16-bit strips, is a view
+# straight into the map.
+
+import os
+import mmap
+import struct
+
+import numpy
+
+## TIFF tags used to find and decode the raw image
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SUB_IFDS = 330
+CFA_PATTERN = 33422
+BLACK_LEVEL = 50714
+WHITE_LEVEL = 50717
+
+## Photometric interpretations of raw images
+PHOTOMETRIC_CFA = 32803
+PHOTOMETRIC_LINEAR_RAW = 34892
+
+## struct format and size of one value of each TIFF type
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('B', 1),
+    8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8), 13: ('I', 4),
+}
+
+class tiffIFD(object):
+    """
+    One image file directory: its tags (as tuples of values, or a string
+    for ASCII tags) and the SubIFDs it points to.
+    """
+    def __init__(self, offset, tags, subIFDs):
+        self.offset = offset
+        self.tags = tags
+        self.subIFDs = subIFDs
+
+    def get(self, tag, default=None):
+        """The first value of a tag, or default if the IFD does not have it."""
+        values = self.tags.get(tag)
+        if values is None:
+            return default
+        return values[0]
+
+    def walk(self):
+        """This IFD followed by all of the SubIFDs below it, depth first."""
+        yield self
+        for ifd in self.subIFDs:
+            for child in ifd.walk():
+                yield child
+
+    def isRaw(self):
+        return (self.get(NEW_SUBFILE_TYPE, 0) == 0 and
+                self.get(PHOTOMETRIC_INTERPRETATION) in (PHOTOMETRIC_CFA, PHOTOMETRIC_LINEAR_RAW))
+
+## Parse the chain of IFDs starting at offset, along with their SubIFDs,
+## returning the list of top-level IFDs
+def parseIFDs(data, byteOrder, offset):
+    ifds = []
+    seen = set()
+    while offset and offset not in seen and offset + 2 <= len(data):
+        seen.add(offset)
+        ifd = parseIFD(data, byteOrder, offset)
+        ifds.append(ifd)
+        count = struct.unpack_from(byteOrder + "H", data, offset)[0]
+        offset = struct.unpack_from(byteOrder + "I", data, offset + 2 + count * 12)[0]
+    return ifds
+
+def parseIFD(data, byteOrder, offset):
+    tags = {}
+    count = struct.unpack_from(byteOrder + "H", data, offset)[0]
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tagID, tagType, valueCount = struct.unpack_from(byteOrder + "HHI", data, entry)
+        if tagType not in TIFF_TYPES:
+            continue
+        fmt, size = TIFF_TYPES[tagType]
+        valueOffset = entry + 8
+        if size * valueCount > 4:
+            valueOffset = struct.unpack_from(byteOrder + "I", data, entry + 8)[0]
+        if tagType == 2:
+            tags[tagID] = struct.unpack_from("%ds" % valueCount, data, valueOffset)[0].rstrip(b"\0").decode('latin-1')
+        else:
+            values = struct.unpack_from(byteOrder + fmt * valueCount, data, valueOffset)
+            if len(fmt) == 2:
+                values = tuple(zip(values[0::2], values[1::2])) # rationals as (numerator, denominator)
+            tags[tagID] = values
+
+    subIFDs = []
+    for subOffset in tags.get(SUB_IFDS, ()):
+        subIFDs.extend(parseIFDs(data, byteOrder, subOffset))
+    return tiffIFD(offset, tags, subIFDs)
+
+## Parsed IFD trees by (filename, size, modification time), so a file that
+## is opened again is not parsed again
+indexCache = {}
+
+## Unpack rows of MSB-first packed 12-bit samples (each row starting on a
+## byte boundary) into a (rows, width) array
+def unpack12(data, rows, width):
+    rowBytes = (width * 12 + 7) // 8
+    packed = numpy.frombuffer(data, dtype=numpy.uint8, count=rows * rowBytes).reshape(rows, rowBytes)
+    pairs = (width + 1) // 2
+    if rowBytes < pairs * 3:
+        packed = numpy.pad(packed, ((0, 0), (0, pairs * 3 - rowBytes)), mode='constant')
+    groups = packed[:, :pairs * 3].reshape(rows, pairs, 3).astype(numpy.uint16)
+    samples = numpy.empty((rows, pairs, 2), dtype=numpy.uint16)
+    samples[:, :, 0] = (groups[:, :, 0] << 4) | (groups[:, :, 1] >> 4)
+    samples[:, :, 1] = ((groups[:, :, 1] & 0x0f) << 8) | groups[:, :, 2]
+    return samples.reshape(rows, pairs * 2)[:, :width]
+
+class dngReader(object):
+    """
+    Random access to the raw CFA images of a DNG file (or of each frame of a
+    multi-frame DNG written by pyraw2dng --clip). The file is memory mapped
+    and its IFD tree parsed once. Uncompressed 16-bit images stored in
+    contiguous strips are returned as read-only views into the map, without
+    copying; multiple scattered strips, tiles and 12-bit samples are
+    assembled into a new array.
+    """
+    def __init__(self, filename, rawIFDs=None):
+        """
+        rawIFDs, when the raw IFD of each frame is already known (from an
+        index of the file), skips parsing the file.
+        """
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = self.map[:4]
+        if header == b"II*\0":
+            self.byteOrder = "<"
+        elif header == b"MM\0*":
+            self.byteOrder = ">"
+        else:
+            raise ValueError("%s is not a TIFF or DNG file" % filename)
+
+        if rawIFDs is not None:
+            self.ifds = self.rawIFDs = list(rawIFDs)
+        else:
+            stat = os.stat(filename)
+            key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+            if key not in indexCache:
+                firstIFD = struct.unpack_from(self.byteOrder + "I", self.map, 4)[0]
+                indexCache[key] = parseIFDs(self.map, self.byteOrder, firstIFD)
+            self.ifds = indexCache[key]
+
+            # The raw image of each frame, wherever it is in the frame's tree
+            # (in a SubIFD when the frame has a preview).
+            self.rawIFDs = []
+            for ifd in self.ifds:
+                for child in ifd.walk():
+                    if child.isRaw():
+                        self.rawIFDs.append(child)
+                        break
+        if not self.rawIFDs:
+            raise ValueError("no raw image found in %s" % filename)
+
+        raw = self.rawIFDs[0]
+        self.width = raw.get(IMAGE_WIDTH)
+        self.length = raw.get(IMAGE_LENGTH)
+        self.bitsPerSample = raw.get(BITS_PER_SAMPLE, 1)
+        self.cfaPattern = raw.tags.get(CFA_PATTERN)
+        self.whiteLevel = raw.get(WHITE_LEVEL, (1 << self.bitsPerSample) - 1)
+        self.blackLevel = raw.get(BLACK_LEVEL, 0)
+
+    def __len__(self):
+        return len(self.rawIFDs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # The map itself stays open for as long as arrays returned by cfa()
+        # are using it.
+        self.file.close()
+
+    def cfa(self, frame=0, leftJustify=False):
+        """
+        The raw image of a frame as a (length, width) array of samples. With
+        leftJustify, samples of fewer than 16 bits are shifted up to 16 bits
+        (as pyraw2dng writes 16-bit DNGs), which needs a copy.
+        """
+        ifd = self.rawIFDs[frame]
+        width = ifd.get(IMAGE_WIDTH)
+        length = ifd.get(IMAGE_LENGTH)
+        bitsPerSample = ifd.get(BITS_PER_SAMPLE, 1)
+        compression = ifd.get(COMPRESSION, 1)
+        if compression != 1:
+            raise ValueError("compressed raw images (compression %d) are not supported" % compression)
+        if ifd.get(SAMPLES_PER_PIXEL, 1) != 1 or bitsPerSample not in (8, 12, 16):
+            raise ValueError("unsupported raw layout: %d samples per pixel of %d bits" %
+                             (ifd.get(SAMPLES_PER_PIXEL, 1), bitsPerSample))
+
+        if TILE_OFFSETS in ifd.tags:
+            image = self.tiles(ifd, width, length, bitsPerSample)
+        else:
+            image = self.strips(ifd, width, length, bitsPerSample)
+
+        if leftJustify and bitsPerSample < 16:
+            image = image.astype(numpy.uint16) << (16 - bitsPerSample)
+        return image
+
+    ## rows x width samples starting at offset in the map
+    def rows(self, offset, rows, width, bitsPerSample):
+        if bitsPerSample == 16:
+            return numpy.frombuffer(self.map, dtype=self.byteOrder + "u2", count=rows * width, offset=offset).reshape(rows, width)
+        if bitsPerSample == 8:
+            return numpy.frombuffer(self.map, dtype=numpy.uint8, count=rows * width, offset=offset).reshape(rows, width)
+        rowBytes = (width * 12 + 7) // 8
+        return unpack12(self.map[offset:offset + rows * rowBytes], rows, width)
+
+    def strips(self, ifd, width, length, bitsPerSample):
+        offsets = ifd.tags[STRIP_OFFSETS]
+        counts = ifd.tags.get(STRIP_BYTE_COUNTS)
+        rowsPerStrip = min(ifd.get(ROWS_PER_STRIP, length), length)
+
+        contiguous = counts is not None and all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1))
+        if len(offsets) == 1 or contiguous:
+            return self.rows(offsets[0], length, width, bitsPerSample)
+
+        image = numpy.empty((length, width), dtype=numpy.uint8 if bitsPerSample == 8 else numpy.uint16)
+        for strip, offset in enumerate(offsets):
+            top = strip * rowsPerStrip
+            rows = min(rowsPerStrip, length - top)
+            if rows <= 0:
+                break
+            image[top:top + rows] = self.rows(offset, rows, width, bitsPerSample)
+        return image
+
+    def tiles(self, ifd, width, length, bitsPerSample):
+        tileWidth = ifd.get(TILE_WIDTH)
+        tileLength = ifd.get(TILE_LENGTH)
+        offsets = ifd.tags[TILE_OFFSETS]
+        across = (width + tileWidth - 1) // tileWidth
+
+        image = numpy.empty((length, width), dtype=numpy.uint8 if bitsPerSample == 8 else numpy.uint16)
+        for tile, offset in enumerate(offsets):
+            top = (tile // across) * tileLength
+            left = (tile % across) * tileWidth
+            if top >= length:
+                break
+            data = self.rows(offset, tileLength, tileWidth, bitsPerSample)
+            image[top:top + tileLength, left:left + tileWidth] = data[:length - top, :width - left]
+        return image
+
+## The raw CFA image of a DNG file, as for dngReader.cfa
+def readCFA(filename, frame=0, leftJustify=False):
+    reader = dngReader(filename)
+    image = reader.cfa(frame, leftJustify)
+    reader.close()
+    return image
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# coding=UTF-8
+
+# Random access to a directory of DNG frames (the frame_%06d.DNG files, or
+# multi-frame clip files, written by pyraw2dng), for tools that scrub back
+# and forth through a video. The directory is indexed once and the index
+# kept in a sidecar file, decoded frames are held in a cache of bounded
+# size, and the frames ahead of the one asked for, in the direction the
+# video is being scrubbed, are read in the background.
+
+import os
+import re
+import json
+import struct
+import fnmatch
+import hashlib
+import threading
+import collections
+
+import dngreader
+
+## Name of the index file written into each directory
+INDEX_FILENAME = "dngindex.json"
+INDEX_VERSION = 1
+
+## The tags kept in the index: enough to find and decode the raw image
+## without parsing the file again
+LAYOUT_TAGS = (
+    dngreader.NEW_SUBFILE_TYPE, dngreader.IMAGE_WIDTH, dngreader.IMAGE_LENGTH, dngreader.BITS_PER_SAMPLE,
+    dngreader.COMPRESSION, dngreader.PHOTOMETRIC_INTERPRETATION, dngreader.STRIP_OFFSETS,
+    dngreader.SAMPLES_PER_PIXEL, dngreader.ROWS_PER_STRIP, dngreader.STRIP_BYTE_COUNTS,
+    dngreader.TILE_WIDTH, dngreader.TILE_LENGTH, dngreader.TILE_OFFSETS, dngreader.TILE_BYTE_COUNTS,
+    dngreader.CFA_PATTERN, dngreader.BLACK_LEVEL, dngreader.WHITE_LEVEL,
+)
+
+## Footer of the frame index pyraw2dng appends to clip files
+CLIP_INDEX_MAGIC = b"PYR2DIDX"
+CLIP_FOOTER = "<8sII" # magic, frame count, index offset
+CLIP_INDEX_ENTRY = "<III" # frame number, IFD offset, strip offset
+
+## The frame number in a filename: its last run of digits
+FRAME_NUMBER = re.compile(r"(\d+)\D*$")
+
+## Digest of an image's tags other than the offsets of its data, which
+## tells frames of a different size, format or metadata apart without
+## opening them
+def tagDigest(ifd):
+    tags = dict((str(tag), values) for tag, values in ifd.tags.items()
+                if tag not in (dngreader.STRIP_OFFSETS, dngreader.TILE_OFFSETS, dngreader.SUB_IFDS))
+    return hashlib.sha1(json.dumps(tags, sort_keys=True).encode('utf-8')).hexdigest()
+
+## Tag values read back from JSON, where tuples became lists
+def fromJSON(value):
+    if isinstance(value, list):
+        return tuple(fromJSON(v) for v in value)
+    return value
+
+## The frame numbers of the frames of a clip file, from the index at its
+## end, or None if it does not have one
+def clipFrameNumbers(reader):
+    footerSize = struct.calcsize(CLIP_FOOTER)
+    if len(reader.map) < 8 + footerSize:
+        return None
+    magic, count, indexOffset = struct.unpack_from(CLIP_FOOTER, reader.map, len(reader.map) - footerSize)
+    if magic != CLIP_INDEX_MAGIC or count != len(reader.rawIFDs):
+        return None
+    entrySize = struct.calcsize(CLIP_INDEX_ENTRY)
+    return [struct.unpack_from(CLIP_INDEX_ENTRY, reader.map, indexOffset + i*entrySize)[0] for i in range(count)]
+
+## Index entries of the frames in one DNG file
+def indexFile(path, firstFrame):
+    reader = dngreader.dngReader(path)
+    frameNums = clipFrameNumbers(reader) or [firstFrame + i for i in range(len(reader))]
+    frames = []
+    for position, ifd in enumerate(reader.rawIFDs):
+        frames.append({
+            'frame': frameNums[position],
+            'position': position,
+            'tags': dict((str(tag), ifd.tags[tag]) for tag in LAYOUT_TAGS if tag in ifd.tags),
+            'digest': tagDigest(ifd),
+        })
+    reader.close()
+    return frames
+
+## Write the index to its sidecar file, replacing the old one only once the
+## new one is complete
+def saveIndex(filename, files):
+    tempFilename = filename + ".tmp"
+    sidecar = open(tempFilename, "w")
+    json.dump({'version': INDEX_VERSION, 'files': files}, sidecar, sort_keys=True)
+    sidecar.close()
+    if hasattr(os, 'replace'):
+        os.replace(tempFilename, filename)
+    else:
+        # Windows will not rename over an existing file
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tempFilename, filename)
+
+## The index of every DNG file in a directory, as a dict of filename to the
+## file's size, modification time and frames. The index in the directory's
+## sidecar file is used for every file that has not changed since, and the
+## sidecar is brought up to date if any had.
+def loadIndex(directory):
+    indexFilename = os.path.join(directory, INDEX_FILENAME)
+    try:
+        with open(indexFilename, "r") as sidecar:
+            saved = json.load(sidecar)
+        if saved.get('version') != INDEX_VERSION:
+            saved = {}
+    except (EnvironmentError, ValueError):
+        saved = {}
+    savedFiles = saved.get('files', {})
+
+    files = {}
+    changed = False
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(".dng"):
+            continue
+        match = FRAME_NUMBER.search(name)
+        if not match:
+            continue
+        stat = os.stat(os.path.join(directory, name))
+        entry = savedFiles.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            try:
+                frames = indexFile(os.path.join(directory, name), int(match.group(1)))
+            except (ValueError, struct.error):
+                continue # not a DNG with a raw image
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'frames': frames}
+            changed = True
+        files[name] = entry
+
+    if changed or set(files) != set(savedFiles):
+        try:
+            saveIndex(indexFilename, files)
+        except EnvironmentError:
+            pass # a read-only directory is indexed again next time
+    return files
+
+class dngSequence(object):
+    """
+    Random access, by frame number, to the frames of a directory of DNG
+    files (optionally only those whose names match pattern). Frames are
+    returned as read-only (length, width) arrays of samples, as for
+    dngreader.dngReader.cfa.
+
+    Decoded frames are kept in a least recently used cache of up to
+    cacheBytes, and after each frame is read the next readAhead frames in
+    the direction the sequence is being stepped through are read into the
+    cache by a background thread, so scrubbing forwards or backwards finds
+    them ready. Call close() to stop the thread.
+    """
+    def __init__(self, directory, pattern="*", cacheBytes=256*1024*1024, readAhead=4, leftJustify=False):
+        self.directory = directory
+        self.cacheBytes = cacheBytes
+        self.readAhead = readAhead
+        self.leftJustify = leftJustify
+
+        self.frames = {}
+        for name, entry in loadIndex(directory).items():
+            if not fnmatch.fnmatch(name, pattern):
+                continue
+            for frame in entry['frames']:
+                if frame['frame'] in self.frames:
+                    raise ValueError("frame %d is in both %s and %s" % (frame['frame'], self.frames[frame['frame']]['file'], name))
+                self.frames[frame['frame']] = dict(frame, file=name)
+        self.frameNumbers = sorted(self.frames)
+        self.positions = dict((frameNum, i) for i, frameNum in enumerate(self.frameNumbers))
+
+        self.cache = collections.OrderedDict()
+        self.cached = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Condition()
+        self.loading = set()
+        self.wanted = []
+        self.last = None
+        self.direction = 1
+        self.thread = None
+        self.closing = False
+
+    def __len__(self):
+        return len(self.frameNumbers)
+
+    def __contains__(self, frameNum):
+        return frameNum in self.frames
+
+    def __getitem__(self, frameNum):
+        return self.frame(frameNum)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def info(self, frameNum):
+        """
+        The index entry of a frame: the file it is in and its position in
+        that file, the tags giving its geometry and the offsets of its data,
+        and the digest of its tags.
+        """
+        return self.frames[frameNum]
+
+    def frame(self, frameNum):
+        """The raw image of a frame, from the cache if it is there."""
+        if frameNum not in self.frames:
+            raise KeyError("no frame %d in %s" % (frameNum, self.directory))
+
+        with self.lock:
+            if self.last is not None and frameNum != self.last:
+                self.direction = 1 if frameNum > self.last else -1
+            self.last = frameNum
+            image = self.lookup(frameNum)
+            if image is None:
+                self.misses += 1
+                self.loading.add(frameNum)
+            else:
+                self.hits += 1
+
+        if image is None:
+            try:
+                image = self.decode(frameNum)
+            finally:
+                with self.lock:
+                    self.loading.discard(frameNum)
+                    self.lock.notify_all()
+            with self.lock:
+                self.insert(frameNum, image)
+
+        if self.readAhead > 0:
+            self.prefetch(frameNum)
+        return image
+
+    ## The cached image of a frame, waiting for it if the background thread
+    ## is reading it, or None. Called with the lock held.
+    def lookup(self, frameNum):
+        while frameNum in self.loading:
+            self.lock.wait()
+        image = self.cache.pop(frameNum, None)
+        if image is not None:
+            self.cache[frameNum] = image # now the most recently used
+        return image
+
+    ## Add an image to the cache, dropping the least recently used images
+    ## beyond cacheBytes. Called with the lock held.
+    def insert(self, frameNum, image):
+        if frameNum in self.cache:
+            return
+        self.cache[frameNum] = image
+        self.cached += image.nbytes
+        while self.cached > self.cacheBytes and len(self.cache) > 1:
+            oldNum, old = self.cache.popitem(last=False)
+            self.cached -= old.nbytes
+
+    ## Read and decode a frame from its file
+    def decode(self, frameNum):
+        entry = self.frames[frameNum]
+        tags = dict((int(tag), fromJSON(values)) for tag, values in entry['tags'].items())
+        ifd = dngreader.tiffIFD(None, tags, [])
+        reader = dngreader.dngReader(os.path.join(self.directory, entry['file']), [ifd])
+        image = reader.cfa(0, self.leftJustify)
+        reader.close()
+        if not image.flags.writeable:
+            image = image.copy() # a view into the file, which the cache must not keep open
+        image.setflags(write=False)
+        return image
+
+    ## Ask the background thread for the frames after frameNum in the
+    ## direction of travel, replacing any it has not got to yet
+    def prefetch(self, frameNum):
+        entry = self.frames[frameNum]
+        frameBytes = entry['tags'][str(dngreader.IMAGE_WIDTH)][0] * entry['tags'][str(dngreader.IMAGE_LENGTH)][0] * 2
+        count = min(self.readAhead, max(0, self.cacheBytes // frameBytes - 1))
+
+        position = self.positions[frameNum]
+        wanted = []
+        for step in range(1, count + 1):
+            ahead = position + step * self.direction
+            if ahead < 0 or ahead >= len(self.frameNumbers):
+                break
+            wanted.append(self.frameNumbers[ahead])
+
+        with self.lock:
+            self.wanted = wanted
+            if self.thread is None and wanted:
+                self.thread = threading.Thread(target=self.readAheadLoop)
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify_all()
+
+    def readAheadLoop(self):
+        while True:
+            with self.lock:
+                while not self.wanted and not self.closing:
+                    self.lock.wait()
+                if self.closing:
+                    return
+                frameNum = self.wanted.pop(0)
+                if frameNum in self.cache or frameNum in self.loading:
+                    continue
+                self.loading.add(frameNum)
+
+            try:
+                image = self.decode(frameNum)
+            except (EnvironmentError, ValueError):
+                image = None # reported if the frame itself is asked for
+            with self.lock:
+                self.loading.discard(frameNum)
+                if image is not None:
+                    self.insert(frameNum, image)
+                self.lock.notify_all()
+
+    def close(self):
+        """Stop reading ahead and empty the cache."""
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.cache.clear()
+        self.cached = 0
@@ -17,80 +17,37 @@ import getopt
 import platform
 import errno
 
+import bayerframe
+import dngreader
+
 def constrain(val, min_val, max_val):
     if min_val > max_val:
         min_val, max_val = max_val, min_val
     return min(max_val, max(min_val, val))
-def demConstrain(val, min_val, max_val):
-    while val < min_val:
-        val += 2
-    while val >= max_val:
-        val -= 2
-    return val
 
 inputFilename = "S:\\KronTech\\Raw\\testScene_000002.dng"
 outputBase = "S:\\KronTech\\Raw\\test_loials_pipelined\\"
 
 # set up the image binary data
-rawFile = open(inputFilename, "rb")
-rawDNG = rawFile.read()
-
-# this will itterate through DNGs to find the raw image data
-def parseIFD(rawFile, ifdOffset):
-    foundIFDList = []
-    stripOffset = None
-    validImageFound = False
-    width = 0
-    height = 0
-    ifdLength = struct.unpack_from("<H", rawFile, ifdOffset)[0]
-    for i in range(ifdLength):
-        tagID, tagDataType, tagDataCount, tagValue = struct.unpack_from("<HHII", rawFile, ifdOffset+2+(i*12))
-        if tagID == 254 and tagValue == 0:
-            validImageFound = True
-            
-        if tagID == 273:
-            stripOffset = tagValue
-
-        if tagID == 330:
-            foundIFDList.append(tagValue)
-
-        if tagID == 256:
-            width = tagValue
-
-        if tagID == 257:
-            height = tagValue
-
-    nextIFD = struct.unpack_from("<I", rawFile, ifdOffset+2 + ifdLength*12)[0]
-
-    if nextIFD > 0:
-        foundIFDList.append(nextIFD)
-
-    if not validImageFound:
-        for ifd in foundIFDList:
-            stripOffset, width, height = parseIFD(rawFile, ifd)
-
-    return stripOffset, width, height
-        
-ifdOffset = struct.unpack_from("<I", rawDNG, 4)[0]
-stripOffset, hres, vres = parseIFD(rawDNG, ifdOffset)
-
-if not stripOffset:
-    print("Image data not found")
+try:
+    dng = dngreader.dngReader(inputFilename)
+    cfa = dng.cfa(leftJustify=True)
+except ValueError as e:
+    print("Image data not found: %s" % e)
     sys.exit(0)
+hres, vres = dng.width, dng.length
 
-print("Image data found at offset: 0x%08X %dx%d" % (stripOffset, hres, vres))
+print("Image data found: %dx%d, %d bits per sample" % (hres, vres, dng.bitsPerSample))
 
 
-real_rawImage = {}
-for y in range(vres):
-    real_rawImage[y] = array.array('H', rawDNG[stripOffset+(hres*y*2):stripOffset+(hres*(y+1)*2)])
+# the 200x200 window of the image fed through the pipeline
+real_rawImage = bayerframe.fromWindow(cfa, 430, 650, 200, 200)
             
 def getPixel(field, x, y):
-    value = field[demConstrain(y,0,vres)][demConstrain(x,0,hres)]
-    return value
+    return field.pixel(x, y)
 
 def setPixel(field, x, y, value):
-    field[demConstrain(y,0,vres)][demConstrain(x,0,hres)] = value
+    field.setPixel(x, y, value)
 
 class bucketBregade(object):
     def __init__(self, type, length, dimensions=(1280,1024)):
@@ -256,11 +213,11 @@ for itteration in range(((200+12)*(200+7)) + 0): # vres
     rawImage_ypos = rawImage_offset // (200+12)
     if rawImage_ypos < 200:
         if rawImage_xpos < 2:
-            rawImage.next(getPixel(real_rawImage, rawImage_xpos+430, rawImage_ypos+650))
+            rawImage.next(getPixel(real_rawImage, rawImage_xpos, rawImage_ypos))
         elif rawImage_xpos < 8:
             rawImage.next(rawImage[-1,0])
         elif rawImage_xpos < 200+6:
-            rawImage.next(getPixel(real_rawImage, rawImage_xpos+430-6, rawImage_ypos+650))
+            rawImage.next(getPixel(real_rawImage, rawImage_xpos-6, rawImage_ypos))
         else:
             rawImage.next(rawImage[-1,0])
     else:
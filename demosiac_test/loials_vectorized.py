@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# coding=UTF-8
+
+# Whole-frame numpy implementation of the demosaic in loials_demosiac.py:
+# Low-complexity color demosaicing algorithm based on integrated gradients
+# Journal of Electronic Imaging 19(2), 021104 (Apr–Jun 2010)
+#
+# Every stage is computed for all pixels at once from shifted views of a
+# bayerframe.bayerFrame, instead of pixel by pixel through getPixel(). The
+# results are bit-exact with loials_demosiac.py, including at the borders,
+# where the halo of the frame repeats the same CFA colours as its
+# demConstrain() does.
+#
+# loials_vectorized.py <input.dng, clip or directory of DNGs> <output base>
+
+import os
+import sys
+import time
+
+import numpy
+
+import bayerframe
+import dngreader
+
+## 65535 // n, as div_lookup in loials_demosiac.py
+DIV_LOOKUP = numpy.array([65535 // (i or 1) for i in range(128)], dtype=numpy.int64)
+
+## Clip to 0..65535 (as constrain in loials_demosiac.py), faster than
+## numpy.clip
+def clip16(values):
+    values = numpy.maximum(values, 0)
+    return numpy.minimum(values, 65535, out=values)
+
+## Stage 2: the delta integrated gradients east-west, north-south and along
+## both diagonals (each 0..63), from the top 8 bits of the samples
+def integratedGradients(raw):
+    p = raw.astype(raw.dtype)
+    p.padded >>= 8
+
+    ew = 8 * (abs(p(-1, 0) - p(1, 0)) + abs(p(-2, 0) - p(0, 0)) + abs(p(2, 0) - p(0, 0)))
+    ns = 8 * (abs(p(0, -1) - p(0, 1)) + abs(p(0, -2) - p(0, 0)) + abs(p(0, 2) - p(0, 0)))
+    for d, weight in ((-2, 1), (-1, 2), (0, 2), (1, 2), (2, 1)):
+        ew += weight * abs(2 * (p(1, d) - p(-1, d)) - (p(2, d) - p(-2, d)))
+        ns += weight * abs(2 * (p(d, 1) - p(d, -1)) - (p(d, 2) - p(d, -2)))
+
+    nwse = numpy.zeros_like(ew)
+    nesw = numpy.zeros_like(ew)
+    for i in (-2, -1):
+        for j in (-2, -1):
+            nwse += abs(p(i, j) - p(i + 2, j + 2))
+            nesw += abs(p(-i, j) - p(-i - 2, j + 2))
+
+    return (numpy.clip(ew >> 7, 0, 63), numpy.clip(ns >> 7, 0, 63),
+            numpy.clip(nwse >> 3, 0, 63), numpy.clip(nesw >> 3, 0, 63))
+
+## Stage 3: green at every pixel, interpolated along the direction with the
+## smaller gradient (east-west where direction is set) at red and blue ones
+def estimateGreen(raw, direction, greenMask):
+    p = raw
+    enhanceEW = (2 * p.image - p(-2, 0) - p(2, 0)) // 3
+    enhanceNS = (2 * p.image - p(0, -2) - p(0, 2)) // 3
+    # >> 1 floors negative values like // 2, but is much faster
+    greenEW = clip16((p(-1, 0) + p(1, 0) + enhanceEW) >> 1)
+    greenNS = clip16((p(0, -1) + p(0, 1) + enhanceNS) >> 1)
+
+    green = raw.plane(raw.dtype)
+    green.image[...] = numpy.where(greenMask, p.image, numpy.where(direction, greenEW, greenNS))
+    green.fillHalo()
+    return green
+
+## Stage 4: the missing colour at red and blue pixels (blue at red ones and
+## red at blue ones) from the colour differences of the diagonal
+## neighbours, weighted by the inverse diagonal gradients; 0 at green pixels
+def interpolateDiagonal(raw, green, nwse, nesw, greenMask):
+    p = raw
+    g = green
+    inverseNWSE = 63 // numpy.maximum(nwse, 1)
+    inverseNESW = 63 // numpy.maximum(nesw, 1)
+
+    northeast = g(1, -1) - p(1, -1)
+    northwest = g(-1, -1) - p(-1, -1)
+    southeast = g(1, 1) - p(1, 1)
+    southwest = g(-1, 1) - p(-1, 1)
+
+    weighted = inverseNWSE.astype(numpy.int64) * (northwest + southeast) + inverseNESW * (northeast + southwest)
+    delta = (weighted * DIV_LOOKUP[inverseNWSE + inverseNESW]) >> (1 + 16)
+
+    partial = raw.plane(raw.dtype)
+    partial.image[...] = numpy.where(greenMask, 0, clip16(g.image - delta))
+    partial.fillHalo()
+    return partial
+
+## Stage 5: the complete RGB image, filling in red and blue at green pixels
+## from the colour differences of their neighbours along the direction with
+## the smaller gradient
+def interpolateRGB(raw, green, partial, direction):
+    p = raw
+    g = green
+    q = partial
+
+    # colour differences to the raw (d1) and interpolated (d2) neighbours
+    # (halved, flooring like // 2)
+    d1EW = ((g(1, 0) - p(1, 0)) + (g(-1, 0) - p(-1, 0))) >> 1
+    d1NS = ((g(0, -1) - p(0, -1)) + (g(0, 1) - p(0, 1))) >> 1
+    d2EW = ((g(1, 0) - q(1, 0)) + (g(-1, 0) - q(-1, 0))) >> 1
+    d2NS = ((g(0, -1) - q(0, -1)) + (g(0, 1) - q(0, 1))) >> 1
+
+    fromD1 = clip16(g.image - numpy.where(direction, d1EW, d1NS))
+    fromD2 = clip16(g.image - numpy.where(direction, d2EW, d2NS))
+    # on the rows of red pixels, east-west neighbours are red and north-south
+    # ones blue, and the other way around on the rows of blue pixels
+    red = raw.mask('R')
+    blue = raw.mask('B')
+    d1IsRed = numpy.where(raw.mask('Gr'), direction, ~direction)
+
+    rgb = numpy.empty((raw.length, raw.width, 3), dtype=numpy.uint16)
+    rgb[:, :, 0] = numpy.where(red, p.image, numpy.where(blue, q.image, numpy.where(d1IsRed, fromD1, fromD2)))
+    rgb[:, :, 1] = g.image
+    rgb[:, :, 2] = numpy.where(blue, p.image, numpy.where(red, q.image, numpy.where(d1IsRed, fromD2, fromD1)))
+    return rgb
+
+def demosaic(cfa, stages=None):
+    """
+    Demosaic a (length, width) CFA image of 16-bit samples (G R / B G),
+    returning a (length, width, 3) uint16 RGB image. If stages is a dict,
+    the intermediate images are stored in it, named after the stages of
+    loials_demosiac.py.
+    """
+    length, width = cfa.shape
+    if length < 2 or width < 2:
+        raise ValueError("a %dx%d image is too small to demosaic" % (width, length))
+
+    raw = bayerframe.fromCFA(cfa, halo=2, dtype=numpy.int32)
+    greenMask = raw.mask('Gr', 'Gb')
+
+    ew, ns, nwse, nesw = integratedGradients(raw)
+    direction = ew <= ns
+    green = estimateGreen(raw, direction, greenMask)
+    partial = interpolateDiagonal(raw, green, nwse, nesw, greenMask)
+    rgb = interpolateRGB(raw, green, partial, direction)
+
+    if stages is not None:
+        stages.update(dig_ew=ew, dig_ns=ns, dig_nwse=nwse, dig_nesw=nesw, dig_dir=direction,
+                      greenInterp=green.image, rgbInterp_partial=partial.image)
+    return rgb
+
+## Write the same files as loials_demosiac.py for one frame
+def writeStages(outputBase, cfa):
+    stages = {}
+    rgb = demosaic(cfa, stages)
+    for filename, image in (('001_image.data', cfa),
+                            ('002aa_DIG_delta_EW.data', stages['dig_ew']),
+                            ('002bb_DIG_delta_NS.data', stages['dig_ns']),
+                            ('002cc_DIG_NWSE.data', stages['dig_nwse']),
+                            ('002dd_DIG_NESW.data', stages['dig_nesw']),
+                            ('003_output.data', stages['greenInterp']),
+                            ('004_rgb_partial_out.data', stages['rgbInterp_partial'])):
+        with open(outputBase + filename, 'wb') as out:
+            out.write(numpy.asarray(image).astype('<u2').tobytes())
+    with open(outputBase + '005_rgb_out.data', 'wb') as out:
+        out.write((rgb >> 8).astype(numpy.uint8).tobytes())
+
+## The frames of a DNG file (or each frame of a clip file), or of a
+## directory of DNGs, as (name, cfa) pairs
+def inputFrames(inputFilename):
+    if os.path.isdir(inputFilename):
+        import dngsequence
+        sequence = dngsequence.dngSequence(inputFilename, leftJustify=True, readAhead=2)
+        try:
+            for frameNum in sequence.frameNumbers:
+                yield "%06d_" % frameNum, sequence[frameNum]
+        finally:
+            sequence.close()
+    else:
+        dng = dngreader.dngReader(inputFilename)
+        for frame in range(len(dng)):
+            yield ("%06d_" % frame if len(dng) > 1 else ""), dng.cfa(frame, leftJustify=True)
+        dng.close()
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: loials_vectorized.py <input.dng, clip or directory of DNGs> <output base>")
+        sys.exit(0)
+    inputFilename, outputBase = sys.argv[1:]
+
+    start = time.time()
+    frames = 0
+    for prefix, cfa in inputFrames(inputFilename):
+        if prefix:
+            # one RGB image per frame of a clip or sequence
+            with open(outputBase + prefix + '005_rgb_out.data', 'wb') as out:
+                out.write((demosaic(cfa) >> 8).astype(numpy.uint8).tobytes())
+        else:
+            writeStages(outputBase, cfa)
+        frames += 1
+    elapsed = time.time() - start
+    print("%d frames in %.2fs, %.3fs per frame" % (frames, elapsed, elapsed / max(frames, 1)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/python2.7
+
+# standard python imports
+import sys
+import os
+import getopt
+import shutil
+import tempfile
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+import pyraw2dng
+from bench_pyraw2dng import generateClip
+
+## A fixed creation time, so that conversions of the same video are
+## byte-for-byte identical
+CREATION_TIME = 1500000000
+
+
+class checkFailed(Exception):
+    pass
+
+def check(condition, message):
+    if not condition:
+        raise checkFailed(message)
+
+## The manifest settings main() would use for a conversion
+def manifestSettings(width, length, bpp, outputFilenameFormat, clipFrames=0):
+    return {'width': width, 'length': length, 'colour': True, 'bpp': bpp, 'bitsPerSample': 16,
+            'clipFrames': clipFrames, 'tileSize': 0, 'preview': False, 'output': outputFilenameFormat}
+
+## Convert a video with a manifest (resuming one left in place if resume is
+## set), returning the frames the manifest already listed as done
+def convertWithManifest(rawFilename, outputFilenameFormat, width, length, bpp, clipFrames=0, resume=False):
+    manifestFilename = os.path.join(os.path.dirname(outputFilenameFormat), "pyraw2dng.manifest")
+    pyraw2dng.makeOutputDir(outputFilenameFormat)
+    manifest = pyraw2dng.conversionManifest(manifestFilename, rawFilename,
+        manifestSettings(width, length, bpp, outputFilenameFormat, clipFrames), resume)
+    done = sorted(manifest.done)
+    try:
+        pyraw2dng.convertVideo(rawFilename, outputFilenameFormat, width, length, True, bpp, clipFrames=clipFrames,
+                               manifest=manifest, creationTime=CREATION_TIME)
+    finally:
+        manifest.close()
+    return done
+
+def readFiles(directory):
+    return dict((name, open(os.path.join(directory, name), "rb").read())
+                for name in os.listdir(directory) if name.lower().endswith('.dng'))
+
+## Overwrite one byte of a frame of a raw file, keeping its size
+def editFrame(rawFilename, frameNum, width, length, bpp):
+    rawFile = open(rawFilename, "r+b")
+    rawFile.seek(frameNum * pyraw2dng.rawFrameSize(width, length, bpp) + 100)
+    value = rawFile.read(1)
+    rawFile.seek(-1, os.SEEK_CUR)
+    rawFile.write(chr(ord(value) ^ 0xff))
+    rawFile.close()
+
+## --resume reconverts frames whose source changed without the file
+## changing size, and copes with an empty input
+def checkResume(workDir):
+    width, length, bpp, frames = 64, 32, 16, 6
+    rawFilename = os.path.join(workDir, "resume.raw")
+    for clipFrames, editedFrame, redone in ((0, 2, [2]), (2, 3, [2, 3])):
+        generateClip(rawFilename, width, length, bpp, frames)
+        outputDir = os.path.join(workDir, "resume_%d" % clipFrames)
+        outputFilenameFormat = os.path.join(outputDir, "frame_%06d.DNG")
+        convertWithManifest(rawFilename, outputFilenameFormat, width, length, bpp, clipFrames)
+
+        editFrame(rawFilename, editedFrame, width, length, bpp)
+        done = convertWithManifest(rawFilename, outputFilenameFormat, width, length, bpp, clipFrames, resume=True)
+        check(done == [f for f in range(frames) if f not in redone],
+              "resume (clipFrames %d): frames %s done after editing frame %d" % (clipFrames, done, editedFrame))
+
+        freshDir = os.path.join(workDir, "fresh_%d" % clipFrames)
+        pyraw2dng.convertVideo(rawFilename, os.path.join(freshDir, "frame_%06d.DNG"), width, length, True, bpp,
+                               clipFrames=clipFrames, creationTime=CREATION_TIME)
+        check(readFiles(outputDir) == readFiles(freshDir),
+              "resume (clipFrames %d): output differs from a fresh conversion of the edited video" % clipFrames)
+
+    emptyFilename = os.path.join(workDir, "empty.raw")
+    open(emptyFilename, "wb").close()
+    outputFilenameFormat = os.path.join(workDir, "resume_empty", "frame_%06d.DNG")
+    convertWithManifest(emptyFilename, outputFilenameFormat, width, length, bpp)
+    done = convertWithManifest(emptyFilename, outputFilenameFormat, width, length, bpp, resume=True)
+    check(done == [], "resume: an empty video has frames %s done" % done)
+
+## The formats checkDigests writes, as extra arguments to convertVideo
+DIGEST_MODES = {
+    'plain':        {},
+    'bits12':       {'bitsPerSample': 12},
+    'clip':         {'clipFrames': 2},
+    'compress':     {'tileSize': 48},
+    'compress12':   {'tileSize': 16, 'bitsPerSample': 12, 'preview': True},
+}
+
+## verifyDNG passes every frame of DNGs written with --digest, compressed
+## or not, and fails a frame whose (compressed) image data was changed
+def checkDigests(workDir):
+    width, length, bpp, frames = 64, 32, 12, 4
+    rawFilename = os.path.join(workDir, "digest.raw")
+    generateClip(rawFilename, width, length, bpp, frames)
+    for name in sorted(DIGEST_MODES):
+        outputDir = os.path.join(workDir, name)
+        pyraw2dng.convertVideo(rawFilename, os.path.join(outputDir, "frame_%06d.DNG"), width, length, True, bpp,
+                               creationTime=CREATION_TIME, digests=True, **DIGEST_MODES[name])
+        for filename in sorted(os.listdir(outputDir)):
+            results = pyraw2dng.verifyDNG(os.path.join(outputDir, filename))
+            check(results and set(results) == set(['ok']), "digest (%s): %s is %s" % (name, filename, results))
+
+    filename = os.path.join(workDir, "compress", "frame_000001.DNG")
+    dng = bytearray(open(filename, "rb").read())
+    dng[len(dng) // 2] ^= 0x10
+    open(filename, "wb").write(dng)
+    try:
+        results = pyraw2dng.verifyDNG(filename)
+    except ValueError:
+        results = ['unreadable']
+    check(results != ['ok'], "digest: a changed compressed frame still matches its digest")
+
+## The ways of converting a video checkMemory tries, as extra arguments to
+## convertVideo (or iterDNGs)
+MEMORY_MODES = {
+    'serial':   {},
+    'clip':     {'clipFrames': None},
+    'iterDNGs': None,
+}
+
+## Convert a video (with convertVideo, or by reading every frame of
+## iterDNGs) and return the process's peak RSS in kB and the peak bytes of
+## frame buffers in flight, or None for the latter when they aren't counted
+def convertForMemory(rawFilename, outputDir, width, length, bpp, how):
+    peakBufferBytes = None
+    if how == 'iterDNGs':
+        for frameNum, dng in pyraw2dng.iterDNGs(rawFilename, width, length, bpp, creationTime=CREATION_TIME):
+            pass
+    else:
+        stats = pyraw2dng.conversionStats()
+        pyraw2dng.convertVideo(rawFilename, os.path.join(outputDir, "frame_%06d.DNG"), width, length, True, bpp,
+                               stats=stats, creationTime=CREATION_TIME, **MEMORY_MODES[how])
+        peakBufferBytes = stats.summary()['peakBufferBytes']
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, peakBufferBytes
+
+## Run convertForMemory in a process of its own, so its peak RSS is that of
+## this one conversion
+def measureMemory(*args):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(convertForMemory, args)
+    finally:
+        pool.close()
+        pool.join()
+
+## Peak RSS growth (kB) allowed between the short and the long video, for
+## the noise of the allocator; a leak of even 2kB per frame is well over it
+MEMORY_SLACK = 4096
+
+## Converting a packed video of thousands of frames takes no more memory
+## than converting a short one
+def checkMemory(workDir):
+    check(resource is not None, "memory: needs the resource module (not available on this platform)")
+    width, length, bpp = 256, 128, 12
+    frameCounts = (20, 3000)
+    rawFilename = os.path.join(workDir, "memory.raw")
+    outputDir = os.path.join(workDir, "memory")
+    for how in sorted(MEMORY_MODES):
+        peaks = []
+        for frames in frameCounts:
+            generateClip(rawFilename, width, length, bpp, frames)
+            os.mkdir(outputDir)
+            peaks.append(measureMemory(rawFilename, outputDir, width, length, bpp, how))
+            shutil.rmtree(outputDir)
+        (shortRss, shortBuffers), (longRss, longBuffers) = peaks
+        check(longRss <= shortRss + MEMORY_SLACK,
+              "memory (%s): peak RSS %dkB for %d frames, against %dkB for %d" %
+              (how, longRss, frameCounts[1], shortRss, frameCounts[0]))
+        check(longBuffers <= shortBuffers,
+              "memory (%s): %s bytes of frame buffers at the peak for %d frames, against %s for %d" %
+              (how, longBuffers, frameCounts[1], shortBuffers, frameCounts[0]))
+
+## Every check, by name
+CHECKS = [
+    ('resume', checkResume),
+    ('memory', checkMemory),
+    ('digest', checkDigests),
+]
+
+
+#=========================================================================================================
+helptext = '''check_pyraw2dng.py - Self-checks for pyraw2dng
+Copyright 2018 Kron Technologies Inc.
+
+check_pyraw2dng.py <options> [<check> ...]
+
+Runs the named checks (by default all of them) on synthetic videos in a
+temporary directory, and exits with status 1 if any of them fail.
+
+Checks:
+ resume      --resume reconverts the frames of a video that changed since
+             they were converted
+ memory      Peak memory use (RSS and frame buffers) converting a packed
+             video of thousands of frames is no more than for a short one
+ digest      --digest DNGs, compressed or not, pass verify_pyraw2dng.py,
+             and a changed one fails
+
+Options:
+ --help      Display this help message
+ -d/--dir    Directory for the test videos and output (default: a temporary directory)
+'''
+
+
+def main():
+    workDir = None
+
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'd:', ['help', 'dir='])
+    except getopt.error:
+        print 'Error: You tried to use an unknown option.\n\n'
+        print helptext
+        sys.exit(0)
+
+    for o, a in options:
+        if o == '--help':
+            print helptext
+            sys.exit(0)
+
+        elif o in ('-d', '--dir'):
+            workDir = a
+
+    checks = [(name, function) for name, function in CHECKS if not args or name in args]
+    for name in args:
+        if name not in dict(CHECKS):
+            print 'Error: Unknown check %s.\n\n' % name
+            print helptext
+            sys.exit(0)
+
+    failures = 0
+    for name, function in checks:
+        checkDir = tempfile.mkdtemp(prefix="pyraw2dng_check_", dir=workDir)
+        try:
+            function(checkDir)
+            print "%-10s ok" % name
+        except checkFailed as e:
+            print "%-10s FAILED: %s" % (name, e)
+            failures += 1
+        finally:
+            shutil.rmtree(checkDir)
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
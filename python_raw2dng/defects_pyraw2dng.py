@@ -0,0 +1,128 @@
+#!/usr/bin/python2.7
+
+# standard python imports
+import sys
+import getopt
+
+import pyraw2dng
+
+
+#=========================================================================================================
+helptext = '''defects_pyraw2dng.py - Find the hot and dead pixels of a Chronos sensor
+Copyright 2018 Kron Technologies Inc.
+
+defects_pyraw2dng.py <options> -o <defects.txt>
+
+Averages dark clips (recorded with the lens covered) and flat clips (of an
+evenly lit, featureless scene, well short of saturation) and compares each
+pixel with its same-colour neighbours. Pixels that stand out are written to
+a defect map, for pyraw2dng.py --defects to correct while converting.
+
+Options:
+ --help      Display this help message
+ -M/--mono   Raw data is mono
+ -C/--color  Raw data is colour
+ -p/--packed Raw 12-bit packed data (default: 16-bit)
+ --oldpack   Legacy 12-bit packed data (v0.3.0 and earlier)
+ -w/--width  Frame width
+ -l/--length Frame length
+ -h/--height Frame length (please use only one)
+ -d/--dark   Dark clip to find hot pixels in (may be given more than once)
+ -f/--flat   Flat clip to find dead and weak pixels in (may be given more
+             than once)
+ -o/--output Write the defect map to this file (default: defects.txt)
+ --dark-sigmas
+             How far a hot pixel stands out from its neighbours, in units of
+             the spread of the whole dark frame (default: 10)
+ --flat-tolerance
+             How far, as a fraction, a pixel's response to light may differ
+             from its neighbours' before it is defective (default: 0.25)
+
+Examples:
+  defects_pyraw2dng.py -p -w 1280 -l 1024 -d dark.raw -f flat.raw -o defects.txt
+  pyraw2dng.py -p -w 1280 -l 1024 --defects defects.txt test.raw
+'''
+
+
+def main():
+    width = None
+    length = None
+    colour = True
+    bpp = 16
+    darkFilenames = []
+    flatFilenames = []
+    outputFilename = 'defects.txt'
+    darkSigmas = 10.0
+    flatTolerance = 0.25
+
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'CMpw:l:h:d:f:o:',
+            ['help', 'color', 'mono', 'packed', 'oldpack', 'width=', 'length=', 'height=',
+             'dark=', 'flat=', 'output=', 'dark-sigmas=', 'flat-tolerance='])
+    except getopt.error:
+        print 'Error: You tried to use an unknown option.\n\n'
+        print helptext
+        sys.exit(0)
+
+    for o, a in options:
+        if o == '--help':
+            print helptext
+            sys.exit(0)
+
+        elif o in ('-C', '--color'):
+            colour = True
+
+        elif o in ('-M', '--mono'):
+            colour = False
+
+        elif o in ('-p', '--packed'):
+            bpp = 12
+
+        elif o == '--oldpack':
+            bpp = -12
+
+        elif o in ('-w', '--width'):
+            width = int(a)
+
+        elif o in ('-l', '-h', '--length', '--height'):
+            length = int(a)
+
+        elif o in ('-d', '--dark'):
+            darkFilenames.append(a)
+
+        elif o in ('-f', '--flat'):
+            flatFilenames.append(a)
+
+        elif o in ('-o', '--output'):
+            outputFilename = a
+
+        elif o == '--dark-sigmas':
+            darkSigmas = float(a)
+
+        elif o == '--flat-tolerance':
+            flatTolerance = float(a)
+
+    if not width or not length or not (darkFilenames or flatFilenames):
+        print 'Error: A frame size and at least one dark or flat clip are needed.\n\n'
+        print helptext
+        sys.exit(0)
+
+    if pyraw2dng.numpy is None:
+        print 'Error: Finding defects requires numpy.\n\n'
+        sys.exit(0)
+
+    try:
+        defects = pyraw2dng.findDefects(darkFilenames, flatFilenames, width, length, bpp, colour, darkSigmas, flatTolerance)
+    except (ValueError, EnvironmentError) as e:
+        print 'Error: %s\n\n' % e
+        sys.exit(0)
+    defects.save(outputFilename)
+
+    if darkFilenames:
+        print "%d hot pixels in %d dark frames" % (defects.header['hot'], defects.header['darkFrames'])
+    if flatFilenames:
+        print "%d dead or weak pixels in %d flat frames" % (defects.header['flat'], defects.header['flatFrames'])
+    print "%d defects (%.4f%% of the sensor) written to %s" % (len(defects), 100.0 * len(defects) / (width * length), outputFilename)
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,172 @@ import array
 import getopt
 import platform
 import errno
+import mmap
+import threading
+import itertools
+import json
+import zlib
+import hashlib
+import glob
+import csv
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    mapSlice = buffer # python 2.7: zero-copy view into an mmap
+except NameError:
+    def mapSlice(obj, offset, size):
+        return memoryview(obj)[offset:offset+size]
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+class conversionStats(object):
+    """
+    Optional instrumentation for a conversion: the time spent and bytes moved
+    in each stage (read, unpack, serialize, write, ...) and the peak size of
+    the frame buffers in flight. With trace set, each stage of each frame is
+    also kept as an event for chrome://tracing.
+    """
+    def __init__(self, trace=False):
+        self.startTime = time.time()
+        self.stages = {} # name: [count, seconds, maxSeconds, bytes]
+        self.held = {} # frameNum: bytes of buffers allocated for the frame
+        self.bufferBytes = 0
+        self.peakBufferBytes = 0
+        self.events = [] if trace else None
+        self.lock = threading.Lock()
+
+    ## Locks cannot be pickled, which worker processes need to return stats
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, stage, frameNum, start, nbytes=0):
+        """Record that stage ran on frameNum from start until now."""
+        end = time.time()
+        with self.lock:
+            counts = self.stages.setdefault(stage, [0, 0.0, 0.0, 0])
+            counts[0] += 1
+            counts[1] += end - start
+            counts[2] = max(counts[2], end - start)
+            counts[3] += nbytes
+            if self.events is not None:
+                self.events.append((stage, frameNum, start, end, nbytes, os.getpid(), threading.current_thread().ident))
+
+    def hold(self, frameNum, nbytes):
+        """Count a buffer allocated for frameNum until it is released."""
+        with self.lock:
+            self.held[frameNum] = self.held.get(frameNum, 0) + nbytes
+            self.bufferBytes += nbytes
+            self.peakBufferBytes = max(self.peakBufferBytes, self.bufferBytes)
+
+    def release(self, frameNum):
+        """Drop all buffers held for frameNum, once it has been written."""
+        with self.lock:
+            self.bufferBytes -= self.held.pop(frameNum, 0)
+
+    def merge(self, other):
+        """Add the stats of a worker process."""
+        with self.lock:
+            for stage, (count, seconds, maxSeconds, nbytes) in other.stages.items():
+                counts = self.stages.setdefault(stage, [0, 0.0, 0.0, 0])
+                counts[0] += count
+                counts[1] += seconds
+                counts[2] = max(counts[2], maxSeconds)
+                counts[3] += nbytes
+            # Workers run at the same time, so this is the peak per process.
+            self.peakBufferBytes = max(self.peakBufferBytes, other.peakBufferBytes)
+            if self.events is not None and other.events:
+                self.events.extend(other.events)
+
+    def summary(self):
+        elapsed = time.time() - self.startTime
+        stages = {}
+        for stage, (count, seconds, maxSeconds, nbytes) in self.stages.items():
+            stages[stage] = {
+                'count': count,
+                'seconds': seconds,
+                'meanSeconds': seconds / count,
+                'maxSeconds': maxSeconds,
+                'bytes': nbytes,
+                'MBps': nbytes / seconds / 1e6 if seconds and nbytes else None,
+            }
+        frames = self.stages.get('write', [0])[0]
+        summary = {
+            'frames': frames,
+            'elapsed': elapsed,
+            'fps': frames / elapsed if elapsed else None,
+            'bytesRead': self.stages.get('read', [0, 0, 0, 0])[3],
+            'bytesWritten': self.stages.get('write', [0, 0, 0, 0])[3],
+            'peakBufferBytes': self.peakBufferBytes,
+            'stages': stages,
+        }
+        if resource is not None:
+            # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+            scale = 1 if sys.platform == 'darwin' else 1024
+            summary['peakRSSBytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+            summary['peakChildRSSBytes'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        return summary
+
+    def trace(self):
+        """The recorded events in the Chrome trace event format."""
+        return {'traceEvents': [
+            {'name': stage, 'cat': 'pyraw2dng', 'ph': 'X', 'pid': pid, 'tid': tid,
+             'ts': (start - self.startTime) * 1e6, 'dur': (end - start) * 1e6,
+             'args': {'frame': frameNum, 'bytes': nbytes}}
+            for stage, frameNum, start, end, nbytes, pid, tid in (self.events or [])]}
+
+class nullStats(object):
+    """Stands in for conversionStats when instrumentation is off."""
+    def record(self, stage, frameNum, start, nbytes=0):
+        pass
+
+    def hold(self, frameNum, nbytes):
+        pass
+
+    def release(self, frameNum):
+        pass
+
+NO_STATS = nullStats()
+
+class bufferPool(object):
+    """
+    Free lists of bytearrays by size, so a conversion loop that hands each
+    frame's buffers back once the frame is written reuses them rather than
+    allocating new ones for every frame. Anything that is not a bytearray
+    (eg: a view into a memory map) is ignored when put back.
+    """
+    def __init__(self):
+        self.free = {}
+        self.lock = threading.Lock()
+
+    def get(self, size):
+        with self.lock:
+            buffers = self.free.get(size)
+            if buffers:
+                return buffers.pop()
+        return bytearray(size)
+
+    def put(self, buf):
+        if isinstance(buf, bytearray):
+            with self.lock:
+                self.free.setdefault(len(buf), []).append(buf)
 
 class Type:
     # TIFF Type Format = (Tag TYPE value, Size in bytes of one instance)
@@ -29,6 +195,7 @@ class Type:
 
 Types = [(getattr(Type,n),n) for n in dir(Type) if n!="__doc__" and n!="__module__"]
 Types.sort()
+TypeSizes = dict(t for t, n in Types)
 
 class Tag:
     Invalid                     = (0,Type.Invalid)
@@ -238,6 +405,12 @@ class dngIFD(object):
         self.tags = []
         self.NextIFDOffset = 0
 
+    def getTag(self, tagType):
+        for tag in self.tags:
+            if tag.TagId == tagType[0]:
+                return tag
+        return None
+
     def setBuffer(self, buf, offset):
         self.buf = buf
         self.offset = offset
@@ -274,6 +447,7 @@ class DNG(object):
         self.IFDs = []
         self.ImageDataStrips = []
         self.StripOffsets = {}
+        self.digester = None
 
     def setBuffer(self, buf):
         self.buf = buf
@@ -306,6 +480,876 @@ class DNG(object):
         for i in range(len(self.ImageDataStrips)):
             self.buf[self.StripOffsets[i]:self.StripOffsets[i]+len(self.ImageDataStrips[i])] = self.ImageDataStrips[i]
 
+    def compile(self):
+        return compiledDNG(self)
+
+
+class compiledDNG(object):
+    """
+    Pre-serialized DNG with fixed size strips. The tags are packed once,
+    leaving the bytes around the strips fixed, so each frame is written as
+    header + strip + gap + ... + strip + trailer without any struct packing
+    or buffer copies. With a digester, each frame's copy of the header is
+    stamped with the digests of its raw image.
+    """
+    def __init__(self, dng):
+        dng.write()
+        self.digester = dng.digester
+        if self.digester is not None:
+            self.digestOffset = dng.IFDs[0].getTag(Tag.NewRawImageDigest).DataOffset
+            self.uniqueIDOffset = dng.IFDs[0].getTag(Tag.RawDataUniqueID).DataOffset
+        self.stripOffsets = [dng.StripOffsets[i] for i in range(len(dng.ImageDataStrips))]
+        self.stripLengths = [len(strip) for strip in dng.ImageDataStrips]
+        stripEnds = [offset + length for offset, length in zip(self.stripOffsets, self.stripLengths)]
+        self.header = bytes(dng.buf[:self.stripOffsets[0]])
+        self.gaps = [bytes(dng.buf[end:start]) for end, start in zip(stripEnds, self.stripOffsets[1:])]
+        self.gaps.append(bytes(dng.buf[stripEnds[-1]:])) # the trailer
+
+    def newBuffer(self):
+        """A buffer holding the whole DNG, with everything but the strips filled in."""
+        buf = bytearray(len(self.header) + sum(self.stripLengths) + sum(len(gap) for gap in self.gaps))
+        buf[:len(self.header)] = self.header
+        for offset, length, gap in zip(self.stripOffsets, self.stripLengths, self.gaps):
+            buf[offset + length:offset + length + len(gap)] = gap
+        return buf
+
+    def fillBuffer(self, buf, strips, frameNum=None):
+        """Copy a frame's strips into a buffer from newBuffer."""
+        if [len(strip) for strip in strips] != self.stripLengths:
+            raise ValueError("strips are %s bytes, expected %s" % ([len(strip) for strip in strips], self.stripLengths))
+        for offset, strip in zip(self.stripOffsets, strips):
+            buf[offset:offset + len(strip)] = strip
+        if self.digester is not None:
+            self.stamp(buf, strips, frameNum)
+
+    def stamp(self, buf, strips, frameNum=None, stats=NO_STATS, base=0):
+        """
+        Write the digests of a frame's raw image into buf, a copy of the
+        header (or part of it, starting at file offset base).
+        """
+        start = time.time()
+        digest, uniqueID = self.digester.stripDigests(strips[0], frameNum)
+        buf[self.digestOffset - base:self.digestOffset - base + len(digest)] = digest
+        buf[self.uniqueIDOffset - base:self.uniqueIDOffset - base + len(uniqueID)] = uniqueID
+        stats.record('digest', frameNum, start, self.stripLengths[0])
+
+    def buffers(self, strips, header=None):
+        """
+        The buffers to write for a frame, in order. header replaces the
+        compiled header, eg: with a copy stamped with the frame's digests.
+        """
+        if [len(strip) for strip in strips] != self.stripLengths:
+            raise ValueError("strips are %s bytes, expected %s" % ([len(strip) for strip in strips], self.stripLengths))
+        buffers = [self.header if header is None else header]
+        for strip, gap in zip(strips, self.gaps):
+            buffers.append(strip)
+            buffers.append(gap)
+        return buffers
+
+    def copyFile(self, filename, inFd, offset, stats=NO_STATS, frameNum=None):
+        """
+        Write a DNG whose single strip is stored at offset in the file inFd,
+        copying it across without reading it into python.
+        """
+        if len(self.stripLengths) != 1:
+            raise ValueError("only DNGs with a single strip can be copied")
+        if self.digester is not None:
+            raise ValueError("frames copied by the kernel cannot be digested")
+        start = time.time()
+        with atomicFile(filename) as fd:
+            writeBuffers(fd, [self.header])
+            copyRange(inFd, fd, offset, self.stripLengths[0])
+            writeBuffers(fd, self.gaps)
+        stats.record('write', frameNum, start, len(self.header) + self.stripLengths[0] + sum(len(gap) for gap in self.gaps))
+
+    def writeFile(self, filename, strips, stats=NO_STATS, frameNum=None):
+        header = None
+        if self.digester is not None:
+            header = bytearray(self.header)
+            self.stamp(header, strips, frameNum, stats)
+
+        start = time.time()
+        buffers = self.buffers(strips, header)
+        stats.record('serialize', frameNum, start)
+
+        start = time.time()
+        with atomicFile(filename) as fd:
+            writeBuffers(fd, buffers)
+        stats.record('write', frameNum, start, sum(len(b) for b in buffers))
+        stats.release(frameNum)
+
+
+## Scatter-gather writes through libc, which Python 2 has no os.writev for.
+## Buffers are passed to writev by address, through the (old) buffer
+## interface of str, bytearray, buffer and numpy objects, without copying.
+libcWritev = None
+if os.name == 'posix':
+    try:
+        import ctypes
+
+        class iovec(ctypes.Structure):
+            _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        libcWritev = libc.writev
+        libcWritev.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int]
+        libcWritev.restype = ctypes.c_ssize_t
+        asReadBuffer = ctypes.pythonapi.PyObject_AsReadBuffer
+        asReadBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_ssize_t)]
+        asReadBuffer.restype = ctypes.c_int
+    except (ImportError, OSError, AttributeError):
+        libcWritev = None
+
+## Most buffers writev accepts in one call (the smallest IOV_MAX in use)
+WRITEV_MAX_BUFFERS = 1024
+
+## The address and length of a buffer's memory; TypeError if it has none
+def bufferAddress(obj):
+    address = ctypes.c_void_p()
+    size = ctypes.c_ssize_t()
+    asReadBuffer(obj, ctypes.byref(address), ctypes.byref(size))
+    return address.value, size.value
+
+## Write a list of buffers to a file descriptor, using scatter-gather writes
+## where libc has writev, and a write per buffer otherwise.
+def writeBuffers(fd, buffers):
+    if libcWritev is not None:
+        try:
+            pending = [(address, size) for address, size in (bufferAddress(b) for b in buffers) if size]
+        except TypeError:
+            pending = None # eg: a memoryview, which has no old-style buffer
+        if pending is not None:
+            while pending:
+                count = min(len(pending), WRITEV_MAX_BUFFERS)
+                iovecs = (iovec * count)(*[iovec(address, size) for address, size in pending[:count]])
+                written = libcWritev(fd, iovecs, count)
+                if written < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.EINTR:
+                        continue
+                    raise OSError(err, os.strerror(err))
+                while pending and written >= pending[0][1]:
+                    written -= pending[0][1]
+                    pending.pop(0)
+                if written:
+                    address, size = pending[0]
+                    pending[0] = (address + written, size - written)
+            return
+
+    for b in buffers:
+        while len(b):
+            b = b[os.write(fd, b):]
+
+
+## Functions that copy up to count bytes from offset in inFd to the current
+## position of outFd inside the kernel, returning the number of bytes
+## copied. They are tried in order, and dropped once they turn out not to
+## work for the files at hand (eg: copy_file_range across filesystems on
+## older kernels).
+kernelCopies = []
+if hasattr(os, 'copy_file_range'):
+    kernelCopies.append(lambda inFd, outFd, offset, count: os.copy_file_range(inFd, outFd, count, offset))
+if hasattr(os, 'sendfile'):
+    kernelCopies.append(lambda inFd, outFd, offset, count: os.sendfile(outFd, inFd, offset, count))
+elif platform.system() == 'Linux':
+    # Python 2 has no os.sendfile, but libc does.
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            libcSendfile, offsetType = libc.sendfile64, ctypes.c_int64
+        except AttributeError:
+            libcSendfile, offsetType = libc.sendfile, ctypes.c_long
+        libcSendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(offsetType), ctypes.c_size_t]
+        libcSendfile.restype = ctypes.c_ssize_t
+
+        def sendfile(inFd, outFd, offset, count):
+            copied = libcSendfile(outFd, inFd, ctypes.byref(offsetType(offset)), count)
+            if copied < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return copied
+        kernelCopies.append(sendfile)
+    except (ImportError, OSError, AttributeError):
+        pass
+
+## Errors meaning a kernel copy function cannot be used on these files
+KERNEL_COPY_UNSUPPORTED = set(getattr(errno, name) for name in ('ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP')
+                              if hasattr(errno, name))
+
+## Copy count bytes from offset in inFd to the current position of outFd,
+## inside the kernel if possible and through a buffer otherwise.
+def copyRange(inFd, outFd, offset, count):
+    while count > 0:
+        for copy in list(kernelCopies):
+            try:
+                copied = copy(inFd, outFd, offset, count)
+                break
+            except OSError as e:
+                if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                    raise
+                if copy in kernelCopies:
+                    kernelCopies.remove(copy)
+        else:
+            if hasattr(os, 'pread'):
+                data = os.pread(inFd, min(count, 1 << 20), offset)
+            else:
+                os.lseek(inFd, offset, os.SEEK_SET)
+                data = os.read(inFd, min(count, 1 << 20))
+            writeBuffers(outFd, [data])
+            copied = len(data)
+        if copied == 0:
+            raise IOError("unexpected end of input")
+        offset += copied
+        count -= copied
+
+class atomicFile(object):
+    """
+    Opens a temporary file next to filename for writing, returning its file
+    descriptor, and renames it into place once the with block completes. A
+    file that was only partly written is removed rather than left looking
+    like a finished one.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.tempFilename = filename + ".tmp"
+
+    def __enter__(self):
+        self.fd = os.open(self.tempFilename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+        return self.fd
+
+    def __exit__(self, excType, excValue, traceback):
+        os.close(self.fd)
+        if excType is not None:
+            os.remove(self.tempFilename)
+        elif hasattr(os, 'replace'):
+            os.replace(self.tempFilename, self.filename)
+        else:
+            # Windows will not rename over an existing file
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(self.tempFilename, self.filename)
+        return False
+
+
+## Positions of every field in an IFD (and its sub-IFDs) that holds an
+## absolute file offset. buf holds the file starting at absolute position
+## base; the returned positions are relative to buf. The next-IFD pointer is
+## not included.
+def offsetFields(buf, ifdOffset, base=0):
+    fields = []
+    pos = ifdOffset - base
+    count = struct.unpack_from("<H", buf, pos)[0]
+    for i in range(count):
+        entry = pos + 2 + i*12
+        tagId, dataType, dataCount, value = struct.unpack_from("<HHII", buf, entry)
+        if tagId in (Tag.SubIFD[0], Tag.EXIF_IFD[0]):
+            fields.append(entry + 8)
+            fields.extend(offsetFields(buf, value, base))
+            continue
+        external = (dataCount * TypeSizes.get(dataType, 1)) > 4
+        if external:
+            fields.append(entry + 8)
+        if tagId in (Tag.StripOffsets[0], Tag.TileOffsets[0]):
+            if external:
+                fields.extend(value - base + 4*n for n in range(dataCount))
+            else:
+                fields.append(entry + 8)
+    return fields
+
+## Add delta to each offset field of buf
+def relocate(buf, fields, delta):
+    for field in fields:
+        struct.pack_into("<I", buf, field, struct.unpack_from("<I", buf, field)[0] + delta)
+
+
+CLIP_INDEX_MAGIC = b"PYR2DIDX"
+CLIP_FOOTER = "<8sII" # magic, frame count, index offset
+CLIP_INDEX_ENTRY = "<III" # frame number, IFD offset, strip offset
+
+class clipWriter(object):
+    """
+    Writes many frames into one DNG file as a chain of IFDs, each followed
+    by its strip. After the last frame comes an index of IFD and strip
+    offsets and a fixed-size footer pointing at it, so a frame can be found
+    without walking the IFD chain. TIFF readers ignore the index.
+    """
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.ifdOffset = struct.unpack_from("<I", compiled.header, 4)[0]
+        self.record = bytearray(compiled.header[self.ifdOffset:])
+        self.fields = [f - self.ifdOffset for f in offsetFields(compiled.header, self.ifdOffset)]
+        tagCount = struct.unpack_from("<H", self.record, 0)[0]
+        self.nextField = 2 + tagCount*12
+        self.stripOffset = compiled.stripOffsets[0] - self.ifdOffset
+        self.recordLength = len(self.record) + sum(compiled.stripLengths) + sum(len(gap) for gap in compiled.gaps)
+
+    ## Largest number of frames that fits in one file with 32-bit offsets
+    def maxFrames(self):
+        available = 0xFFFFFFFF - 8 - struct.calcsize(CLIP_FOOTER)
+        return available // (self.recordLength + struct.calcsize(CLIP_INDEX_ENTRY))
+
+    def write(self, filename, frames, stats=NO_STATS, pool=None):
+        """
+        Write an iterable of (frameNum, strips) pairs to filename, returning
+        the frame numbers written. With a pool, each frame's image data is
+        put back into it once written.
+        """
+        with atomicFile(filename) as fd:
+            index = []
+            frameNums = []
+            frames = iter(frames)
+            pending = next(frames, None)
+            writeBuffers(fd, [struct.pack("<ccbbI", b'I', b'I', 0x2A, 0x00, 8 if pending else 0)])
+
+            offset = 8
+            while pending:
+                frameNum, strips = pending
+                pending = next(frames, None)
+
+                record = bytearray(self.record)
+                if self.compiled.digester is not None:
+                    self.compiled.stamp(record, strips, frameNum, stats, self.ifdOffset)
+
+                start = time.time()
+                buffers = self.compiled.buffers(strips)
+                relocate(record, self.fields, offset - self.ifdOffset)
+                nextOffset = offset + self.recordLength
+                struct.pack_into("<I", record, self.nextField, nextOffset if pending else 0)
+                buffers[0] = record
+                stats.record('serialize', frameNum, start)
+
+                start = time.time()
+                writeBuffers(fd, buffers)
+                stats.record('write', frameNum, start, self.recordLength)
+                stats.release(frameNum)
+                if pool is not None:
+                    pool.put(strips[0])
+
+                index.append(struct.pack(CLIP_INDEX_ENTRY, frameNum, offset, offset + self.stripOffset))
+                frameNums.append(frameNum)
+                offset = nextOffset
+
+            index.append(struct.pack(CLIP_FOOTER, CLIP_INDEX_MAGIC, len(index), offset))
+            writeBuffers(fd, [b''.join(index)])
+        return frameNums
+
+## Read the index of a clip file as a list of (frameNum, ifdOffset,
+## stripOffset) entries, plus the offset of the index itself
+def readClipIndex(file):
+    footerSize = struct.calcsize(CLIP_FOOTER)
+    entrySize = struct.calcsize(CLIP_INDEX_ENTRY)
+    file.seek(-footerSize, os.SEEK_END)
+    magic, count, indexOffset = struct.unpack(CLIP_FOOTER, file.read(footerSize))
+    if magic != CLIP_INDEX_MAGIC:
+        raise ValueError("not a pyraw2dng clip file")
+
+    file.seek(indexOffset)
+    data = file.read(count * entrySize)
+    index = [struct.unpack_from(CLIP_INDEX_ENTRY, data, i*entrySize) for i in range(count)]
+    return index, indexOffset
+
+## Extract a frame from a clip file as the bytes of a standalone DNG
+def readClipFrame(file, index, indexOffset, position):
+    frameNum, ifdOffset, stripOffset = index[position]
+    if position + 1 < len(index):
+        end = index[position + 1][1]
+    else:
+        end = indexOffset
+
+    file.seek(ifdOffset)
+    record = bytearray(file.read(end - ifdOffset))
+    relocate(record, offsetFields(record, ifdOffset, ifdOffset), 8 - ifdOffset)
+    tagCount = struct.unpack_from("<H", record, 0)[0]
+    struct.pack_into("<I", record, 2 + tagCount*12, 0)
+    return struct.pack("<ccbbI", b'I', b'I', 0x2A, 0x00, 8) + bytes(record)
+
+## Split a clip file back into one DNG per frame. Only the frames listed in
+## frameNums are extracted, or all of them if it is None.
+def splitClip(clipFilename, outputFilenameFormat, frameNums=None):
+    clipFile = open(clipFilename, "rb")
+    index, indexOffset = readClipIndex(clipFile)
+    for position in range(len(index)):
+        frameNum = index[position][0]
+        if frameNums is not None and frameNum not in frameNums:
+            continue
+        with atomicFile(outputFilenameFormat % frameNum) as fd:
+            writeBuffers(fd, [readClipFrame(clipFile, index, indexOffset, position)])
+    clipFile.close()
+
+## The tags of the IFD at offset in buf, as a dict of tag id to (data type,
+## count, position of the values), and the offset of the next IFD
+def readIFD(buf, offset):
+    tags = {}
+    count = struct.unpack_from("<H", buf, offset)[0]
+    for i in range(count):
+        entry = offset + 2 + i*12
+        tagId, dataType, dataCount, value = struct.unpack_from("<HHII", buf, entry)
+        external = (dataCount * TypeSizes.get(dataType, 1)) > 4
+        tags[tagId] = (dataType, dataCount, value if external else entry + 8)
+    return tags, struct.unpack_from("<I", buf, offset + 2 + count*12)[0]
+
+## The values of an integer tag read by readIFD
+def tagValues(buf, tags, tagType, default=None):
+    if tagType[0] not in tags:
+        return default
+    dataType, dataCount, position = tags[tagType[0]]
+    formats = {Type.Byte[0]: 'B', Type.Short[0]: 'H', Type.Long[0]: 'I', Type.Undefined[0]: 'B'}
+    return struct.unpack_from("<%d%s" % (dataCount, formats[dataType]), buf, position)
+
+## The raw image of a tiled, lossless JPEG compressed IFD read by readIFD,
+## as a (length, width) array
+def readTiledImage(buf, tags, width, length):
+    tileWidth = tagValues(buf, tags, Tag.TileWidth)[0]
+    tileLength = tagValues(buf, tags, Tag.TileLength)[0]
+    across = (width + tileWidth - 1) // tileWidth
+    down = (length + tileLength - 1) // tileLength
+    tileOffsets = tagValues(buf, tags, Tag.TileOffsets)
+    tileLengths = tagValues(buf, tags, Tag.TileByteCounts)
+    if len(tileOffsets) != across * down:
+        raise ValueError("expected %d tiles, found %d" % (across * down, len(tileOffsets)))
+
+    image = numpy.empty((down * tileLength, across * tileWidth), dtype=numpy.uint16)
+    for i, (start, count) in enumerate(zip(tileOffsets, tileLengths)):
+        y, x = divmod(i, across)
+        tile = decodeLJ92(buf[start:start + count])
+        if tile.shape != (tileLength, tileWidth):
+            raise ValueError("tile %d is %dx%d, expected %dx%d" % (i, tile.shape[1], tile.shape[0], tileWidth, tileLength))
+        image[y*tileLength:(y+1)*tileLength, x*tileWidth:(x+1)*tileWidth] = tile
+    return image[:length, :width]
+
+## Check each frame of a DNG file (or clip file) written by pyraw2dng
+## against the NewRawImageDigest recorded in it, returning the status of
+## each frame: 'ok', 'mismatch', or 'missing' if it has no digest. Compressed
+## frames are decoded to be checked.
+def verifyDNG(filename, threads=1):
+    dngFile = open(filename, "rb")
+    try:
+        buf = mmap.mmap(dngFile.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise ValueError("%s is empty" % filename)
+    finally:
+        dngFile.close()
+    if buf[:4] != b"II*\x00":
+        raise ValueError("%s is not a little-endian DNG file" % filename)
+
+    digesters = {}
+    results = []
+    seen = set()
+    offset = struct.unpack_from("<I", buf, 4)[0]
+    while offset and offset not in seen:
+        seen.add(offset)
+        tags, nextOffset = readIFD(buf, offset)
+        offset = nextOffset
+        if Tag.NewRawImageDigest[0] not in tags:
+            results.append('missing')
+            continue
+
+        raw = tags
+        if tagValues(buf, tags, Tag.NewSubfileType, (0,))[0] != 0:
+            raw = readIFD(buf, tagValues(buf, tags, Tag.SubIFD)[0])[0]
+        compression = tagValues(buf, raw, Tag.Compression, (1,))[0]
+        if compression not in (1, 7):
+            raise ValueError("%s uses compression %d, which pyraw2dng does not write" % (filename, compression))
+
+        width = tagValues(buf, raw, Tag.ImageWidth)[0]
+        length = tagValues(buf, raw, Tag.ImageLength)[0]
+        bitsPerSample = tagValues(buf, raw, Tag.BitsPerSample)[0]
+        key = (width, length, bitsPerSample)
+        if key not in digesters:
+            digesters[key] = rawImageDigest(width, length, bitsPerSample, threads)
+
+        if compression == 7:
+            digest = digesters[key].digest(readTiledImage(buf, raw, width, length))
+        else:
+            stripOffsets = tagValues(buf, raw, Tag.StripOffsets)
+            stripLengths = tagValues(buf, raw, Tag.StripByteCounts)
+            if len(stripOffsets) == 1:
+                strip = mapSlice(buf, stripOffsets[0], stripLengths[0])
+            else:
+                strip = b''.join(buf[start:start + count] for start, count in zip(stripOffsets, stripLengths))
+            digest = digesters[key].stripDigests(strip)[0]
+        dataType, dataCount, position = tags[Tag.NewRawImageDigest[0]]
+        results.append('ok' if buf[position:position + dataCount] == digest else 'mismatch')
+    return results
+
+## Huffman code lengths for the given symbol counts, limited to 16 bits, as
+## the BITS and HUFFVAL lists of a JPEG DHT segment (ITU T.81 Annex K.2).
+def huffmanTable(counts):
+    freq = list(counts) + [1] # reserved symbol, so no code is all 1-bits
+    codesize = [0] * len(freq)
+    others = [-1] * len(freq)
+    while True:
+        v1 = v2 = -1
+        for i in range(len(freq)):
+            if freq[i] > 0 and (v1 < 0 or freq[i] <= freq[v1]):
+                v1 = i
+        for i in range(len(freq)):
+            if freq[i] > 0 and i != v1 and (v2 < 0 or freq[i] <= freq[v2]):
+                v2 = i
+        if v2 < 0:
+            break
+
+        freq[v1] += freq[v2]
+        freq[v2] = 0
+        codesize[v1] += 1
+        while others[v1] >= 0:
+            v1 = others[v1]
+            codesize[v1] += 1
+        others[v1] = v2
+        codesize[v2] += 1
+        while others[v2] >= 0:
+            v2 = others[v2]
+            codesize[v2] += 1
+
+    bits = [0] * 33
+    for size in codesize:
+        if size:
+            bits[size] += 1
+
+    # limit the code lengths to 16 bits (Annex K.3)
+    for i in range(32, 16, -1):
+        while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2
+            bits[i-1] += 1
+            bits[j+1] += 2
+            bits[j] -= 1
+    i = 16
+    while bits[i] == 0:
+        i -= 1
+    bits[i] -= 1 # drop the reserved symbol
+
+    huffval = [v for size in range(1, 33) for v in range(len(counts)) if codesize[v] == size]
+    return bits[1:17], huffval
+
+## Code and length for each symbol of a Huffman table (Annex C)
+def huffmanCodes(bits, huffval):
+    codes = {}
+    code = 0
+    k = 0
+    for size in range(1, 17):
+        for n in range(bits[size-1]):
+            codes[huffval[k]] = (code, size)
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+## Encode a 2D uint16 array as a lossless JPEG (ITU T.81 process 14) with
+## predictor 1, as used by DNG compression 7. With two components, each row
+## is split into interleaved even and odd columns so that samples are
+## predicted from the same colour of the CFA.
+def encodeLJ92(tile, components=1, precision=16):
+    length, width = tile.shape
+    planeWidth = width // components
+    samples = tile.reshape(length, planeWidth, components).astype(numpy.int32)
+
+    pred = numpy.empty_like(samples)
+    pred[:, 1:, :] = samples[:, :-1, :]
+    pred[1:, 0, :] = samples[:-1, 0, :]
+    pred[0, 0, :] = 1 << (precision - 1)
+
+    diff = ((samples - pred) & 0xFFFF).ravel()
+    diff[diff > 32768] -= 65536
+    ssss = numpy.frexp(numpy.abs(diff))[1]
+    extraLen = numpy.where(ssss < 16, ssss, 0)
+    extra = numpy.where(diff < 0, diff - 1, diff) & ((1 << extraLen) - 1)
+
+    bits, huffval = huffmanTable(numpy.bincount(ssss, minlength=17))
+    codes = huffmanCodes(bits, huffval)
+    codeTable = numpy.zeros(17, dtype=numpy.int64)
+    sizeTable = numpy.zeros(17, dtype=numpy.int64)
+    for symbol, (code, size) in codes.items():
+        codeTable[symbol] = code
+        sizeTable[symbol] = size
+
+    # each sample becomes a Huffman code followed by its extra bits
+    lengths = sizeTable[ssss] + extraLen
+    values = (codeTable[ssss] << extraLen) | extra
+    shifts = lengths[:, None] - 1 - numpy.arange(32)
+    valid = shifts >= 0
+    stream = ((values[:, None] >> numpy.where(valid, shifts, 0)) & 1)[valid].astype(numpy.uint8)
+    stream = numpy.concatenate((stream, numpy.ones(-len(stream) % 8, dtype=numpy.uint8)))
+    data = numpy.packbits(stream)
+    data = numpy.insert(data, numpy.flatnonzero(data == 0xFF) + 1, 0)
+
+    jpeg = [struct.pack(">H", 0xFFD8)]
+    jpeg.append(struct.pack(">HHB16B", 0xFFC4, 3 + 16 + len(huffval), 0x00, *bits))
+    jpeg.append(struct.pack(">%dB" % len(huffval), *huffval))
+    jpeg.append(struct.pack(">HHBHHB", 0xFFC3, 8 + 3*components, precision, length, planeWidth, components))
+    for c in range(components):
+        jpeg.append(struct.pack(">BBB", c, 0x11, 0))
+    jpeg.append(struct.pack(">HHB", 0xFFDA, 6 + 2*components, components))
+    for c in range(components):
+        jpeg.append(struct.pack(">BB", c, 0x00))
+    jpeg.append(struct.pack(">BBB", 1, 0, 0)) # predictor 1, no point transform
+    jpeg.append(data.tobytes())
+    jpeg.append(struct.pack(">H", 0xFFD9))
+    return b''.join(jpeg)
+
+## Decode a lossless JPEG written by encodeLJ92 (one Huffman table,
+## predictor 1, no point transform or restarts) back into a 2D uint16 array.
+## Anything else raises a ValueError.
+def decodeLJ92(jpeg):
+    jpeg = bytes(jpeg)
+    if jpeg[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG image")
+    codes = None
+    frame = None
+    position = 2
+    while True:
+        marker, segmentLength = struct.unpack_from(">HH", jpeg, position)
+        segment = jpeg[position + 4:position + 2 + segmentLength]
+        position += 2 + segmentLength
+        if marker == 0xFFC4:
+            if codes is not None or struct.unpack_from(">B", segment)[0] != 0:
+                raise ValueError("only a single Huffman table is supported")
+            bits = list(struct.unpack_from(">16B", segment, 1))
+            codes = huffmanCodes(bits, list(struct.unpack_from(">%dB" % sum(bits), segment, 17)))
+        elif marker == 0xFFC3:
+            precision, length, planeWidth, components = struct.unpack_from(">BHHB", segment)
+            frame = (precision, length, planeWidth, components)
+        elif marker == 0xFFDA:
+            if struct.unpack_from(">3B", segment, len(segment) - 3) != (1, 0, 0):
+                raise ValueError("only predictor 1 without a point transform is supported")
+            break
+        elif marker in (0xFFD9, 0xFFDD):
+            raise ValueError("unsupported JPEG marker %04X" % marker)
+    if codes is None or frame is None:
+        raise ValueError("JPEG image has no Huffman table or frame header")
+    precision, length, planeWidth, components = frame
+
+    end = jpeg.rfind(b"\xff\xd9")
+    if end < position:
+        raise ValueError("JPEG image has no end marker")
+    data = numpy.frombuffer(jpeg[position:end].replace(b"\xff\x00", b"\xff"), dtype=numpy.uint8)
+
+    # The symbol and code length for every 16-bit prefix of the bit stream
+    symbols = numpy.zeros(1 << 16, dtype=numpy.uint8)
+    codeLengths = numpy.zeros(1 << 16, dtype=numpy.uint8)
+    for symbol, (code, size) in codes.items():
+        symbols[code << (16 - size):(code + 1) << (16 - size)] = symbol
+        codeLengths[code << (16 - size):(code + 1) << (16 - size)] = size
+
+    # The bits of the stream from a bit position (with a byte offset of 2
+    # bytes, the 16 bits of a code; with 4, a code and its extra bits)
+    padded = numpy.concatenate((data, numpy.zeros(5, dtype=numpy.uint8))).astype(numpy.int64)
+    def window(positions, byteCount):
+        bytePositions = positions >> 3
+        bits = padded[bytePositions]
+        for i in range(1, byteCount + 1):
+            bits = (bits << 8) | padded[bytePositions + i]
+        return (bits >> (8 - (positions & 7))) & ((1 << (8 * byteCount)) - 1)
+
+    # The length of the sample that would start at every bit position
+    prefixes = window(numpy.arange(len(data) * 8), 2)
+    ssss = symbols[prefixes]
+    sampleLengths = codeLengths[prefixes] + numpy.where(ssss < 16, ssss, 0)
+
+    # Each sample starts where the one before it ends, so the starts have
+    # to be found one at a time
+    count = length * planeWidth * components
+    starts = [0] * count
+    steps = bytearray(sampleLengths.astype(numpy.uint8).tostring())
+    start = 0
+    try:
+        for i in xrange(count):
+            starts[i] = start
+            if not steps[start]:
+                raise ValueError("invalid Huffman code in JPEG image")
+            start += steps[start]
+    except IndexError:
+        raise ValueError("JPEG image is truncated or corrupt")
+    if start > len(steps):
+        raise ValueError("JPEG image is truncated or corrupt")
+    starts = numpy.array(starts, dtype=numpy.int64)
+
+    bits = window(starts, 4)
+    ssss = ssss[starts].astype(numpy.int64)
+    extraLen = numpy.where(ssss < 16, ssss, 0)
+    extra = (bits >> (32 - codeLengths[bits >> 16] - extraLen)) & ((1 << extraLen) - 1)
+    diff = numpy.where(extra < (1 << extraLen) >> 1, extra - (1 << extraLen) + 1, extra)
+    diff[ssss == 16] = 32768
+
+    # Undo predictor 1: down the first column, then along each row
+    diff = diff.reshape(length, planeWidth, components)
+    samples = numpy.cumsum(diff, axis=1)
+    samples += numpy.cumsum(diff[:, :1, :], axis=0) - diff[:, :1, :] + (1 << (precision - 1))
+    return (samples & 0xFFFF).astype(numpy.uint16).reshape(length, planeWidth * components)
+
+## Unpack a 12-bpp frame in DNG bit order into a (length, width) array
+def unpackDNG12(rawFrame, width, length):
+    pix = numpy.frombuffer(rawFrame, dtype=numpy.uint8, count=(width*length*3) // 2).reshape(-1, 3).astype(numpy.uint16)
+    frame = numpy.empty((pix.shape[0], 2), dtype=numpy.uint16)
+    frame[:,0] = (pix[:,0] << 4) | (pix[:,1] >> 4)
+    frame[:,1] = ((pix[:,1] & 0x0f) << 8) | pix[:,2]
+    return frame.reshape(length, width)
+
+class previewBuilder(object):
+    """
+    Builds the 8-bit RGB preview for a frame, at 1/16th of its resolution
+    like raw2dng. The CFA is binned 2x2 into RGB pixels and box filtered by
+    another factor of 8, then white balanced using AsShotNeutral and gamma
+    corrected through a lookup table. Frames are either 16-bpp or, with a
+    bitsPerSample of 12, packed 12-bpp in DNG bit order.
+    """
+    def __init__(self, width, length, colour, bitsPerSample=16):
+        self.width = width
+        self.length = length
+        self.colour = colour
+        self.bitsPerSample = bitsPerSample
+        self.previewWidth = width >> 4
+        self.previewLength = length >> 4
+        self.gains = numpy.array([15150 / 10000.0, 1.0, 11048 / 10000.0])
+        self.gamma = (255 * (numpy.arange(4096) / 4095.0) ** (1 / 2.2) + 0.5).astype(numpy.uint8)
+
+    ## 12-bit samples of a frame as a 2D array
+    def samples(self, rawFrame):
+        if (self.bitsPerSample == 16):
+            return (numpy.frombuffer(rawFrame, dtype='<u2') >> 4).reshape(self.length, self.width)
+        return unpackDNG12(rawFrame, self.width, self.length)
+
+    def __call__(self, rawFrame):
+        pw = self.previewWidth
+        pl = self.previewLength
+        frame = self.samples(rawFrame)[:pl*16, :pw*16]
+        if self.colour:
+            # sum each CFA phase over 16x16 blocks (G R / B G)
+            sums = frame.reshape(pl, 8, 2, pw, 8, 2).sum(axis=(1, 4), dtype=numpy.uint32)
+            rgb = numpy.empty((pl, pw, 3))
+            rgb[:,:,0] = sums[:,0,:,1]
+            rgb[:,:,1] = (sums[:,0,:,0] + sums[:,1,:,1]) / 2.0
+            rgb[:,:,2] = sums[:,1,:,0]
+            rgb *= self.gains / 64.0
+        else:
+            sums = frame.reshape(pl, 16, pw, 16).sum(axis=(1, 3), dtype=numpy.uint32)
+            rgb = numpy.repeat(sums[:,:,None] / 256.0, 3, axis=2)
+        return bytearray(self.gamma[numpy.clip(rgb, 0, 4095).astype(numpy.uint16)].tobytes())
+
+## The strips of a frame's DNG: its image data, followed by the preview
+def frameStrips(rawFrame, preview=None, stats=NO_STATS, frameNum=None):
+    if preview is None:
+        return [rawFrame]
+    start = time.time()
+    strip = preview(rawFrame)
+    stats.record('preview', frameNum, start, len(strip))
+    stats.hold(frameNum, len(strip))
+    return [rawFrame, strip]
+
+## Size of the tiles NewRawImageDigest is computed over, as in the DNG SDK
+DIGEST_TILE_SIZE = 256
+
+class rawImageDigest(object):
+    """
+    Computes the NewRawImageDigest and RawDataUniqueID of raw images of one
+    size and format. As in the DNG SDK, each 256x256 tile of the image
+    (shorter at the right and bottom edges) is hashed with MD5 as 16-bit
+    little-endian samples, and the digest is the MD5 of the tile hashes in
+    row-scan order. The tiles are hashed on a pool of threads, as hashlib
+    releases the GIL while hashing, unless threads is 1. The unique ID is the
+    MD5 of the digest, the camera model and the frame number. Requires numpy.
+    """
+    def __init__(self, width, length, bitsPerSample=16, threads=0):
+        self.width = width
+        self.length = length
+        self.bitsPerSample = bitsPerSample
+        self.threads = threads
+        self.tiles = [(y, x) for y in range(0, length, DIGEST_TILE_SIZE) for x in range(0, width, DIGEST_TILE_SIZE)]
+        self.pool = None
+
+    def __getstate__(self):
+        # the thread pool stays behind when sent to a worker process
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def digest(self, samples):
+        """The NewRawImageDigest of a (length, width) array of samples."""
+        def hashTile(origin):
+            y, x = origin
+            tile = numpy.ascontiguousarray(samples[y:y+DIGEST_TILE_SIZE, x:x+DIGEST_TILE_SIZE], dtype='<u2')
+            return hashlib.md5(tile).digest()
+
+        if self.threads == 1 or len(self.tiles) == 1:
+            hashes = [hashTile(origin) for origin in self.tiles]
+        else:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(self.threads or None)
+            hashes = self.pool.map(hashTile, self.tiles)
+        return hashlib.md5(b''.join(hashes)).digest()
+
+    def uniqueID(self, digest, frameNum=None):
+        return hashlib.md5(digest + b"Krontech Chronos 1.4" + struct.pack("<I", frameNum or 0)).digest()
+
+    def stripDigests(self, strip, frameNum=None):
+        """The (digest, uniqueID) of a frame from its uncompressed raw strip."""
+        if (self.bitsPerSample == 16):
+            samples = numpy.frombuffer(strip, dtype='<u2', count=self.width*self.length).reshape(self.length, self.width)
+        else:
+            samples = unpackDNG12(strip, self.width, self.length)
+        digest = self.digest(samples)
+        return digest, self.uniqueID(digest, frameNum)
+
+    def frameDigests(self, rawFrame, frameNum=None):
+        """The (digest, uniqueID) of a 16-bpp frame, stored with bitsPerSample bits."""
+        samples = numpy.frombuffer(rawFrame, dtype='<u2', count=self.width*self.length).reshape(self.length, self.width)
+        if (self.bitsPerSample == 12):
+            samples = samples >> 4
+        digest = self.digest(samples)
+        return digest, self.uniqueID(digest, frameNum)
+
+## Split a 16-bpp frame into tiles of tileSize x tileSize pixels, padding
+## the tiles along the right and bottom edges. With a bitsPerSample of 12
+## the samples are shifted down to 12 bits.
+def frameTiles(rawFrame, width, length, tileSize, bitsPerSample=16):
+    frame = numpy.frombuffer(rawFrame, dtype='<u2').reshape(length, width)
+    if (bitsPerSample == 12):
+        frame = frame >> 4
+    frame = numpy.pad(frame, ((0, -length % tileSize), (0, -width % tileSize)), mode='edge')
+    return [frame[y:y+tileSize, x:x+tileSize]
+            for y in range(0, frame.shape[0], tileSize)
+            for x in range(0, frame.shape[1], tileSize)]
+
+## Write a tiled DNG for one frame
+def writeTiledDNG(filename, dngTemplate, tiles, previews=[], stats=NO_STATS, frameNum=None, digests=None):
+    start = time.time()
+    buf = layoutTiledDNG(dngTemplate, tiles, previews, digests)
+    stats.record('serialize', frameNum, start)
+
+    start = time.time()
+    with atomicFile(filename) as fd:
+        writeBuffers(fd, [buf])
+    stats.record('write', frameNum, start, len(buf))
+    stats.release(frameNum)
+
+## Serialize a tiled DNG around this frame's tiles (and preview strips, if
+## any), returning the whole file as a bytearray. digests are the frame's
+## (digest, uniqueID), when the template has a digester.
+def layoutTiledDNG(dngTemplate, tiles, previews=[], digests=None):
+    mainIFD = dngTemplate.IFDs[0]
+    if digests is not None:
+        mainIFD.getTag(Tag.NewRawImageDigest).setValue(bytearray(digests[0]))
+        mainIFD.getTag(Tag.RawDataUniqueID).setValue(bytearray(digests[1]))
+    previewIFD = None
+    subIFD = mainIFD.getTag(Tag.SubIFD)
+    if subIFD:
+        previewIFD = mainIFD
+        mainIFD = subIFD.subIFD
+    dngTemplate.ImageDataStrips = tiles + previews
+    totalLength = dngTemplate.dataLen()
+    mainIFD.getTag(Tag.TileOffsets).setValue([dngTemplate.StripOffsets[i] for i in range(len(tiles))])
+    mainIFD.getTag(Tag.TileByteCounts).setValue([len(tile) for tile in tiles])
+    if previewIFD:
+        previewIFD.getTag(Tag.StripOffsets).setValue([dngTemplate.StripOffsets[len(tiles)]])
+
+    buf = bytearray(totalLength)
+    dngTemplate.setBuffer(buf)
+    dngTemplate.write()
+    return buf
 
 def creation_date(path_to_file):
     """
@@ -324,73 +1368,709 @@ def creation_date(path_to_file):
             # so we'll settle for when its content was last modified.
             return stat.st_mtime
 
-## Read the frame data out and convert it to 16-bpp
-def readFrame(file, width, length, bpp):
+## Whether the raw video is a stream (stdin, given as '-', or an open file
+## object) rather than a file on disk
+def isStream(inputFilename):
+    return inputFilename == '-' or hasattr(inputFilename, 'read')
+
+## Open the raw video for reading. Streams are read sequentially, a frame
+## at a time, as the data arrives.
+def openInput(inputFilename):
+    if hasattr(inputFilename, 'read'):
+        return inputFilename
+    if inputFilename == '-':
+        if platform.system() == 'Windows':
+            import msvcrt
+            msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        return getattr(sys.stdin, 'buffer', sys.stdin)
+    return open(inputFilename, "rb")
+
+## out = (src & mask) << shift, computed in place (negative shifts are right
+## shifts, and a mask of None leaves src unmasked)
+def maskShiftInto(out, src, mask, shift):
+    if mask is not None:
+        numpy.bitwise_and(src, mask, out=out)
+        src = out
+    if shift > 0:
+        numpy.left_shift(src, shift, out=out)
+    elif shift < 0:
+        numpy.right_shift(src, -shift, out=out)
+    elif src is not out:
+        numpy.copyto(out, src)
+
+## out = ((a & mask) << shift) | ((b & mask) << shift) for a and b given as
+## (src, mask, shift), using temp as scratch space so that no frame-sized
+## temporaries are allocated
+def combineInto(out, temp, a, b):
+    maskShiftInto(out, *a)
+    maskShiftInto(temp, *b)
+    numpy.bitwise_or(out, temp, out=out)
+
+## Unpack a 12-bpp packed frame into 16-bpp little-endian samples.
+## Each 3-byte group holds two pixels, which are left-justified to 16 bits.
+## The samples are written into out if given, a bytearray of 4 bytes per
+## group, and with numpy scratch is a bytearray of 8 bytes per group to
+## work in; either is allocated when not given.
+def unpackFrame12(packed, legacy=False, out=None, scratch=None):
+    groups = len(packed) // 3
+    if out is None:
+        out = bytearray(groups * 4)
+
+    if numpy is not None:
+        if scratch is None:
+            scratch = bytearray(groups * 8)
+        ## Widen the bytes to 16 bits in one pass, so the rest of the work
+        ## is done without casting.
+        pix = numpy.frombuffer(scratch, dtype=numpy.uint16, count=groups * 3).reshape(-1, 3)
+        numpy.copyto(pix, numpy.frombuffer(packed, dtype=numpy.uint8, count=groups * 3).reshape(-1, 3))
+        temp = numpy.frombuffer(scratch, dtype=numpy.uint16, count=groups, offset=groups * 6)
+        frame = numpy.frombuffer(out, dtype='<u2', count=groups * 2).reshape(-1, 2)
+        if legacy:
+            combineInto(frame[:,0], temp, (pix[:,2], None, 4), (pix[:,1], 0x0f, 12))
+            combineInto(frame[:,1], temp, (pix[:,0], None, 8), (pix[:,1], 0xf0, 0))
+        else:
+            combineInto(frame[:,0], temp, (pix[:,0], None, 4), (pix[:,1], 0xf0, 8))
+            combineInto(frame[:,1], temp, (pix[:,2], None, 8), (pix[:,1], 0x0f, 4))
+        return out
+
+    ## Pure-python fallback for machines without numpy.
+    pix = bytearray(packed)
+    frame = out
+    off = 0
+    for i in range(0, groups * 3, 3):
+        if legacy:
+            a = (pix[i+2] << 4) + ((pix[i+1] & 0x0f) << 12)
+            b = (pix[i+0] << 8) + ((pix[i+1] & 0xf0) << 0)
+        else:
+            a = (pix[i+0] << 4) + ((pix[i+1] & 0xf0) << 8)
+            b = (pix[i+2] << 8) + ((pix[i+1] & 0x0f) << 4)
+        frame[off + 0] = (a & 0x00ff) >> 0
+        frame[off + 1] = (a & 0xff00) >> 8
+        frame[off + 2] = (b & 0x00ff) >> 0
+        frame[off + 3] = (b & 0xff00) >> 8
+        off += 4
+
+    return frame
+
+## Size in bytes of one frame in the raw file
+def rawFrameSize(width, length, bpp):
+    if (bpp == 16):
+        return width * length * 2
+    else:
+        return (width * length * 3) // 2
+
+## Repack a 12-bpp packed frame into the 12-bpp packing used by DNG, where
+## each pair of samples is stored most significant bits first. out and
+## scratch are as for unpackFrame12, but of 3 bytes and 1 byte per group.
+def repackFrame12(packed, legacy=False, out=None, scratch=None):
+    groups = len(packed) // 3
+    if out is None:
+        out = bytearray(groups * 3)
+
+    if numpy is not None:
+        if scratch is None:
+            scratch = bytearray(groups)
+        pix = numpy.frombuffer(packed, dtype=numpy.uint8, count=groups * 3).reshape(-1, 3)
+        frame = numpy.frombuffer(out, dtype=numpy.uint8, count=groups * 3).reshape(-1, 3)
+        temp = numpy.frombuffer(scratch, dtype=numpy.uint8, count=groups)
+        if legacy:
+            combineInto(frame[:,0], temp, (pix[:,1], 0x0f, 4), (pix[:,2], 0xf0, -4))
+            combineInto(frame[:,1], temp, (pix[:,2], 0x0f, 4), (pix[:,0], 0xf0, -4))
+            combineInto(frame[:,2], temp, (pix[:,0], 0x0f, 4), (pix[:,1], 0xf0, -4))
+        else:
+            combineInto(frame[:,0], temp, (pix[:,1], 0xf0, 0), (pix[:,0], 0xf0, -4))
+            combineInto(frame[:,1], temp, (pix[:,0], 0x0f, 4), (pix[:,2], 0xf0, -4))
+            combineInto(frame[:,2], temp, (pix[:,2], 0x0f, 4), (pix[:,1], 0x0f, 0))
+        return out
+
+    ## Pure-python fallback for machines without numpy.
+    pix = bytearray(packed)
+    frame = out
+    for i in range(0, groups * 3, 3):
+        if legacy:
+            frame[i+0] = ((pix[i+1] & 0x0f) << 4) | (pix[i+2] >> 4)
+            frame[i+1] = ((pix[i+2] & 0x0f) << 4) | (pix[i+0] >> 4)
+            frame[i+2] = ((pix[i+0] & 0x0f) << 4) | (pix[i+1] >> 4)
+        else:
+            frame[i+0] = ((pix[i+1] & 0xf0) << 0) | (pix[i+0] >> 4)
+            frame[i+1] = ((pix[i+0] & 0x0f) << 4) | (pix[i+2] >> 4)
+            frame[i+2] = ((pix[i+2] & 0x0f) << 4) | (pix[i+1] & 0x0f)
+
+    return frame
+
+## Pack 16-bpp samples (left-justified 12-bit values) into the 12-bpp
+## packing used by DNG, writing into out if given, a bytearray of 3 bytes
+## for every 2 samples. Requires numpy.
+def packFrame12(frame, out=None, scratch=None):
+    groups = len(frame) // 4
+    if out is None:
+        out = bytearray(groups * 3)
+    if scratch is None:
+        scratch = bytearray(groups * 2)
+    samples = numpy.frombuffer(frame, dtype='<u2', count=groups * 2).reshape(-1, 2)
+    packed = numpy.frombuffer(out, dtype=numpy.uint8, count=groups * 3).reshape(-1, 3)
+    temp = numpy.frombuffer(scratch, dtype=numpy.uint16, count=groups)
+    numpy.right_shift(samples[:,0], 8, out=temp)
+    numpy.copyto(packed[:,0], temp, casting='unsafe')
+    numpy.bitwise_and(samples[:,0], 0xf0, out=temp)
+    numpy.copyto(packed[:,1], temp, casting='unsafe')
+    numpy.right_shift(samples[:,1], 12, out=temp)
+    numpy.bitwise_or(packed[:,1], temp, out=packed[:,1], casting='unsafe')
+    numpy.right_shift(samples[:,1], 4, out=temp)
+    numpy.copyto(packed[:,2], temp, casting='unsafe')
+    return out
+
+## Convert one frame of raw data to 16-bpp, or for a bitsPerSample of 12 to
+## the packed 12-bpp DNG layout. 12-bpp output needs packed input.
+## The output and scratch buffers come from pool, if given. corrections
+## (eg: a darkFrame) are applied to the samples of every frame.
+def convertFrame(data, bpp, bitsPerSample=16, stats=NO_STATS, frameNum=None, pool=None, corrections=()):
+    if corrections:
+        return correctFrame(data, bpp, bitsPerSample, stats, frameNum, pool, corrections)
+    if (bpp == 16):
+        return data
+
+    start = time.time()
+    groups = len(data) // 3
+    out = scratch = None
+    if pool is not None:
+        out = pool.get(groups * (3 if bitsPerSample == 12 else 4))
+        scratch = pool.get(groups * (1 if bitsPerSample == 12 else 8))
+    ## Legacy (and probably broken) 12-bpp unpacking for bpp == -12.
+    if (bitsPerSample == 12):
+        frame = repackFrame12(data, (bpp == -12), out, scratch)
+    else:
+        frame = unpackFrame12(data, (bpp == -12), out, scratch)
+    if pool is not None:
+        pool.put(scratch)
+    stats.record('unpack', frameNum, start, len(frame))
+    stats.hold(frameNum, len(frame))
+    return frame
+
+## Apply corrections to a frame as for convertFrame. They work on 16-bpp
+## samples, so 12-bpp output is unpacked and packed again around them, and
+## 16-bpp frames are copied unless they are already in a buffer of ours.
+def correctFrame(data, bpp, bitsPerSample, stats, frameNum, pool, corrections):
+    if (bpp != 16):
+        frame = convertFrame(data, bpp, 16, stats, frameNum, pool)
+    elif isinstance(data, bytearray):
+        frame = data
+    else:
+        frame = pool.get(len(data)) if pool is not None else bytearray(len(data))
+        frame[:] = data
+
+    start = time.time()
+    samples = numpy.frombuffer(frame, dtype='<u2')
+    for correction in corrections:
+        correction.apply(samples)
+    stats.record('correct', frameNum, start, len(frame))
+
+    if (bitsPerSample == 12):
+        groups = len(frame) // 4
+        out = scratch = None
+        if pool is not None:
+            out = pool.get(groups * 3)
+            scratch = pool.get(groups * 2)
+        packed = packFrame12(frame, out, scratch)
+        if pool is not None:
+            pool.put(scratch)
+            pool.put(frame)
+        return packed
+    return frame
+
+## Read the frame data out and convert it to 16-bpp (or packed 12-bpp)
+def readFrame(file, width, length, bpp, bitsPerSample=16, stats=NO_STATS):
     try:
-        if (bpp == 16):
-            return file.read(width*length*2)
-
-        elif (bpp == -12):
-            ## Legacy (and probably broken) 12-bpp unpacking.
-            frame = bytearray(width * length * 2)
-            for off in range(0, len(frame), 4):
-                pix = bytearray(file.read(3))
-                a = (pix[2] << 4) + ((pix[1] & 0x0f) << 12)
-                b = (pix[0] << 8) + ((pix[1] & 0xf0) << 0)
-                frame[off + 0] = (a & 0x00ff) >> 0
-                frame[off + 1] = (a & 0xff00) >> 8
-                frame[off + 2] = (b & 0x00ff) >> 0
-                frame[off + 3] = (b & 0xff00) >> 8
-
-            return frame
-
-        elif (bpp == 12):
-            ## Read and convert to 16-bpp.
-            frame = bytearray(width * length * 2)
-            for off in range(0, len(frame), 4):
-                pix = bytearray(file.read(3))
-                a = (pix[0] << 4) + ((pix[1] & 0xf0) << 8)
-                b = (pix[2] << 8) + ((pix[1] & 0x0f) << 4)
-                frame[off + 0] = (a & 0x00ff) >> 0
-                frame[off + 1] = (a & 0xff00) >> 8
-                frame[off + 2] = (b & 0x00ff) >> 0
-                frame[off + 3] = (b & 0xff00) >> 8
-            
-            return frame
+        ## Read the whole frame in one go.
+        start = time.time()
+        data = file.read(rawFrameSize(width, length, bpp))
+        stats.record('read', None, start, len(data))
+        if len(data) < rawFrameSize(width, length, bpp):
+            return None
+        return convertFrame(data, bpp, bitsPerSample, stats)
     
     except:
         return None
 
-def convertVideo(inputFilename, outputFilenameFormat, width, length, colour, bpp):
-    dngTemplate = DNG()
+class mmapFrameReader(object):
+    """
+    Random access to the frames of a raw file through a read-only memory map.
+    16-bpp frames are returned as zero-copy views into the map, so the pixel
+    data is only copied once on its way into the output DNG. Packed frames
+    are unpacked straight out of the map, or when given a pool, read into a
+    buffer from it, which avoids faulting in fresh pages of the map for
+    every frame.
+    """
+    def __init__(self, file, width, length, bpp, bitsPerSample=16, corrections=()):
+        self.file = file
+        self.width = width
+        self.length = length
+        self.bpp = bpp
+        self.bitsPerSample = bitsPerSample
+        self.corrections = corrections
+        self.frameSize = rawFrameSize(width, length, bpp)
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.frameCount = len(self.map) // self.frameSize
 
-    creationTime = creation_date(inputFilename)
-    creationTimeString = time.strftime("%x %X", time.localtime(creationTime))
+    def __len__(self):
+        return self.frameCount
 
-    # https://stackoverflow.com/questions/12517451/automatically-creating-directories-with-file-output
-    if not os.path.exists(os.path.dirname(outputFilenameFormat % (0))):
-        try:
-            os.makedirs(os.path.dirname(outputFilenameFormat % (0)))
-        except OSError as exc: # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
+    def frameOffset(self, frameNum):
+        return frameNum * self.frameSize
 
-    # set up the image binary data
-    rawFile = open(inputFilename, "rb")
-    rawFrame = readFrame(rawFile, width, length, bpp)
-    dngTemplate.ImageDataStrips.append(rawFrame)
+    def view(self, frameNum):
+        return mapSlice(self.map, self.frameOffset(frameNum), self.frameSize)
+
+    def frame(self, frameNum, stats=NO_STATS, pool=None):
+        start = time.time()
+        if (pool is None) or (self.bpp == 16):
+            # Mapping is close to free; the pages are read as they are touched.
+            data = self.view(frameNum)
+        else:
+            data = pool.get(self.frameSize)
+            self.file.seek(self.frameOffset(frameNum))
+            readInto(self.file, data)
+        stats.record('read', frameNum, start, self.frameSize)
+        frame = convertFrame(data, self.bpp, self.bitsPerSample, stats, frameNum, pool, self.corrections)
+        if (pool is not None) and (frame is not data):
+            pool.put(data)
+        return frame
+
+## Skip over count frames, by seeking if the file allows it
+def skipFrames(file, count, frameSize):
+    if count <= 0:
+        return
+    try:
+        file.seek(count * frameSize, os.SEEK_CUR)
+    except (IOError, OSError):
+        for i in range(count):
+            file.read(frameSize)
+
+## Read into buf until it is full or the file ends, returning the number of
+## bytes read
+def readInto(file, buf):
+    view = memoryview(buf)
+    done = 0
+    while done < len(buf):
+        count = file.readinto(view[done:])
+        if not count:
+            break
+        done += count
+    return done
+
+## Yield (frameNum, data) for the raw frames selected by frameSlice, reading
+## sequentially and skipping the frames in between (and any in skip). With a
+## pool, each frame is read into a buffer from it, which the caller puts
+## back once done with the frame.
+def readRawFrames(file, frameSize, frameSlice=None, stats=NO_STATS, skip=(), pool=None):
+    if frameSlice is None:
+        frameSlice = slice(None)
+    step = frameSlice.step or 1
+
+    frameNum = frameSlice.start or 0
+    skipFrames(file, frameNum, frameSize)
+    while (frameSlice.stop is None) or (frameNum < frameSlice.stop):
+        if frameNum in skip:
+            skipFrames(file, step, frameSize)
+            frameNum += step
+            continue
+        start = time.time()
+        if pool is not None:
+            data = pool.get(frameSize)
+            count = readInto(file, data)
+        else:
+            data = file.read(frameSize)
+            count = len(data)
+        stats.record('read', frameNum, start, count)
+        if count < frameSize:
+            return
+        stats.hold(frameNum, len(data))
+        yield frameNum, data
+        skipFrames(file, step - 1, frameSize)
+        frameNum += step
+
+## Yield (frameNum, frame) for the frames of a raw file selected by
+## frameSlice, using a memory map when the file allows it and falling back
+## to sequential reads otherwise (eg: empty files or pipes). Frames in skip
+## are left out. With a pool, frames are built in buffers from it, and the
+## caller puts each frame back into the pool once it is done with it.
+## corrections are applied to every frame, as for convertFrame.
+def frameSource(file, width, length, bpp, bitsPerSample=16, frameSlice=None, stats=NO_STATS, skip=(), pool=None, corrections=()):
+    if frameSlice is None:
+        frameSlice = slice(None)
+
+    try:
+        reader = mmapFrameReader(file, width, length, bpp, bitsPerSample, corrections)
+    except (ValueError, EnvironmentError):
+        reader = None
+
+    if reader is not None:
+        for frameNum in range(*frameSlice.indices(len(reader))):
+            if frameNum not in skip:
+                yield frameNum, reader.frame(frameNum, stats, pool)
+        # The map is released once the last view into it is dropped.
+        return
+
+    for frameNum, data in readRawFrames(file, rawFrameSize(width, length, bpp), frameSlice, stats, skip, pool):
+        frame = convertFrame(data, bpp, bitsPerSample, stats, frameNum, pool, corrections)
+        if (frame is not data) and (pool is not None):
+            pool.put(data)
+        yield frameNum, frame
+
+## CRC-32 of a frame's raw bytes, recorded in the manifest. It is cheap
+## enough to compute for every frame and still catches a changed source.
+def frameDigest(data):
+    return "%08x" % (zlib.crc32(data) & 0xffffffff)
+
+class conversionManifest(object):
+    """
+    Record of the frames a conversion has finished, so that an interrupted
+    conversion can pick up where it left off. Each line holds a frame number,
+    the file it was written to, the size of that file and the digest of the
+    frame's raw data. The first line holds the conversion settings, and a
+    manifest written with different settings cannot be resumed.
+    """
+    def __init__(self, filename, inputFilename, settings, resume=False):
+        self.filename = filename
+        self.done = {}
+        settings = dict(settings, inputSize=os.path.getsize(inputFilename))
+        header = "# pyraw2dng manifest " + json.dumps(settings, sort_keys=True) + "\n"
+
+        # An empty file can't be mapped, but then it has no frames either.
+        self.reader = None
+        if settings['inputSize']:
+            rawFile = open(inputFilename, "rb")
+            self.reader = mmapFrameReader(rawFile, settings['width'], settings['length'], settings['bpp'])
+            rawFile.close()
+
+        if resume and os.path.exists(filename):
+            manifestFile = open(filename, "r")
+            if manifestFile.readline() != header:
+                raise ValueError("%s was written by a conversion with different settings" % filename)
+            line = "\n"
+            stale = set()
+            for line in manifestFile:
+                try:
+                    frameNum, path, size, digest = line.rstrip("\n").split("\t")
+                    frameNum = int(frameNum)
+                    size = int(size)
+                except ValueError:
+                    continue # cut short by a crash
+                # Only trust frames whose output is still there, intact, and
+                # whose source hasn't changed since.
+                if not (os.path.exists(path) and os.path.getsize(path) == size):
+                    continue
+                if self.reader is None or frameNum >= len(self.reader) or \
+                   frameDigest(self.reader.view(frameNum)) != digest:
+                    stale.add(path)
+                    continue
+                self.done[frameNum] = (path, size, digest)
+            manifestFile.close()
+            # A clip file is rewritten whole, so none of its frames are done
+            # if any of them changed.
+            for frameNum, (path, size, digest) in list(self.done.items()):
+                if path in stale:
+                    del self.done[frameNum]
+            self.file = open(filename, "a")
+            if not line.endswith("\n"):
+                self.file.write("\n") # don't append to a line cut short
+        else:
+            self.file = open(filename, "w")
+            self.file.write(header)
+            self.file.flush()
+
+    def entry(self, frameNum, path):
+        return (frameNum, path, os.path.getsize(path), frameDigest(self.reader.view(frameNum)))
+
+    def add(self, entries):
+        """Record (frameNum, path, size, digest) entries for finished frames."""
+        for frameNum, path, size, digest in entries:
+            self.file.write("%d\t%s\t%d\t%s\n" % (frameNum, path, size, digest))
+            self.done[frameNum] = (path, size, digest)
+        self.file.flush()
+
+    def record(self, frameNum, path):
+        self.add([self.entry(frameNum, path)])
+
+    def close(self):
+        self.file.close()
+
+## Where calibrations are cached unless told otherwise
+def defaultCacheDir():
+    if platform.system() == 'Windows':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'pyraw2dng')
+
+## The size and modification time of each file, to tell whether a
+## calibration was made from the same files
+def fileSignatures(filenames):
+    return [[os.path.abspath(f), os.path.getsize(f), int(os.path.getmtime(f))] for f in filenames]
+
+class darkFrame(object):
+    """
+    The average of the frames of one or more dark clips (recorded with the
+    lens covered at the same resolution, gain and format as the video),
+    subtracted from every frame to remove the sensor's fixed pattern noise.
+    Samples are left-justified to 16 bits, the same as unpacked frames, and
+    subtraction saturates at zero. Requires numpy.
+    """
+    def __init__(self, width, length, bpp, gain, samples, frames=0, sources=()):
+        self.width = width
+        self.length = length
+        self.bpp = bpp
+        self.gain = gain
+        self.samples = samples
+        self.frames = frames
+        self.sources = list(sources)
+        self.digest = frameDigest(samples.tobytes())
+
+    def apply(self, samples):
+        """Subtract the dark frame from 16-bpp samples (a numpy array) in place."""
+        numpy.maximum(samples, self.samples, out=samples)
+        numpy.subtract(samples, self.samples, out=samples)
+
+    def header(self):
+        return {'width': self.width, 'length': self.length, 'format': rawFormatName(self.bpp), 'gain': self.gain,
+                'frames': self.frames, 'sources': self.sources}
+
+    def save(self, filename):
+        header = "# pyraw2dng dark " + json.dumps(self.header(), sort_keys=True) + "\n"
+        with atomicFile(filename) as fd:
+            writeBuffers(fd, [header.encode('ascii'), self.samples.astype('<u2').tobytes()])
+
+## Average every frame of the clips in filenames, returning the mean 16-bpp
+## samples (a flat numpy array) and the number of frames
+def averageFrames(filenames, width, length, bpp, stats=NO_STATS):
+    total = numpy.zeros(width * length, dtype=numpy.uint64)
+    frames = 0
+    pool = bufferPool()
+    for filename in filenames:
+        rawFile = open(filename, "rb")
+        for frameNum, frame in frameSource(rawFile, width, length, bpp, 16, stats=stats, pool=pool):
+            numpy.add(total, numpy.frombuffer(frame, dtype='<u2'), out=total)
+            pool.put(frame)
+            frames += 1
+        rawFile.close()
+    if not frames:
+        raise ValueError("no complete frames in %s" % ", ".join(filenames))
+    return ((total + frames // 2) // frames).astype(numpy.uint16), frames
+
+## Average every frame of the dark clips in filenames into a darkFrame
+def averageDarkFrames(filenames, width, length, bpp, gain, stats=NO_STATS):
+    samples, frames = averageFrames(filenames, width, length, bpp, stats)
+    return darkFrame(width, length, bpp, gain, samples, frames, fileSignatures(filenames))
+
+## Read a darkFrame saved by darkFrame.save
+def loadDarkFrame(filename):
+    darkFile = open(filename, "rb")
+    line = darkFile.readline().decode('ascii')
+    if not line.startswith("# pyraw2dng dark "):
+        raise ValueError("%s is not a dark frame calibration" % filename)
+    header = json.loads(line[len("# pyraw2dng dark "):])
+    data = darkFile.read()
+    darkFile.close()
+    if len(data) != header['width'] * header['length'] * 2:
+        raise ValueError("%s is cut short" % filename)
+    samples = numpy.frombuffer(data, dtype='<u2').astype(numpy.uint16)
+    return darkFrame(header['width'], header['length'], rawFormatBpp(header['format']), header['gain'], samples,
+                     header['frames'], header['sources'])
+
+## Cached calibrations are named after the camera setup they are for
+def darkCacheFilename(cacheDir, width, length, bpp, gain):
+    return os.path.join(cacheDir, "dark_%dx%d_%s_gain%s.cal" % (width, length, rawFormatName(bpp), gain))
+
+## The darkFrame for a camera setup, averaged from the dark clips in
+## filenames or, if the cache in cacheDir already holds one made from those
+## same files, read from there. Without filenames, whatever calibration the
+## cache holds for the setup is used. Returns the darkFrame and whether it
+## came from the cache.
+def calibrateDark(filenames, width, length, bpp, gain, cacheDir=None, stats=NO_STATS):
+    if cacheDir is None:
+        cacheDir = defaultCacheDir()
+    cacheFilename = darkCacheFilename(cacheDir, width, length, bpp, gain)
+
+    if os.path.exists(cacheFilename):
+        dark = loadDarkFrame(cacheFilename)
+        if not filenames or dark.sources == fileSignatures(filenames):
+            return dark, True
+    elif not filenames:
+        raise ValueError("no dark frame is cached for %dx%d video in the %s format at gain %s, give the dark clips to average" %
+                         (width, length, rawFormatName(bpp), gain))
+
+    dark = averageDarkFrames(filenames, width, length, bpp, gain, stats)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    dark.save(cacheFilename)
+    return dark, False
+
+## Same-colour neighbours used to replace a defective pixel, as (dx, dy)
+## offsets. Every rule lists four, repeating them where it has fewer, so
+## that all defects are corrected together. The diagonals are only the same
+## colour for the green pixels of the CFA (and for mono sensors).
+DEFECT_RULES = {
+    'hv': [(-2, 0), (2, 0), (0, -2), (0, 2)],
+    'h':  [(-2, 0), (2, 0), (-2, 0), (2, 0)],
+    'v':  [(0, -2), (0, 2), (0, -2), (0, 2)],
+    'd':  [(-1, -1), (1, -1), (-1, 1), (1, 1)],
+}
+
+## Offset val by delta, stepping the other way instead at the edges of the
+## frame so that the neighbour keeps its CFA colour (as demConstrain does
+## in the demosaic scripts)
+def defectNeighbour(val, delta, limit):
+    if 0 <= val + delta < limit:
+        return val + delta
+    return min(max(val - delta, 0), limit - 1)
+
+class defectMap(object):
+    """
+    A sparse list of hot and dead pixels, each with the rule (a key of
+    DEFECT_RULES) choosing the same-colour neighbours it is replaced with.
+    Correcting a frame only touches the listed pixels, so it costs nothing
+    like a pass over the whole frame. Requires numpy.
+    """
+    def __init__(self, width, length, colour, defects, header=None):
+        self.width = width
+        self.length = length
+        self.colour = colour
+        self.defects = sorted(defects, key=lambda d: (d[1], d[0]))
+        self.header = header or {}
+        self.indices = numpy.array([y * width + x for x, y, rule in self.defects], dtype=numpy.intp)
+        self.neighbours = numpy.array([[defectNeighbour(y, dy, length) * width + defectNeighbour(x, dx, width)
+                                        for dx, dy in DEFECT_RULES[rule]]
+                                       for x, y, rule in self.defects], dtype=numpy.intp).reshape(-1, 4)
+        self.digest = frameDigest(self.indices.tobytes() + self.neighbours.tobytes())
+
+    def __len__(self):
+        return len(self.defects)
+
+    def apply(self, samples):
+        """Replace the defective pixels of 16-bpp samples (a numpy array) in place."""
+        if len(self.defects):
+            values = samples[self.neighbours].sum(axis=1, dtype=numpy.uint32)
+            samples[self.indices] = (values + 2) // 4
+
+    def save(self, filename):
+        header = dict(self.header, width=self.width, length=self.length, colour=self.colour)
+        lines = ["# pyraw2dng defects " + json.dumps(header, sort_keys=True) + "\n"]
+        lines.extend("%d\t%d\t%s\n" % defect for defect in self.defects)
+        with atomicFile(filename) as fd:
+            writeBuffers(fd, ["".join(lines).encode('ascii')])
+
+## Read a defectMap saved by defectMap.save. Each line after the header is
+## the x and y of a defective pixel and its rule, separated by whitespace,
+## so defects can be added by hand (without a rule, hv is used).
+def loadDefectMap(filename):
+    mapFile = open(filename, "r")
+    line = mapFile.readline()
+    if not line.startswith("# pyraw2dng defects "):
+        raise ValueError("%s is not a defect map" % filename)
+    header = json.loads(line[len("# pyraw2dng defects "):])
+    defects = []
+    for line in mapFile:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        x, y = int(fields[0]), int(fields[1])
+        rule = fields[2] if len(fields) > 2 else 'hv'
+        if not (0 <= x < header['width'] and 0 <= y < header['length']) or rule not in DEFECT_RULES:
+            raise ValueError("%s: bad defect %s" % (filename, line.strip()))
+        defects.append((x, y, rule))
+    mapFile.close()
+    return defectMap(header['width'], header['length'], header['colour'], defects, header)
+
+## Median of the four same-colour neighbours at +-2 of every pixel of a
+## (length, width) frame
+def neighbourMedian(frame):
+    length, width = frame.shape
+    xs = numpy.array([[defectNeighbour(x, dx, width) for x in range(width)] for dx in (-2, 2)])
+    ys = numpy.array([[defectNeighbour(y, dy, length) for y in range(length)] for dy in (-2, 2)])
+    neighbours = numpy.stack([frame[:, xs[0]], frame[:, xs[1]], frame[ys[0], :], frame[ys[1], :]])
+    return numpy.median(neighbours, axis=0)
+
+## Choose the replacement rule for a defect, avoiding neighbours that are
+## themselves defective where possible
+def defectRule(x, y, width, length, colour, defective):
+    rules = ['hv', 'h', 'v']
+    if not colour or (x + y) % 2 == 0:
+        rules.insert(1, 'd') # green, or mono
+    for rule in rules:
+        if not any(defective[defectNeighbour(y, dy, length), defectNeighbour(x, dx, width)] for dx, dy in DEFECT_RULES[rule]):
+            return rule
+    return 'hv'
+
+## Find the defective pixels of a sensor from the average of dark clips
+## (hot pixels, which stand out from their neighbours by more than
+## darkSigmas times the spread of the whole frame) and of evenly lit flat
+## clips (pixels whose response differs from their neighbours' by more
+## than flatTolerance, as a fraction). Either list of clips may be empty.
+## Returns a defectMap.
+def findDefects(darkFilenames, flatFilenames, width, length, bpp, colour=True, darkSigmas=10.0, flatTolerance=0.25,
+                stats=NO_STATS):
+    defective = numpy.zeros((length, width), dtype=bool)
+    header = {'format': rawFormatName(bpp), 'darkSigmas': darkSigmas, 'flatTolerance': flatTolerance}
+    dark = None
+
+    if darkFilenames:
+        samples, frames = averageFrames(darkFilenames, width, length, bpp, stats)
+        dark = samples.reshape(length, width).astype(numpy.float64)
+        deviation = dark - neighbourMedian(dark)
+        spread = 1.4826 * numpy.median(numpy.abs(deviation - numpy.median(deviation)))
+        hot = deviation > max(darkSigmas * spread, 16.0)
+        defective |= hot
+        header['hot'] = int(hot.sum())
+        header['darkFrames'] = frames
+
+    if flatFilenames:
+        samples, frames = averageFrames(flatFilenames, width, length, bpp, stats)
+        flat = samples.reshape(length, width).astype(numpy.float64)
+        if dark is not None:
+            flat = numpy.maximum(flat - dark, 0)
+        expected = neighbourMedian(flat)
+        response = flat / numpy.maximum(expected, 1.0)
+        bad = (numpy.abs(response - 1.0) > flatTolerance) & (expected > 0)
+        defective |= bad
+        header['flat'] = int(bad.sum())
+        header['flatFrames'] = frames
+
+    ys, xs = numpy.nonzero(defective)
+    defects = [(int(x), int(y), defectRule(x, y, width, length, colour, defective)) for x, y in zip(xs, ys)]
+    return defectMap(width, length, colour, defects, header)
+
+## Build the DNG template for one frame of video. Returns the template along
+## with the buffer it serializes into; only the strip data changes per frame.
+## With a tileSize the image is stored as lossless JPEG compressed tiles,
+## whose offsets and sizes must be filled in for each frame. bitsPerSample
+## is 16 for left-justified samples or 12 for 12-bpp data. With a preview,
+## IFD0 holds an 8-bit RGB preview and the raw image moves to a SubIFD, the
+## same layout as raw2dng; the preview strip follows the raw image data.
+def buildDNG(width, length, colour, creationTimeString, tileSize=0, bitsPerSample=16, preview=False, digester=None):
+    dngTemplate = DNG()
 
     # set up the FULL IFD
     mainIFD = dngIFD()
-    mainTagStripOffset = dngTag(Tag.StripOffsets, [0])
+    if tileSize:
+        tileCount = ((width + tileSize - 1) // tileSize) * ((length + tileSize - 1) // tileSize)
+        dngTemplate.ImageDataStrips = [b''] * tileCount
+        mainTagStripOffset = dngTag(Tag.TileOffsets, [0] * tileCount)
+        mainIFD.tags.append(dngTag(Tag.TileByteCounts       , [0] * tileCount))
+        mainIFD.tags.append(dngTag(Tag.TileWidth            , [tileSize]))
+        mainIFD.tags.append(dngTag(Tag.TileLength           , [tileSize]))
+        mainIFD.tags.append(dngTag(Tag.Compression          , [7])) # lossless JPEG
+    else:
+        # placeholder for the image binary data
+        dngTemplate.ImageDataStrips.append(bytearray((width*length*bitsPerSample) // 8))
+        mainTagStripOffset = dngTag(Tag.StripOffsets, [0])
+        mainIFD.tags.append(dngTag(Tag.StripByteCounts      , [(width*length*bitsPerSample) // 8]))
+        mainIFD.tags.append(dngTag(Tag.RowsPerStrip         , [length]))
+        mainIFD.tags.append(dngTag(Tag.Compression          , [1])) # uncompressed
     mainIFD.tags.append(dngTag(Tag.NewSubfileType           , [0]))
-    mainIFD.tags.append(dngTag(Tag.StripByteCounts          , [width*length*2]))
     mainIFD.tags.append(dngTag(Tag.ImageWidth               , [width]))
     mainIFD.tags.append(dngTag(Tag.ImageLength              , [length]))
     mainIFD.tags.append(dngTag(Tag.SamplesPerPixel          , [1]))
-    mainIFD.tags.append(dngTag(Tag.BitsPerSample            , [16]))
-    mainIFD.tags.append(dngTag(Tag.RowsPerStrip             , [length]))
-    mainIFD.tags.append(dngTag(Tag.Compression              , [1])) # uncompressed
+    mainIFD.tags.append(dngTag(Tag.BitsPerSample            , [bitsPerSample]))
     
     if (colour):
         mainIFD.tags.append(dngTag(Tag.PhotometricInterpretation, [32803])) # bayer - i think
@@ -402,45 +2082,646 @@ def convertVideo(inputFilename, outputFilenameFormat, width, length, colour, bpp
     mainIFD.tags.append(mainTagStripOffset)
     mainIFD.tags.append(dngTag(Tag.PlanarConfiguration      , [1]))
     
-    mainIFD.tags.append(dngTag(Tag.WhiteLevel               , [65520]))
+    mainIFD.tags.append(dngTag(Tag.WhiteLevel               , [65520 if bitsPerSample == 16 else 4095]))
+
+    # set up the preview IFD, which takes over the camera-wide tags
+    rawStrips = len(dngTemplate.ImageDataStrips)
+    if preview:
+        previewWidth = width >> 4
+        previewLength = length >> 4
+        dngTemplate.ImageDataStrips.append(bytearray(previewWidth*previewLength*3))
+
+        topIFD = dngIFD()
+        previewTagStripOffset = dngTag(Tag.StripOffsets, [0])
+        topIFD.tags.append(dngTag(Tag.NewSubfileType            , [1])) # reduced resolution
+        topIFD.tags.append(dngTag(Tag.ImageWidth                , [previewWidth]))
+        topIFD.tags.append(dngTag(Tag.ImageLength               , [previewLength]))
+        topIFD.tags.append(dngTag(Tag.BitsPerSample             , [8, 8, 8]))
+        topIFD.tags.append(dngTag(Tag.Compression               , [1])) # uncompressed
+        topIFD.tags.append(dngTag(Tag.PhotometricInterpretation , [2])) # RGB
+        topIFD.tags.append(previewTagStripOffset)
+        topIFD.tags.append(dngTag(Tag.SamplesPerPixel           , [3]))
+        topIFD.tags.append(dngTag(Tag.RowsPerStrip              , [previewLength]))
+        topIFD.tags.append(dngTag(Tag.StripByteCounts           , [previewWidth*previewLength*3]))
+        topIFD.tags.append(dngTag(Tag.PlanarConfiguration       , [1]))
+        topIFD.tags.append(dngTag(Tag.SubIFD                    , [mainIFD]))
+    else:
+        topIFD = mainIFD
     
-    mainIFD.tags.append(dngTag(Tag.Make                     , "Kron Technologies"))
-    mainIFD.tags.append(dngTag(Tag.Model                    , "Chronos 1.4"))
-    mainIFD.tags.append(dngTag(Tag.DateTime                 , creationTimeString))
-    mainIFD.tags.append(dngTag(Tag.Software                 , "pyraw2dng"))
-    mainIFD.tags.append(dngTag(Tag.Orientation              , [1]))
+    topIFD.tags.append(dngTag(Tag.Make                      , "Kron Technologies"))
+    topIFD.tags.append(dngTag(Tag.Model                     , "Chronos 1.4"))
+    topIFD.tags.append(dngTag(Tag.DateTime                  , creationTimeString))
+    topIFD.tags.append(dngTag(Tag.Software                  , "pyraw2dng"))
+    topIFD.tags.append(dngTag(Tag.Orientation               , [1]))
     
-    mainIFD.tags.append(dngTag(Tag.DNGVersion               , [1, 1, 0, 0]))
-    mainIFD.tags.append(dngTag(Tag.DNGBackwardVersion       , [1, 0, 0, 0]))
-    mainIFD.tags.append(dngTag(Tag.UniqueCameraModel        , "Krontech Chronos 1.4"))
-    mainIFD.tags.append(dngTag(Tag.ColorMatrix1             , [[15407, 10000], [-3218, 10000], [-1652, 10000],	#CIECAM16 color matrix for LUX1310, D55 illuminant
+    if digester is not None:
+        # NewRawImageDigest first appeared in DNG 1.4
+        topIFD.tags.append(dngTag(Tag.DNGVersion            , [1, 4, 0, 0]))
+        topIFD.tags.append(dngTag(Tag.NewRawImageDigest     , [0] * 16)) # filled in for each frame
+        topIFD.tags.append(dngTag(Tag.RawDataUniqueID       , [0] * 16))
+        dngTemplate.digester = digester
+    else:
+        topIFD.tags.append(dngTag(Tag.DNGVersion            , [1, 1, 0, 0]))
+    topIFD.tags.append(dngTag(Tag.DNGBackwardVersion        , [1, 0, 0, 0]))
+    topIFD.tags.append(dngTag(Tag.UniqueCameraModel         , "Krontech Chronos 1.4"))
+    topIFD.tags.append(dngTag(Tag.ColorMatrix1              , [[15407, 10000], [-3218, 10000], [-1652, 10000],	#CIECAM16 color matrix for LUX1310, D55 illuminant
                                                                [-3799, 10000], [13260, 10000], [-408, 10000],
                                                                [-3047, 10000], [ 6673, 10000], [ 6774, 10000]]))
-    mainIFD.tags.append(dngTag(Tag.AsShotNeutral            , [[10000, 15150], [10000, 10000], [10000, 11048]]))
-    mainIFD.tags.append(dngTag(Tag.CalibrationIlluminant1   , [20]))
+    topIFD.tags.append(dngTag(Tag.AsShotNeutral             , [[10000, 15150], [10000, 10000], [10000, 11048]]))
+    topIFD.tags.append(dngTag(Tag.CalibrationIlluminant1    , [20]))
 
-    dngTemplate.IFDs.append(mainIFD)
+    dngTemplate.IFDs.append(topIFD)
 
     totalLength = dngTemplate.dataLen()
     # this must happen after dataLen is calculated! (dataLen caches the offsets)
-    mainTagStripOffset.setValue([dngTemplate.StripOffsets[0]])
+    mainTagStripOffset.setValue([dngTemplate.StripOffsets[i] for i in range(rawStrips)])
+    if preview:
+        previewTagStripOffset.setValue([dngTemplate.StripOffsets[rawStrips]])
 
     buf = bytearray(totalLength)
     dngTemplate.setBuffer(buf)
 
-    frameNum = 0
-    while(rawFrame):
-        dngTemplate.ImageDataStrips[0] = rawFrame
-        dngTemplate.write()
+    return dngTemplate, buf
+
+## Worker process for parallel conversion. Converts a contiguous run of
+## frames, seeking straight to each one in the raw file, and wraps the pixel
+## data in the compiled template. trace is None when instrumentation is off,
+## otherwise the worker returns its conversionStats. With digest set, it also
+## returns manifest entries for the frames it wrote.
+def convertFrames(task):
+    inputFilename, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, corrections, trace, digest, frameNums = task
+    stats = NO_STATS if trace is None else conversionStats(trace)
+    entries = []
+
+    rawFile = open(inputFilename, "rb")
+    reader = mmapFrameReader(rawFile, width, length, bpp, bitsPerSample, corrections)
+    pool = bufferPool()
+    for frameNum in frameNums:
+        filename = outputFilenameFormat % frameNum
+        if canCopyFrames(bpp, preview, corrections, compiled.digester):
+            compiled.copyFile(filename, rawFile.fileno(), reader.frameOffset(frameNum), stats, frameNum)
+        else:
+            frame = reader.frame(frameNum, stats, pool)
+            compiled.writeFile(filename, frameStrips(frame, preview, stats, frameNum), stats, frameNum)
+            pool.put(frame)
+        if digest:
+            entries.append((frameNum, filename, os.path.getsize(filename), frameDigest(reader.view(frameNum))))
+
+    rawFile.close()
+    return (None if trace is None else stats), entries
+
+## 16-bpp frames go into the DNG unchanged, so without a preview to compute,
+## corrections to apply or digests to take they can be copied straight from
+## the raw file by the kernel.
+def canCopyFrames(bpp, preview, corrections=(), digester=None):
+    return (bpp == 16) and (preview is None) and not corrections and (digester is None) and bool(kernelCopies)
+
+## Write each frame by copying its data from the raw file inside the kernel,
+## so the pixels never pass through python.
+def convertVideoCopy(rawFile, outputFilenameFormat, width, length, compiled, frameSlice, stats=NO_STATS, manifest=None):
+    frameSize = rawFrameSize(width, length, 16)
+    frameCount = os.fstat(rawFile.fileno()).st_size // frameSize
+    for frameNum in range(*frameSlice.indices(frameCount)):
+        if manifest is not None and frameNum in manifest.done:
+            continue
+        compiled.copyFile(outputFilenameFormat % frameNum, rawFile.fileno(), frameNum * frameSize, stats, frameNum)
+        if manifest is not None:
+            manifest.record(frameNum, outputFilenameFormat % frameNum)
+
+## Number of frames handed to a worker process at a time.
+PARALLEL_CHUNK_FRAMES = 32
+
+def convertVideoParallel(inputFilename, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, jobs, frameSlice,
+                         stats=NO_STATS, manifest=None, corrections=()):
+    import multiprocessing
+
+    frameCount = os.path.getsize(inputFilename) // rawFrameSize(width, length, bpp)
+    frameNums = list(range(*frameSlice.indices(frameCount)))
+    if manifest is not None:
+        frameNums = [frameNum for frameNum in frameNums if frameNum not in manifest.done]
+    trace = None if stats is NO_STATS else (stats.events is not None)
+    tasks = ((inputFilename, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, corrections, trace,
+              manifest is not None, frameNums[start:start + PARALLEL_CHUNK_FRAMES])
+             for start in range(0, len(frameNums), PARALLEL_CHUNK_FRAMES))
+
+    # Each worker holds a single frame at a time, so memory use is bounded
+    # by the number of jobs regardless of the length of the video.
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for workerStats, entries in pool.imap_unordered(convertFrames, tasks):
+            if workerStats is not None:
+                stats.merge(workerStats)
+            if manifest is not None:
+                manifest.add(entries)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+class pipelineStage(object):
+    """
+    Counters for one thread of the pipelined converter. A stage that is often
+    starved is waiting on the stage before it, and a stage that is often
+    blocked is waiting on the stage after it.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.starved = 0
+        self.starvedTime = 0.0
+        self.blocked = 0
+        self.blockedTime = 0.0
+
+    def __str__(self):
+        return "%-8s %6d frames, starved %6d times (%7.2fs), blocked %6d times (%7.2fs)" % (
+            self.name, self.frames, self.starved, self.starvedTime, self.blocked, self.blockedTime)
+
+## Convert with separate reader, converter and writer threads joined by
+## queues of at most queueDepth frames, so disk reads, unpacking and disk
+## writes overlap. Returns the pipelineStage counters for each thread.
+def convertVideoPipelined(rawFile, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, queueDepth, frameSlice,
+                          stats=NO_STATS, manifest=None, corrections=()):
+    readStage = pipelineStage("read")
+    convertStage = pipelineStage("convert")
+    writeStage = pipelineStage("write")
+    readQueue = queue.Queue(queueDepth)
+    writeQueue = queue.Queue(queueDepth)
+    abort = threading.Event()
+    errors = []
+    # Frames go back into the pool once written, so the number of buffers
+    # in use is bounded by the queue depths.
+    pool = bufferPool()
+
+    def put(stage, q, item):
+        try:
+            q.put_nowait(item)
+            return True
+        except queue.Full:
+            stage.blocked += 1
+        start = time.time()
+        try:
+            while not abort.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            stage.blockedTime += time.time() - start
+
+    def get(stage, q):
+        try:
+            return q.get_nowait()
+        except queue.Empty:
+            stage.starved += 1
+        start = time.time()
+        try:
+            while not abort.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+        finally:
+            stage.starvedTime += time.time() - start
 
-        outfile = open(outputFilenameFormat % frameNum, "wb")
-        outfile.write(buf)
-        outfile.close()
+    def reader():
+        skip = manifest.done if manifest is not None else ()
+        for item in readRawFrames(rawFile, rawFrameSize(width, length, bpp), frameSlice, stats, skip, pool):
+            if not put(readStage, readQueue, item):
+                return
+            readStage.frames += 1
+        put(readStage, readQueue, None)
 
-        # go onto next frame
-        rawFrame = readFrame(rawFile, width, length, bpp)
-        frameNum += 1
+    def converter():
+        while True:
+            item = get(convertStage, readQueue)
+            if item is None:
+                break
+            frameNum, packed = item
+            frame = convertFrame(packed, bpp, bitsPerSample, stats, frameNum, pool, corrections)
+            if frame is not packed:
+                pool.put(packed)
+            strips = frameStrips(frame, preview, stats, frameNum)
+            if not put(convertStage, writeQueue, (frameNum, strips)):
+                return
+            convertStage.frames += 1
+        put(convertStage, writeQueue, None)
+
+    def writer():
+        while True:
+            item = get(writeStage, writeQueue)
+            if item is None:
+                break
+            frameNum, strips = item
+            compiled.writeFile(outputFilenameFormat % frameNum, strips, stats, frameNum)
+            pool.put(strips[0])
+            if manifest is not None:
+                manifest.record(frameNum, outputFilenameFormat % frameNum)
+            writeStage.frames += 1
+
+    def run(target):
+        try:
+            target()
+        except:
+            errors.append(sys.exc_info()[1])
+            abort.set()
 
+    threads = [threading.Thread(target=run, args=(t,)) for t in (reader, converter, writer)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return [readStage, convertStage, writeStage]
+
+## Two components would predict each CFA sample from the previous one of the
+## same colour, but LibRaw misreads those when the image is exactly two
+## tiles wide, so compressed tiles stick to a single component.
+LJ92_COMPONENTS = 1
+
+## Write lossless JPEG compressed DNGs, encoding the tiles of each frame on
+## a pool of threads (numpy releases the GIL for most of the work)
+def convertVideoCompressed(rawFile, outputFilenameFormat, width, length, bpp, bitsPerSample, dngTemplate, preview, tileSize, threads, frameSlice,
+                           stats=NO_STATS, manifest=None, corrections=()):
+    from multiprocessing.pool import ThreadPool
+
+    def encoder(frameNum):
+        def encode(tile):
+            start = time.time()
+            data = encodeLJ92(tile, LJ92_COMPONENTS, bitsPerSample)
+            stats.record('compress', frameNum, start, len(data))
+            stats.hold(frameNum, len(data))
+            return data
+        return encode
+
+    skip = manifest.done if manifest is not None else ()
+    buffers = bufferPool()
+    pool = ThreadPool(threads)
+    try:
+        for frameNum, rawFrame in frameSource(rawFile, width, length, bpp, 16, frameSlice, stats, skip, buffers, corrections):
+            tiles = pool.map(encoder(frameNum), frameTiles(rawFrame, width, length, tileSize, bitsPerSample))
+            previews = frameStrips(rawFrame, preview, stats, frameNum)[1:]
+            digests = None
+            if dngTemplate.digester is not None:
+                start = time.time()
+                digests = dngTemplate.digester.frameDigests(rawFrame, frameNum)
+                stats.record('digest', frameNum, start, len(rawFrame))
+            writeTiledDNG(outputFilenameFormat % frameNum, dngTemplate, tiles, previews, stats, frameNum, digests)
+            buffers.put(rawFrame)
+            if manifest is not None:
+                manifest.record(frameNum, outputFilenameFormat % frameNum)
+    finally:
+        pool.close()
+        pool.join()
+
+def makeOutputDir(outputFilenameFormat):
+    # https://stackoverflow.com/questions/12517451/automatically-creating-directories-with-file-output
+    if not os.path.exists(os.path.dirname(outputFilenameFormat % (0))):
+        try:
+            os.makedirs(os.path.dirname(outputFilenameFormat % (0)))
+        except OSError as exc: # Guard against race condition
+            if exc.errno != errno.EEXIST:
+                raise
+
+## Write the video as clip files holding clipFrames frames each (or as many
+## as fit, if clipFrames is None), named after their first frame.
+def convertVideoClips(rawFile, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, clipFrames, frameSlice,
+                      stats=NO_STATS, manifest=None, corrections=()):
+    writer = clipWriter(compiled)
+    if not clipFrames or clipFrames > writer.maxFrames():
+        clipFrames = writer.maxFrames()
+
+    skip = manifest.done if manifest is not None else ()
+    pool = bufferPool()
+    frames = ((frameNum, frameStrips(rawFrame, preview, stats, frameNum))
+              for frameNum, rawFrame in frameSource(rawFile, width, length, bpp, bitsPerSample, frameSlice, stats, skip, pool, corrections))
+    firstFrame = next(frames, None)
+    while firstFrame:
+        filename = outputFilenameFormat % firstFrame[0]
+        chunk = itertools.chain([firstFrame], itertools.islice(frames, clipFrames - 1))
+        frameNums = writer.write(filename, chunk, stats, pool)
+        if manifest is not None:
+            # The frames of a clip are only done once the whole file is.
+            manifest.add([manifest.entry(frameNum, filename) for frameNum in frameNums])
+        firstFrame = next(frames, None)
+
+## frameSlice selects the frames to convert, by default all of them. Output
+## files are numbered by their frame number in the raw file. Pass a
+## conversionStats as stats to time each stage of the conversion, and a
+## conversionManifest as manifest to record finished frames and skip any
+## it already lists. inputFilename may also be '-' for stdin or an open
+## file object, in which case creationTime (seconds since the epoch, by
+## default the file's creation time) defaults to now. corrections (eg: a
+## darkFrame) are applied to every frame. With digests set, each DNG records
+## the NewRawImageDigest and RawDataUniqueID of its raw image.
+def convertVideo(inputFilename, outputFilenameFormat, width, length, colour, bpp, jobs=1, queueDepth=0, clipFrames=0, tileSize=0,
+                 bitsPerSample=16, frameSlice=None, preview=False, stats=None, manifest=None, creationTime=None, corrections=(),
+                 digests=False):
+    if frameSlice is None:
+        frameSlice = slice(None)
+    if stats is None:
+        stats = NO_STATS
+    if (frameSlice.start or 0) < 0 or (frameSlice.stop or 0) < 0 or (frameSlice.step or 1) < 1:
+        raise ValueError("frame range must be positive")
+    if (bitsPerSample == 12) and (bpp == 16):
+        raise ValueError("12-bit output requires 12-bit packed input")
+    if (tileSize or preview or corrections or digests) and numpy is None:
+        raise RuntimeError("compressed output, previews, corrections and digests require numpy")
+    if tileSize:
+        if tileSize % 16:
+            raise ValueError("compressed output needs a tile size that is a multiple of 16")
+        if clipFrames != 0 or queueDepth:
+            raise ValueError("compressed output cannot be used with clips or queues")
+    elif (jobs > 1) and queueDepth and (clipFrames == 0):
+        raise ValueError("parallel conversion cannot be used with a queue, use either --jobs or --queue")
+    if isStream(inputFilename):
+        if (jobs > 1) and not tileSize and (clipFrames == 0):
+            raise ValueError("parallel conversion needs an input file, drop --jobs and use --queue to overlap reading a stream with conversion")
+        if manifest is not None:
+            raise ValueError("resuming needs an input file")
+
+    if creationTime is None:
+        creationTime = time.time() if isStream(inputFilename) else creation_date(inputFilename)
+    creationTimeString = time.strftime("%x %X", time.localtime(creationTime))
+
+    makeOutputDir(outputFilenameFormat)
+
+    digester = None
+    if digests:
+        # worker processes already keep every core busy
+        parallel = (jobs > 1) and not tileSize and (clipFrames == 0)
+        digester = rawImageDigest(width, length, bitsPerSample, 1 if parallel else 0)
+
+    dngTemplate, buf = buildDNG(width, length, colour, creationTimeString, tileSize, bitsPerSample, preview, digester)
+    if preview:
+        # compressed output is tiled from 16-bpp frames
+        preview = previewBuilder(width, length, colour, 16 if tileSize else bitsPerSample)
+    else:
+        preview = None
+
+    if tileSize:
+        rawFile = openInput(inputFilename)
+        convertVideoCompressed(rawFile, outputFilenameFormat, width, length, bpp, bitsPerSample, dngTemplate, preview, tileSize, jobs, frameSlice,
+                               stats, manifest, corrections)
+        return
+
+    compiled = dngTemplate.compile()
+
+    if (jobs > 1) and (clipFrames == 0):
+        convertVideoParallel(inputFilename, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, jobs, frameSlice,
+                             stats, manifest, corrections)
+        return
+
+    # set up the image binary data
+    rawFile = openInput(inputFilename)
+
+    if (clipFrames != 0):
+        convertVideoClips(rawFile, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, clipFrames, frameSlice,
+                          stats, manifest, corrections)
+        return
+
+    if (queueDepth > 0):
+        return convertVideoPipelined(rawFile, outputFilenameFormat, width, length, bpp, bitsPerSample, compiled, preview, queueDepth, frameSlice,
+                                     stats, manifest, corrections)
+
+    if canCopyFrames(bpp, preview, corrections, digester) and not isStream(inputFilename):
+        convertVideoCopy(rawFile, outputFilenameFormat, width, length, compiled, frameSlice, stats, manifest)
+        return
+
+    skip = manifest.done if manifest is not None else ()
+    pool = bufferPool()
+    frames = frameSource(rawFile, width, length, bpp, bitsPerSample, frameSlice, stats, skip, pool, corrections)
+
+    for frameNum, rawFrame in frames:
+        compiled.writeFile(outputFilenameFormat % frameNum, frameStrips(rawFrame, preview, stats, frameNum), stats, frameNum)
+        pool.put(rawFrame)
+        if manifest is not None:
+            manifest.record(frameNum, outputFilenameFormat % frameNum)
+
+
+## Raw formats by name, for job files and sidecars
+RAW_FORMATS = {'16': 16, 'packed': 12, 'legacy': -12}
+
+class batchClip(object):
+    """
+    One raw video in a batch conversion: its frame geometry and format, where
+    its DNGs go, and how far its conversion has got.
+    """
+    def __init__(self, inputFilename, width, length, bpp=16, colour=True, outputFilenameFormat=None):
+        if outputFilenameFormat is None:
+            outputFilenameFormat = os.path.splitext(inputFilename)[0] + '/frame_%06d.DNG'
+        self.inputFilename = inputFilename
+        self.outputFilenameFormat = outputFilenameFormat
+        self.width = width
+        self.length = length
+        self.bpp = bpp
+        self.colour = colour
+        self.frameSize = rawFrameSize(width, length, bpp)
+        self.frameCount = os.path.getsize(inputFilename) // self.frameSize
+        self.frames = 0
+        self.framesDone = 0
+        self.finishTime = None
+
+## Settings for a clip from a job file row or sidecar, as a dict with any
+## of the keys input, output, width, length (or height), format (16, packed
+## or legacy) and colour (true or false). CSV values are strings, so
+## everything is converted here.
+def clipSettings(spec):
+    settings = {}
+    for key, value in spec.items():
+        if value is None or value == '':
+            continue
+        key = key.strip().lower()
+        if key in ('width', 'length', 'height'):
+            settings['length' if key == 'height' else key] = int(value)
+        elif key == 'format':
+            settings['bpp'] = rawFormatBpp(str(value))
+        elif key in ('colour', 'color'):
+            settings['colour'] = str(value).strip().lower() in ('1', 'true', 'yes', 'colour', 'color')
+        elif key in ('input', 'output'):
+            settings[key] = value
+    return settings
+
+## Read a job file, either a JSON list of objects or a CSV file with a
+## header row, returning the settings of each clip
+def readJobFile(filename):
+    jobFile = open(filename, "r")
+    try:
+        if os.path.splitext(filename)[1].lower() == '.json':
+            specs = json.load(jobFile)
+        else:
+            specs = list(csv.DictReader(jobFile))
+    finally:
+        jobFile.close()
+    return [clipSettings(spec) for spec in specs]
+
+## The settings in a raw file's sidecar (the raw filename with .json added,
+## or in place of its extension), if it has one
+def readSidecar(inputFilename):
+    for sidecar in (inputFilename + '.json', os.path.splitext(inputFilename)[0] + '.json'):
+        if os.path.exists(sidecar):
+            sidecarFile = open(sidecar, "r")
+            try:
+                return clipSettings(json.load(sidecarFile))
+            finally:
+                sidecarFile.close()
+    return {}
+
+## Expand the inputs (filenames or glob patterns) into batchClips, taking
+## each clip's settings from its sidecar and otherwise from defaults
+def findClips(inputs, defaults):
+    clips = []
+    for pattern in inputs:
+        filenames = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not filenames:
+            raise ValueError("no files match %s" % pattern)
+        for inputFilename in filenames:
+            settings = dict(defaults, input=inputFilename)
+            settings.update(readSidecar(inputFilename))
+            clips.append(clipFromSettings(settings))
+    return clips
+
+def clipFromSettings(settings):
+    if settings.get('width') is None or settings.get('length') is None:
+        raise ValueError("no frame size given for %s" % settings.get('input'))
+    return batchClip(settings['input'], settings['width'], settings['length'], settings.get('bpp', 16),
+                     settings.get('colour', True), settings.get('output'))
+
+## Worker for batch conversion, tagging the stats returned by convertFrames
+## with the clip and number of frames they were for
+def convertBatchTask(batchTask):
+    clipIndex, task = batchTask
+    workerStats, entries = convertFrames(task)
+    return clipIndex, len(task[-1]), workerStats
+
+## Convert many clips at once, sharing a pool of jobs processes between
+## them. Frames are handed out in chunks, largest first, so that small
+## chunks fill in at the end and no core sits idle while one clip finishes.
+## progress(clip) is called whenever a chunk of a clip is done. Returns the
+## time taken.
+def convertBatch(clips, jobs, bitsPerSample=16, preview=False, frameSlice=None, stats=None, progress=None, digests=False):
+    import multiprocessing
+
+    if frameSlice is None:
+        frameSlice = slice(None)
+    if stats is None:
+        stats = NO_STATS
+    if (preview or digests) and numpy is None:
+        raise RuntimeError("previews and digests require numpy")
+    trace = None if stats is NO_STATS else (stats.events is not None)
+
+    tasks = []
+    for clipIndex, clip in enumerate(clips):
+        if (bitsPerSample == 12) and (clip.bpp == 16):
+            raise ValueError("12-bit output requires 12-bit packed input, %s is 16-bit" % clip.inputFilename)
+        makeOutputDir(clip.outputFilenameFormat)
+        creationTimeString = time.strftime("%x %X", time.localtime(creation_date(clip.inputFilename)))
+        digester = rawImageDigest(clip.width, clip.length, bitsPerSample, 1) if digests else None
+        dngTemplate, buf = buildDNG(clip.width, clip.length, clip.colour, creationTimeString, 0, bitsPerSample, preview, digester)
+        compiled = dngTemplate.compile()
+        clipPreview = previewBuilder(clip.width, clip.length, clip.colour, bitsPerSample) if preview else None
+
+        frameNums = list(range(*frameSlice.indices(clip.frameCount)))
+        clip.frames = len(frameNums)
+        for start in range(0, len(frameNums), PARALLEL_CHUNK_FRAMES):
+            chunk = frameNums[start:start + PARALLEL_CHUNK_FRAMES]
+            task = (clip.inputFilename, clip.outputFilenameFormat, clip.width, clip.length, clip.bpp, bitsPerSample,
+                    compiled, clipPreview, (), trace, False, chunk)
+            tasks.append((len(chunk) * clip.frameSize, clipIndex, task))
+
+    # sort is stable, so chunks of the same size stay in clip order
+    tasks.sort(key=lambda t: -t[0])
+
+    startTime = time.time()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for clipIndex, frames, workerStats in pool.imap_unordered(convertBatchTask, ((clipIndex, task) for size, clipIndex, task in tasks)):
+            if workerStats is not None:
+                stats.merge(workerStats)
+            clip = clips[clipIndex]
+            clip.framesDone += frames
+            if clip.framesDone == clip.frames:
+                clip.finishTime = time.time() - startTime
+            if progress:
+                progress(clip)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return time.time() - startTime
+
+## The bpp of a raw format, given by name (16, packed or legacy) or as a bpp
+def rawFormatBpp(fmt):
+    if fmt in (16, 12, -12):
+        return fmt
+    if str(fmt) not in RAW_FORMATS:
+        raise ValueError("unknown raw format %s, expected one of %s" % (fmt, ", ".join(sorted(RAW_FORMATS))))
+    return RAW_FORMATS[str(fmt)]
+
+## Name of the raw format for bpp, the inverse of rawFormatBpp
+def rawFormatName(bpp):
+    return dict((value, name) for name, value in RAW_FORMATS.items())[bpp]
+
+## Yield (frameNum, frame) for the frames of a raw video, without writing
+## anything. source is a filename, '-' for stdin or an open binary file, and
+## fmt is the raw format (16, packed or legacy). Frames are little-endian
+## samples, left-justified to 16 bits or packed as 12-bit DNG data when
+## bitsPerSample is 12. 16-bit frames are read-only views into the file.
+def iterFrames(source, width, length, fmt='16', bitsPerSample=16, frameSlice=None):
+    bpp = rawFormatBpp(fmt)
+    if (bitsPerSample == 12) and (bpp == 16):
+        raise ValueError("12-bit output requires 12-bit packed input")
+    return frameSource(openInput(source), width, length, bpp, bitsPerSample, frameSlice)
+
+## Yield (frameNum, dng) for the frames of a raw video, where dng is a
+## bytearray holding a complete DNG file, ready to be uploaded or passed on
+## without touching the disk. The arguments are as for iterFrames and
+## convertVideo. Uncompressed DNGs are built in a pool of poolSize buffers
+## that are reused in turn, so each is only valid until poolSize more
+## frames have been yielded; copy it with bytes() to keep it for longer.
+def iterDNGs(source, width, length, fmt='16', colour=True, bitsPerSample=16, frameSlice=None, preview=False, tileSize=0,
+             creationTime=None, poolSize=2, digests=False):
+    bpp = rawFormatBpp(fmt)
+    if (bitsPerSample == 12) and (bpp == 16):
+        raise ValueError("12-bit output requires 12-bit packed input")
+    if (tileSize or preview or digests) and numpy is None:
+        raise RuntimeError("compressed output, previews and digests require numpy")
+    if tileSize % 16:
+        raise ValueError("compressed output needs a tile size that is a multiple of 16")
+
+    if creationTime is None:
+        creationTime = time.time() if isStream(source) else creation_date(source)
+    creationTimeString = time.strftime("%x %X", time.localtime(creationTime))
+    digester = rawImageDigest(width, length, bitsPerSample) if digests else None
+    dngTemplate, buf = buildDNG(width, length, colour, creationTimeString, tileSize, bitsPerSample, preview, digester)
+    if preview:
+        preview = previewBuilder(width, length, colour, 16 if tileSize else bitsPerSample)
+    else:
+        preview = None
+
+    if tileSize:
+        for frameNum, rawFrame in frameSource(openInput(source), width, length, bpp, 16, frameSlice):
+            tiles = [encodeLJ92(tile, LJ92_COMPONENTS, bitsPerSample) for tile in frameTiles(rawFrame, width, length, tileSize, bitsPerSample)]
+            frameDigests = digester.frameDigests(rawFrame, frameNum) if digester else None
+            yield frameNum, layoutTiledDNG(dngTemplate, tiles, frameStrips(rawFrame, preview)[1:], frameDigests)
+        return
+
+    compiled = dngTemplate.compile()
+    pool = [compiled.newBuffer() for i in range(max(poolSize, 1))]
+    frames = bufferPool()
+    for position, (frameNum, rawFrame) in enumerate(frameSource(openInput(source), width, length, bpp, bitsPerSample, frameSlice, pool=frames)):
+        buf = pool[position % len(pool)]
+        compiled.fillBuffer(buf, frameStrips(rawFrame, preview), frameNum)
+        frames.put(rawFrame)
+        yield frameNum, buf
 
 
 #=========================================================================================================
@@ -449,6 +2730,9 @@ Version 0.1
 Copyright 2018 Kron Technologies Inc.
 
 pyraw2dng.py <options> <inputFilename> [<OutputFilenameFormat>]
+pyraw2dng.py <options> - <OutputFilenameFormat>
+pyraw2dng.py <options> --batch <inputFilename or pattern> ...
+pyraw2dng.py <options> --jobfile <jobs.csv or jobs.json>
 
 Options:
  --help      Display this help message
@@ -459,15 +2743,135 @@ Options:
  -w/--width  Frame width
  -l/--length Frame length
  -h/--height Frame length (please use only one)
+ -j/--jobs   Number of frames to convert in parallel (default: 1, or one
+             per CPU in batch mode)
+ -q/--queue  Overlap reading, converting and writing in separate threads,
+             buffering up to this many frames between them (default: off).
+             Cannot be used with --jobs.
+ --clip      Write the whole video into one multi-frame DNG file, or as
+             few as possible when it does not fit in 4GB
+ --chunk     Write multi-frame DNG files of this many frames each
+ --split     Split a multi-frame DNG file back into one DNG per frame
+ --compress  Write lossless JPEG compressed DNGs, using --jobs threads to
+             compress the tiles of each frame (requires numpy)
+ --tile      Tile size for compressed DNGs, a multiple of 16 (default: 256)
+ -b/--bits   Bits per sample in the output DNG, either 16 or 12 (default: 16).
+             12-bit output requires packed input.
+ --start     First frame to convert (default: 0)
+ --end       Last frame to convert (default: the end of the video)
+ --step      Convert only every Nth frame (default: 1)
+ --preview   Embed a 1/16th resolution RGB preview in each DNG (requires numpy)
+ --stats     Write the time spent and bytes moved in each stage of the
+             conversion to this file as JSON ('-' to print it)
+ --trace     Write the timing of every stage of every frame to this file
+             as Chrome trace events (open it in chrome://tracing)
+ --resume    Skip the frames listed as finished in the manifest left by an
+             earlier, interrupted run, and add the rest to it
+ --manifest  Record finished frames in this file (default with --resume:
+             pyraw2dng.manifest in the output directory)
+ --date      Time the video was recorded, as YYYY-MM-DD HH:MM:SS (default:
+             when the raw file was created, or now when reading stdin)
+ --batch     Convert every input file (or glob pattern) given, sharing one
+             pool of --jobs processes. Each clip's settings come from its
+             sidecar (the raw filename with .json added or in place of the
+             extension) or from the options given.
+ --jobfile   Convert the clips listed in a CSV or JSON job file, as in --batch
+ --dark      Subtract the average of this dark clip (recorded with the lens
+             covered, in the same format) from every frame. Give it more than
+             once to average several clips. The average is cached, and reused
+             as long as the same clips are given (requires numpy).
+ --cached-dark
+             Subtract the dark frame cached for this resolution, format and
+             gain by an earlier run with --dark
+ --gain      Gain the video and dark clips were recorded at, which keeps
+             calibrations for different gains apart (default: 1)
+ --dark-cache
+             Directory to cache dark frames in (default: pyraw2dng in the
+             user's cache directory)
+ --defects   Replace the hot and dead pixels listed in this defect map (made
+             with defects_pyraw2dng.py) with their neighbours (requires numpy)
+ --digest    Record a digest of each frame's raw image in its DNG
+             (NewRawImageDigest and RawDataUniqueID), which
+             verify_pyraw2dng.py checks (requires numpy)
    
 Output filename format must include '%06d' which will be replaced by the image sequence number.
+When writing multi-frame files, it is replaced by the number of the first frame in each file.
+An input filename of '-' reads the raw video from stdin, converting frames as they arrive.
+
+Batch job files and sidecars give the settings of each clip, using the keys input, output,
+width, length, format (16, packed or legacy) and colour (true or false), as the columns
+of a CSV file or the fields of JSON objects. Output defaults to a directory named after
+each input file.
 
 Examples:
   pyraw2dng.py -M -w 1280 -l 1024 test.raw
   pyraw2dng.py -w 336 -l 96 test.raw test_output/test_%06d.DNG
+  pyraw2dng.py --chunk 1000 -w 1280 -l 1024 test.raw test_output/clip_%06d.DNG
+  pyraw2dng.py --split test_output/clip_001000.DNG test_output/test_%06d.DNG
+  gunzip -c test.raw.gz | pyraw2dng.py -q 4 -w 1280 -l 1024 - test_output/test_%06d.DNG
+  pyraw2dng.py --batch -p -w 1280 -l 1024 'shoot/*.raw'
+  pyraw2dng.py -p -w 1280 -l 1024 --gain 2 --dark dark1.raw --dark dark2.raw test.raw
 '''
 
 
+def writeStats(stats, statsFilename, traceFilename):
+    if statsFilename == '-':
+        print json.dumps(stats.summary(), indent=2, sort_keys=True)
+    elif statsFilename:
+        with open(statsFilename, "w") as outfile:
+            json.dump(stats.summary(), outfile, indent=2, sort_keys=True)
+    if traceFilename:
+        with open(traceFilename, "w") as outfile:
+            json.dump(stats.trace(), outfile)
+
+def convertBatchMain(inputs, jobFilename, width, length, colour, bpp, jobs, bitsPerSample, frameSlice, preview,
+                     statsFilename, traceFilename, digests=False):
+    import multiprocessing
+
+    defaults = {'width': width, 'length': length, 'colour': colour, 'bpp': bpp}
+    try:
+        clips = findClips(inputs, defaults)
+        if jobFilename:
+            for settings in readJobFile(jobFilename):
+                if 'input' not in settings:
+                    raise ValueError("%s lists a clip without an input file" % jobFilename)
+                clipDefaults = dict(defaults, **readSidecar(settings['input']))
+                clips.append(clipFromSettings(dict(clipDefaults, **settings)))
+    except (ValueError, EnvironmentError) as e:
+        print 'Error: %s\n\n' % e
+        print helptext
+        sys.exit(0)
+
+    if not clips:
+        print helptext
+        sys.exit(0)
+
+    # Report each clip as it passes every tenth of its frames.
+    reported = {}
+    def progress(clip):
+        tenths = clip.framesDone * 10 // max(clip.frames, 1)
+        if reported.get(clip.inputFilename) != tenths:
+            reported[clip.inputFilename] = tenths
+            print "%s: %d/%d frames" % (clip.inputFilename, clip.framesDone, clip.frames)
+
+    stats = None
+    if statsFilename or traceFilename:
+        stats = conversionStats(trace=bool(traceFilename))
+
+    try:
+        elapsed = convertBatch(clips, jobs or multiprocessing.cpu_count(), bitsPerSample, preview, frameSlice, stats, progress, digests)
+    finally:
+        writeStats(stats, statsFilename, traceFilename)
+
+    frames = sum(clip.frames for clip in clips)
+    rawBytes = sum(clip.frames * clip.frameSize for clip in clips)
+    print
+    for clip in clips:
+        print "%-40s %5dx%-5d %6d frames, done after %7.2fs" % (
+            clip.inputFilename, clip.width, clip.length, clip.frames, clip.finishTime or 0.0)
+    print "%d clips, %d frames (%.1f MB) in %.2fs: %.1f frames/s, %.1f MB/s" % (
+        len(clips), frames, rawBytes / 1e6, elapsed, frames / elapsed, rawBytes / elapsed / 1e6)
+
 def main():
     width = None
     length = None
@@ -475,10 +2879,39 @@ def main():
     inputFilename = None
     outputFilenameFormat = None
     bpp = 16
+    jobs = None
+    queueDepth = 0
+    clipFrames = 0
+    split = False
+    compress = False
+    tileSize = 256
+    bitsPerSample = 16
+    start = None
+    end = None
+    step = None
+    preview = False
+    statsFilename = None
+    traceFilename = None
+    resume = False
+    manifestFilename = None
+    creationTime = None
+    batch = False
+    jobFilename = None
+    darkFilenames = []
+    cachedDark = False
+    gain = 1
+    darkCacheDir = None
+    defectsFilename = None
+    digests = False
     
     try:
-        options, args = getopt.getopt(sys.argv[1:], 'CMpw:l:h:',
-            ['help', 'color', 'packed', 'mono', 'width', 'length', 'height', 'oldpack'])
+        # gnu_getopt, so options can follow the list of inputs in batch mode
+        options, args = getopt.gnu_getopt(sys.argv[1:], 'CMpw:l:h:j:q:b:',
+            ['help', 'color', 'packed', 'mono', 'width', 'length', 'height', 'oldpack', 'jobs=', 'queue=',
+             'clip', 'chunk=', 'split', 'compress', 'tile=', 'bits=',
+             'start=', 'end=', 'step=', 'preview', 'stats=', 'trace=',
+             'resume', 'manifest=', 'date=', 'batch', 'jobfile=',
+             'dark=', 'cached-dark', 'gain=', 'dark-cache=', 'defects=', 'digest'])
     except getopt.error:
         print 'Error: You tried to use an unknown option.\n\n'
         print helptext
@@ -511,11 +2944,127 @@ def main():
         elif o in ('-w', '--width'):
             width = int(a)
 
+        elif o in ('-j', '--jobs'):
+            jobs = int(a)
+
+        elif o in ('-q', '--queue'):
+            queueDepth = int(a)
+
+        elif o == '--clip':
+            clipFrames = None
+
+        elif o == '--chunk':
+            clipFrames = int(a)
+
+        elif o == '--split':
+            split = True
+
+        elif o == '--compress':
+            compress = True
+
+        elif o == '--tile':
+            tileSize = int(a)
+
+        elif o in ('-b', '--bits'):
+            bitsPerSample = int(a)
+            if bitsPerSample not in (12, 16):
+                print 'Error: Bits per sample must be 16 or 12.\n\n'
+                print helptext
+                sys.exit(0)
+
+        elif o == '--start':
+            start = int(a)
+
+        elif o == '--end':
+            end = int(a) + 1
+
+        elif o == '--step':
+            step = int(a)
+
+        elif o == '--preview':
+            preview = True
+
+        elif o == '--stats':
+            statsFilename = a
+
+        elif o == '--trace':
+            traceFilename = a
+
+        elif o == '--resume':
+            resume = True
+
+        elif o == '--manifest':
+            manifestFilename = a
+
+        elif o == '--batch':
+            batch = True
+
+        elif o == '--jobfile':
+            jobFilename = a
+
+        elif o == '--dark':
+            darkFilenames.append(a)
+
+        elif o == '--cached-dark':
+            cachedDark = True
+
+        elif o == '--gain':
+            gain = int(a)
+
+        elif o == '--dark-cache':
+            darkCacheDir = a
+
+        elif o == '--defects':
+            defectsFilename = a
+
+        elif o == '--digest':
+            digests = True
+
+        elif o == '--date':
+            try:
+                creationTime = time.mktime(time.strptime(a, "%Y-%m-%d %H:%M:%S"))
+            except ValueError:
+                print 'Error: The date must be given as YYYY-MM-DD HH:MM:SS.\n\n'
+                print helptext
+                sys.exit(0)
+
+    # Batch clips may each have their own format, which convertBatch checks.
+    if (bitsPerSample == 12) and (bpp == 16) and not (batch or jobFilename):
+        print 'Error: 12-bit output requires packed input (--packed or --oldpack).\n\n'
+        print helptext
+        sys.exit(0)
+
+    if digests and numpy is None:
+        print 'Error: Digests require numpy.\n\n'
+        print helptext
+        sys.exit(0)
+
+    if batch or jobFilename:
+        if darkFilenames or cachedDark or defectsFilename:
+            print 'Error: Dark frame subtraction and defect maps cannot be used in batch mode.\n\n'
+            print helptext
+            sys.exit(0)
+        convertBatchMain(args, jobFilename, width, length, colour, bpp, jobs, bitsPerSample, slice(start, end, step), preview,
+                         statsFilename, traceFilename, digests)
+        return
+
+    if jobs is None:
+        jobs = 1
+
+    if (jobs > 1) and queueDepth and not compress and (clipFrames == 0):
+        print 'Error: --jobs and --queue cannot be used together.\n\n'
+        print helptext
+        sys.exit(0)
+
     if len(args) < 1:
         print helptext
         sys.exit(0)
 
     elif len(args) == 1:
+        if args[0] == '-':
+            print 'Error: An output filename format is needed when reading from stdin.\n\n'
+            print helptext
+            sys.exit(0)
         inputFilename = args[0]
         dirname = os.path.splitext(inputFilename)[0]
         basename = os.path.basename(inputFilename)
@@ -525,7 +3074,89 @@ def main():
         inputFilename = args[0]
         outputFilenameFormat = args[1]
 
-    convertVideo(inputFilename, outputFilenameFormat, width, length, colour, bpp)
+    if split:
+        makeOutputDir(outputFilenameFormat)
+        splitClip(inputFilename, outputFilenameFormat)
+        return
+
+    corrections = []
+    if (darkFilenames or cachedDark or defectsFilename) and numpy is None:
+        print 'Error: Dark frame subtraction and defect maps require numpy.\n\n'
+        print helptext
+        sys.exit(0)
+
+    if darkFilenames or cachedDark:
+        try:
+            dark, cached = calibrateDark(darkFilenames, width, length, bpp, gain, darkCacheDir)
+        except (ValueError, EnvironmentError) as e:
+            print 'Error: %s\n\n' % e
+            print helptext
+            sys.exit(0)
+        if cached:
+            print "Using the cached dark frame, averaged from %d frames" % dark.frames
+        else:
+            print "Averaged %d dark frames" % dark.frames
+        corrections.append(dark)
+
+    if defectsFilename:
+        try:
+            defects = loadDefectMap(defectsFilename)
+        except (ValueError, KeyError, EnvironmentError) as e:
+            print 'Error: %s\n\n' % e
+            print helptext
+            sys.exit(0)
+        if (defects.width, defects.length) != (width, length):
+            print 'Error: The defect map is for %dx%d video.\n\n' % (defects.width, defects.length)
+            print helptext
+            sys.exit(0)
+        corrections.append(defects)
+
+    if isStream(inputFilename) and (jobs > 1) and not compress and (clipFrames == 0):
+        print 'Error: Parallel conversion needs an input file, not stdin. Drop --jobs and use --queue instead.\n\n'
+        print helptext
+        sys.exit(0)
+
+    manifest = None
+    if resume or manifestFilename:
+        if isStream(inputFilename):
+            print 'Error: Resuming needs an input file, not stdin.\n\n'
+            print helptext
+            sys.exit(0)
+        makeOutputDir(outputFilenameFormat)
+        if not manifestFilename:
+            manifestFilename = os.path.join(os.path.dirname(outputFilenameFormat % 0), "pyraw2dng.manifest")
+        settings = {'width': width, 'length': length, 'colour': colour, 'bpp': bpp, 'bitsPerSample': bitsPerSample,
+                    'clipFrames': clipFrames, 'tileSize': tileSize if compress else 0, 'preview': preview,
+                    'output': outputFilenameFormat}
+        if corrections:
+            settings['corrections'] = [correction.digest for correction in corrections]
+        if digests:
+            settings['digests'] = True
+        manifest = conversionManifest(manifestFilename, inputFilename, settings, resume)
+        if manifest.done:
+            print "Resuming, %d frames already converted" % len(manifest.done)
+
+    stats = None
+    if statsFilename or traceFilename:
+        stats = conversionStats(trace=bool(traceFilename))
+
+    try:
+        stages = convertVideo(inputFilename, outputFilenameFormat, width, length, colour, bpp, jobs, queueDepth, clipFrames,
+                              tileSize if compress else 0, bitsPerSample, slice(start, end, step), preview, stats, manifest,
+                              creationTime, corrections, digests)
+    except ValueError as e:
+        print 'Error: %s\n\n' % e
+        print helptext
+        sys.exit(0)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        # Written even when the conversion fails, to show how far it got.
+        writeStats(stats, statsFilename, traceFilename)
+
+    if stages:
+        for stage in stages:
+            print stage
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python2.7
+
+# standard python imports
+import sys
+import os
+import getopt
+import glob
+import time
+import multiprocessing
+
+import pyraw2dng
+
+
+#=========================================================================================================
+helptext = '''verify_pyraw2dng.py - Check DNGs against the digests recorded by pyraw2dng.py --digest
+Copyright 2018 Kron Technologies Inc.
+
+verify_pyraw2dng.py <options> <file, directory or pattern> ...
+
+Recomputes the NewRawImageDigest of every frame of the given DNG files (and
+of every .dng file under the given directories) and compares it with the
+digest recorded when the file was written, checking many files at once.
+Compressed (--compress) DNGs are decompressed to be checked.
+Files whose raw data has changed are listed, and the exit status is 1 if
+any frame does not match or a file could not be read.
+
+Options:
+ --help      Display this help message
+ -j/--jobs   Number of files to check in parallel (default: one per CPU)
+ -v/--verbose
+             List every file checked, not only those that fail
+
+Examples:
+  pyraw2dng.py --digest -p -w 1280 -l 1024 test.raw
+  verify_pyraw2dng.py test/
+'''
+
+
+## How each status returned by pyraw2dng.verifyDNG is listed
+STATUS_NAMES = {'ok': 'ok', 'mismatch': 'does not match', 'missing': 'no digest'}
+
+## Every DNG file named on the command line or found under a directory
+def findFiles(inputs):
+    filenames = []
+    for name in inputs:
+        if os.path.isdir(name):
+            for dirpath, dirnames, files in os.walk(name):
+                dirnames.sort()
+                filenames.extend(os.path.join(dirpath, f) for f in sorted(files) if f.lower().endswith('.dng'))
+        elif glob.has_magic(name):
+            filenames.extend(sorted(glob.glob(name)))
+        else:
+            filenames.append(name)
+    return filenames
+
+## Worker process: the status of each frame of a file, or the error that
+## stopped it being read
+def verifyFile(filename):
+    try:
+        return filename, os.path.getsize(filename), pyraw2dng.verifyDNG(filename), None
+    except (ValueError, EnvironmentError, pyraw2dng.struct.error) as e:
+        return filename, 0, [], str(e) or e.__class__.__name__
+
+def main():
+    jobs = None
+    verbose = False
+
+    try:
+        options, args = getopt.gnu_getopt(sys.argv[1:], 'j:v', ['help', 'jobs=', 'verbose'])
+    except getopt.error:
+        print 'Error: You tried to use an unknown option.\n\n'
+        print helptext
+        sys.exit(0)
+
+    for o, a in options:
+        if o == '--help':
+            print helptext
+            sys.exit(0)
+
+        elif o in ('-j', '--jobs'):
+            jobs = int(a)
+
+        elif o in ('-v', '--verbose'):
+            verbose = True
+
+    if not args:
+        print helptext
+        sys.exit(0)
+
+    if pyraw2dng.numpy is None:
+        print 'Error: Checking digests requires numpy.\n\n'
+        sys.exit(0)
+
+    filenames = findFiles(args)
+    counts = dict.fromkeys(['ok', 'mismatch', 'missing'], 0)
+    errors = 0
+    totalBytes = 0
+
+    startTime = time.time()
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    try:
+        for filename, size, results, error in pool.imap(verifyFile, filenames):
+            totalBytes += size
+            if error is not None:
+                errors += 1
+                print "%s: %s" % (filename, error)
+                continue
+            for status in results:
+                counts[status] += 1
+
+            bad = [frame for frame, status in enumerate(results) if status == 'mismatch']
+            if bad and len(results) > 1:
+                print "%s: frame%s %s of %d do%s not match" % (filename, 's' if len(bad) > 1 else '',
+                    ', '.join(str(frame) for frame in bad), len(results), '' if len(bad) > 1 else 'es')
+            elif bad:
+                print "%s: does not match its digest" % filename
+            elif verbose:
+                print "%s: %s" % (filename, ', '.join(STATUS_NAMES[status] for status in sorted(set(results))))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    elapsed = max(time.time() - startTime, 1e-6)
+
+    print "%d files, %d frames (%.1f MB) checked in %.2fs, %.1f MB/s" % (
+        len(filenames), sum(counts.values()), totalBytes / 1e6, elapsed, totalBytes / elapsed / 1e6)
+    print "%d ok, %d mismatched, %d without a digest, %d unreadable files" % (
+        counts['ok'], counts['mismatch'], counts['missing'], errors)
+    if counts['mismatch'] or errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()